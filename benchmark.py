@@ -0,0 +1,1283 @@
+"""
+HealthDomino
+============
+
+HealthDomino is a GDPR or HIPAA compatible data driven service, that helps
+the user to store, manage, share or use their own personal medical records or
+health data securely with the advantages of being anonymous or with revealed
+identity at the same time.
+
+WHY PYTHON?
+-----------
+We use Python for planning, modeling and prototyping purposes. We think Python
+code is much easier to read at the first time.
+
+The use of Python doesn't mean that we'll develop our production ready solution
+in Python or in Python only. We transform our solutions to C++ or Java quite
+often.
+
+THIS FILE
+---------
+This file contains benchmarks of the HealthDomino workflow. Every benchmark is
+run with each of its dataset sizes, timed and measured for peak memory.
+
+    python benchmark.py                    run every benchmark
+    python benchmark.py transmit close     run benchmarks by name prefix
+    python benchmark.py --quick            run the smallest sizes only
+    python benchmark.py --save             store results as the new baseline
+    python benchmark.py --compare          compare results with the baseline
+    python benchmark.py import             measure import times only
+    python benchmark.py series             series storage benchmarks and report
+    python benchmark.py server.custody     batched re-encryption of accepted objects
+    python benchmark.py server.filters     Bloom filter negative lookup report
+    python benchmark.py server.rateLimits  reservation flood and idle bucket eviction
+    python benchmark.py merkle             replica anti-entropy sync report
+    python benchmark.py broadcast          broadcast fan-out to 100 000 subscriptions
+    python benchmark.py outbox             offline outbox report
+    python benchmark.py pipeline           parallel preparation at 1, 4 and 16 workers, deduplication
+    python benchmark.py rawdata.nested     nested RawData at depth 1 to 10 000
+
+The baseline is stored in benchmark_baseline.json, so performance regressions
+show up in review as a diff of that file. --compare fails on a regression and
+on a benchmark that has no baseline yet, run --save after adding one.
+"""
+from argparse import ArgumentParser
+from hddo import HDDORateLimitException, HealthDominoDataObject, RawData
+import json
+from mock_app import App, AppCache
+from mock_broadcast import BroadcastRegistry
+from mock_custody import CustodyStage, PARSED_KEYS, protect_chunk, reveal_content
+from mock_merkle import MerkleReplica, sync_replicas
+from mock_metrics import Metrics, MetricsRecorder
+from mock_other import LogManager, ScriptEngine
+from mock_pipeline import deduplicate, prepare_batch, transmit_batch
+from mock_outbox import Outbox
+from mock_query import Aggregator, DataIndex
+from mock_ratelimit import TokenBucketLimiter
+from mock_segments import SegmentStore
+from mock_series import SeriesStore
+from mock_vault import Vault
+from mock_wal import WriteAheadLog
+from mock_server import Server
+from gc import collect
+from hashlib import sha256
+from os import devnull, sysconf
+from os.path import dirname, join
+from random import Random
+from subprocess import run as run_process
+from tempfile import TemporaryDirectory
+from threading import Thread
+from sys import executable, exit
+from time import perf_counter
+import tracemalloc
+
+
+
+BASELINE_PATH = join(dirname(__file__), 'benchmark_baseline.json')
+# Objects stored for the cold storage memory report. The production estimate
+# was made with 10 000 000, which needs a few minutes and gigabytes of RAM.
+COLD_OBJECTS = 100000
+BENCHMARKS = {}
+IMPORTS = ['hddo', 'mock_app', 'mock_server']
+REPORTS = {}
+TIMESTAMP = 1613862953
+
+
+
+def benchmark(name: str, sizes: list):
+
+    def decorator(function):
+
+        BENCHMARKS[name] = (function, sizes)
+        return function
+
+    return decorator
+
+
+
+def report(name: str):
+
+    def decorator(function):
+
+        REPORTS[name] = function
+        return function
+
+    return decorator
+
+
+
+def build_hddos(count: int, script: bool=False, closed: bool=True) -> list:
+
+    result = []
+    for i in range(count):
+        hddo = HealthDominoDataObject(RawData('human_measure.weight.kg',
+                                              50.0 + (i % 2000) / 100,
+                                              TIMESTAMP + i))
+        if script:
+            hddo.addScript(['<SigKey>', str(i), 'HD_ADD', str(i)])
+        if closed:
+            hddo.close()
+        result.append(hddo)
+    return result
+
+
+
+def build_stream(kind: str, count: int) -> list:
+
+    # Synthetic device streams like in example.py: a thermometer reporting
+    # every minute with some jitter and a scale reporting once a day.
+    random = Random(count)
+    result = []
+    timestamp = TIMESTAMP
+    for _ in range(count):
+        if kind == 'thermometer':
+            timestamp += 60 + random.choice([0, 0, 0, 0, 1, -1])
+            result.append((timestamp, round(random.uniform(36.1, 37.4), 1)))
+        else:
+            timestamp += 86400 + random.randrange(-600, 600)
+            result.append((timestamp, round(random.uniform(50.0, 70.0), 2)))
+    return result
+
+
+
+def lifecycle(count: int):
+
+    for hddo in build_hddos(count):
+        hddo.transmit()
+        App.requestDelete(HealthDominoDataObject.toSendable(hddo), hddo.hashBase)
+
+
+
+def reset_server():
+
+    Server.hddo_accepted.clear()
+    Server.hddo_encoding_keys.clear()
+    Server.hddo_encryption_keys.clear()
+    Server.hddo_inner.clear()
+    Server.hddo_nounces.clear()
+    Server.hddo_outer.clear()
+    Server.hddo_reencrypted.clear()
+    Server.hddo_reserved.clear()
+    Server.broadcasts.clear()
+    Server.filters = {}
+    Server.limiters = {}
+    Server.script_cache = None
+    Server.trees = {}
+    DataIndex.clear()
+    Aggregator.clear()
+    SeriesStore.clear()
+
+
+
+@benchmark('rawdata.init', [100, 1000, 10000])
+def bench_rawdata_init(size: int):
+
+    def run():
+        for i in range(size):
+            RawData('human_measure.weight.kg', 60.0, TIMESTAMP + i)
+
+    yield run
+
+
+
+@benchmark('rawdata.toJSON', [100, 1000, 10000])
+def bench_rawdata_to_json(size: int):
+
+    data = [RawData('human_measure.weight.kg', 60.0, TIMESTAMP + i) for i in range(size)]
+
+    def run():
+        for item in data:
+            item.toJSON()
+
+    yield run
+
+
+
+@benchmark('rawdata.fromJSON', [100, 1000, 10000])
+def bench_rawdata_from_json(size: int):
+
+    data = [RawData('human_measure.weight.kg', 60.0, TIMESTAMP + i).toJSON() for i in range(size)]
+
+    def run():
+        for item in data:
+            RawData.fromJSON(item)
+
+    yield run
+
+
+
+def waveform_json(size: int) -> list:
+
+    # Ten seconds of a 250 Hz ECG lead per object.
+    waveform = [round(0.5 * (i % 50) / 50, 3) for i in range(2500)]
+    return [RawData('human_measure.ecg.mv', waveform, TIMESTAMP + i).toJSON() for i in range(size)]
+
+
+
+@benchmark('rawdata.fromJSON.waveform', [100, 1000])
+def bench_rawdata_from_json_waveform(size: int):
+
+    data = waveform_json(size)
+
+    def run():
+        for item in data:
+            RawData.fromJSON(item).toJSON()
+
+    yield run
+
+
+
+@benchmark('rawdata.fromJSON.waveform.lazy', [100, 1000])
+def bench_rawdata_from_json_waveform_lazy(size: int):
+
+    data = waveform_json(size)
+
+    def run():
+        for item in data:
+            RawData.fromJSON(item, lazy=True).toJSON()
+
+    yield run
+
+
+
+def nested_rawdata(depth: int):
+
+    # A reading wrapped by depth levels of RawData, like a value forwarded
+    # through a chain of devices.
+    result = RawData('human_measure.weight.kg', 60.0, TIMESTAMP)
+    for i in range(depth):
+        result = RawData('human_measure.weight.kg', result, TIMESTAMP + i)
+    return result
+
+
+
+@benchmark('rawdata.nested.toJSON', [1, 10, 100, 1000, 10000])
+def bench_rawdata_nested_to_json(size: int):
+
+    data = nested_rawdata(size)
+
+    def run():
+        data.toJSON()
+
+    yield run
+
+
+
+@benchmark('rawdata.nested.fromJSON', [1, 10, 100, 1000, 10000])
+def bench_rawdata_nested_from_json(size: int):
+
+    data = nested_rawdata(size).toJSON()
+
+    def run():
+        RawData.fromJSON(data)
+
+    yield run
+
+
+
+@benchmark('hddo.close', [100, 1000, 10000])
+def bench_close(size: int):
+
+    def run():
+        for hddo in build_hddos(size, closed=False):
+            hddo.close()
+
+    yield run
+
+
+
+@benchmark('hddo.toSendable', [100, 1000, 10000])
+def bench_to_sendable(size: int):
+
+    hddos = build_hddos(size, script=True)
+
+    def run():
+        for hddo in hddos:
+            HealthDominoDataObject.toSendable(hddo)
+
+    yield run
+
+
+
+@benchmark('hddo.transmit', [100, 1000, 10000])
+def bench_transmit(size: int):
+
+    App.registerUser()
+    hddos = []
+
+    def prepare():
+        reset_server()
+        hddos.clear()
+        hddos.extend(build_hddos(size))
+
+    def run():
+        for hddo in hddos:
+            hddo.transmit()
+
+    yield prepare, run
+    reset_server()
+
+
+
+@benchmark('server.sendBroadcast', [100, 1000, 10000])
+def bench_send_broadcast(size: int):
+
+    App.registerUser()
+    reset_server()
+    hddos = build_hddos(size, script=True)
+    for hddo in hddos:
+        hddo.transmit()
+    inner_hashes = [hddo.innerHash for hddo in hddos]
+
+    def run():
+        for inner_hash in inner_hashes:
+            Server.sendBroadcast(inner_hash)
+
+    yield run
+    reset_server()
+
+
+
+@benchmark('server.queryData', [1000, 10000, 100000])
+def bench_query_data(size: int):
+
+    App.registerUser()
+    reset_server()
+    for hddo in build_hddos(size):
+        hddo.transmit()
+    start = TIMESTAMP + size // 2
+    end = start + 100
+
+    def run():
+        for _ in range(100):
+            for _ in Server.queryData('human_measure.weight.kg', start, end):
+                pass
+
+    yield run
+    reset_server()
+
+
+
+@benchmark('server.queryData.scan', [1000, 10000, 100000])
+def bench_query_data_scan(size: int):
+
+    App.registerUser()
+    reset_server()
+    for hddo in build_hddos(size):
+        hddo.transmit()
+    start = TIMESTAMP + size // 2
+    end = start + 100
+
+    def run():
+        for _ in range(100):
+            for hddo in Server.hddo_inner.values():
+                if hddo.data.label == 'human_measure.weight.kg' and start <= hddo.data.timestamp <= end:
+                    pass
+
+    yield run
+    reset_server()
+
+
+
+@benchmark('server.aggregateData', [1000, 10000, 100000])
+def bench_aggregate_data(size: int):
+
+    App.registerUser()
+    reset_server()
+    for hddo in build_hddos(size):
+        hddo.transmit()
+
+    def run():
+        for _ in range(100):
+            Server.aggregateData('human_measure.weight.kg', TIMESTAMP, TIMESTAMP + size)
+
+    yield run
+    reset_server()
+
+
+
+@benchmark('series.append', [1000, 10000, 100000])
+def bench_series_append(size: int):
+
+    points = build_stream('thermometer', size)
+
+    def run():
+        SeriesStore.clear()
+        for i, (timestamp, value) in enumerate(points):
+            SeriesStore.append('thermometer', 'thermometer.body_temperature.celsius',
+                               str(i), timestamp, value)
+
+    yield run
+    SeriesStore.clear()
+
+
+
+@benchmark('series.scan', [1000, 10000, 100000])
+def bench_series_scan(size: int):
+
+    SeriesStore.clear()
+    for i, (timestamp, value) in enumerate(build_stream('thermometer', size)):
+        SeriesStore.append('thermometer', 'thermometer.body_temperature.celsius',
+                           str(i), timestamp, value)
+
+    def run():
+        for _ in SeriesStore.scan('thermometer', 'thermometer.body_temperature.celsius'):
+            pass
+
+    yield run
+    SeriesStore.clear()
+
+
+
+@report('series.compression')
+def report_series_compression() -> dict:
+
+    result = {}
+    for kind, label in [('thermometer', 'thermometer.body_temperature.celsius'),
+                        ('scale', 'human_measure.weight.kg')]:
+        SeriesStore.clear()
+        points = build_stream(kind, 100000)
+        json_size = 0
+        for i, (timestamp, value) in enumerate(points):
+            SeriesStore.append(kind, label, str(i), timestamp, value)
+            json_size += len(RawData(label, value, timestamp).toJSON())
+        encoded = SeriesStore.encodedSize()
+        result['{} bytes/point'.format(kind)] = encoded / len(points)
+        result['{} ratio vs 16 bytes/point'.format(kind)] = 16 * len(points) / encoded
+        result['{} ratio vs RawData JSON'.format(kind)] = json_size / encoded
+    SeriesStore.clear()
+    return result
+
+
+
+@report('wal.recovery')
+def report_wal_recovery() -> dict:
+
+    App.registerUser()
+    result = {}
+    with TemporaryDirectory() as directory:
+        reset_server()
+        Server.recover(WriteAheadLog(directory, group_commit_seconds=0,
+                                     snapshot_every=500))
+        hddos = build_hddos(2000)
+        for hddo in hddos:
+            hddo.transmit()
+        for hddo in hddos[::4]:
+            App.requestDelete(HealthDominoDataObject.toSendable(hddo), hddo.hashBase)
+        Server.reserveIfAvailable('0' * 64)
+        expected = Server.getState()
+        # Crash: the process dies in the middle of writing a record.
+        segment = join(directory, Server.wal.files('wal-')[-1])
+        with open(segment, 'a', encoding='utf-8') as out_file:
+            out_file.write('0badc0de {"type":"delete","inner')
+        Server.wal = None
+        Server.reset()
+        start = perf_counter()
+        replayed = Server.recover(WriteAheadLog(directory, group_commit_seconds=0))
+        result['recovery seconds'] = perf_counter() - start
+        result['replayed records'] = replayed
+        Server.wal.close()
+        Server.wal = None
+        if Server.getState() != expected:
+            raise AssertionError('Recovered Server state differs from the state before the crash.')
+        result['recovered objects'] = len(Server.hddo_inner)
+    reset_server()
+    return result
+
+
+
+@report('wal.group_commit')
+def report_wal_group_commit() -> dict:
+
+    result = {}
+    threads_count = 16
+    per_thread = 200
+    for window in [0, 0.001, 0.005, 0.02]:
+        with TemporaryDirectory() as directory:
+            wal = WriteAheadLog(directory, group_commit_seconds=window)
+
+            def worker(thread_id):
+                for i in range(per_thread):
+                    wal.append({'type' : 'reserve', 'inner_hash' : '{}-{}'.format(thread_id, i),
+                                'transmission_id' : ''})
+
+            threads = [Thread(target=worker, args=(i,)) for i in range(threads_count)]
+            start = perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = perf_counter() - start
+            wal.close()
+        result['commits/s at {:g} ms window'.format(window * 1000)] = threads_count * per_thread / elapsed
+    # The Server itself is single threaded, a window only delays it.
+    App.registerUser()
+    count = 200
+    for window in [0, 0.002]:
+        with TemporaryDirectory() as directory:
+            reset_server()
+            Server.recover(WriteAheadLog(directory, group_commit_seconds=window))
+            hddos = build_hddos(count)
+            start = perf_counter()
+            for hddo in hddos:
+                hddo.transmit()
+            result['server transmit ms at {:g} ms window'.format(window * 1000)] = (perf_counter() - start) / count * 1e3
+            requests = [(hddo.innerHash, hddo.outerHash, hddo.hashBase) for hddo in hddos]
+            start = perf_counter()
+            Server.deleteHDDOs(requests)
+            result['server batch delete ms at {:g} ms window'.format(window * 1000)] = (perf_counter() - start) * 1e3
+            Server.wal.close()
+            Server.wal = None
+    reset_server()
+    return result
+
+
+
+def resident_memory() -> int:
+
+    try:
+        with open('/proc/self/statm', 'r') as in_file:
+            return int(in_file.read().split()[1]) * sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+
+@report('hash.algorithms')
+def report_hash_algorithms() -> dict:
+
+    # A weight reading, a day of heart rate, an ECG strip and an image.
+    result = {}
+    for payload_size in (100, 4096, 65536, 2 ** 20):
+        content = b'0' * payload_size
+        count = max(2 ** 24 // payload_size, 1000)
+        for version, name in ((HealthDominoDataObject.VERSION_0, 'sha256'),
+                              (HealthDominoDataObject.VERSION_1, 'blake2b')):
+            start = perf_counter()
+            for _ in range(count):
+                HealthDominoDataObject.newHash(version, content).hexdigest()
+            seconds = perf_counter() - start
+            result['{} {} B us'.format(name, payload_size)] = seconds / count * 1e6
+            result['{} {} B MiB/s'.format(name, payload_size)] = count * payload_size / seconds / 2 ** 20
+    return result
+
+
+
+@report('hash.streaming')
+def report_hash_streaming() -> dict:
+
+    result = {}
+    for payload_size in (2 ** 20, 2 ** 22, 2 ** 24):
+        for name, value in (('str', '0' * payload_size), ('bytes', b'0' * payload_size)):
+            hddo = HealthDominoDataObject(RawData('human_measure.ecg.raw', value, TIMESTAMP))
+            hddo.close()
+            collect()
+            tracemalloc.start()
+            expected = HealthDominoDataObject.newHash(hddo.version, hddo.toHashable()).hexdigest()
+            _, materialized_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            tracemalloc.start()
+            computed = hddo.computeHash()
+            _, streamed_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            if computed != expected:
+                raise AssertionError('Streaming hash differs from the hash of toHashable().')
+            result['{} {} MiB toHashable peak KiB'.format(name, payload_size // 2 ** 20)] = materialized_peak / 2 ** 10
+            result['{} {} MiB computeHash peak KiB'.format(name, payload_size // 2 ** 20)] = streamed_peak / 2 ** 10
+    return result
+
+
+
+@report('segments.memory')
+def report_segments_memory() -> dict:
+
+    result = {}
+    reset_server()
+    collect()
+    tracemalloc.start()
+    start_rss = resident_memory()
+    for i in range(COLD_OBJECTS):
+        hddo = HealthDominoDataObject(RawData('human_measure.weight.kg',
+                                              50.0 + (i % 2000) / 100,
+                                              TIMESTAMP + i))
+        hddo.close()
+        inner_hash = '{:064x}'.format(i)
+        hddo.reset_('', inner_hash, '')
+        Server.storeHDDO(hddo, '{:064x}'.format(i + COLD_OBJECTS), b'0' * 64)
+    collect()
+    hot_heap, _ = tracemalloc.get_traced_memory()
+    result['objects'] = COLD_OBJECTS
+    result['hot heap MiB'] = hot_heap / 2 ** 20
+    result['hot rss delta MiB'] = (resident_memory() - start_rss) / 2 ** 20
+    with TemporaryDirectory() as directory:
+        Server.cold_store = SegmentStore(directory)
+        start = perf_counter()
+        Server.sealCold()
+        result['seal seconds'] = perf_counter() - start
+        collect()
+        cold_heap, _ = tracemalloc.get_traced_memory()
+        result['cold heap MiB'] = cold_heap / 2 ** 20
+        result['cold rss delta MiB'] = (resident_memory() - start_rss) / 2 ** 20
+        tracemalloc.stop()
+        start = perf_counter()
+        for i in range(0, COLD_OBJECTS, 97):
+            Server.sendBroadcast('{:064x}'.format(i))
+        result['cold lookup us'] = (perf_counter() - start) / len(range(0, COLD_OBJECTS, 97)) * 1e6
+        Server.cold_store.close()
+        Server.cold_store = None
+    reset_server()
+    return result
+
+
+
+@report('server.custody')
+def report_server_custody() -> dict:
+
+    result = {}
+    reset_server()
+    clients = [App() for _ in range(4)]
+    for client in clients:
+        client.registerUser()
+    count = 1000
+    items = [('{:064x}'.format(i), clients[i % len(clients)].user_pha,
+              RawData('human_measure.weight.kg', 50.0 + (i % 2000) / 100, TIMESTAMP + i).toJSON())
+             for i in range(count)]
+    # Done naively, every object parses the public key of its PHA again.
+    start = perf_counter()
+    for inner_hash, pha, content in items:
+        PARSED_KEYS.clear()
+        protect_chunk((pha, Server.users[pha], [(inner_hash, content)]))
+    result['per object us'] = (perf_counter() - start) / count * 1e6
+    for workers in (1, 4):
+        PARSED_KEYS.clear()
+        stage = CustodyStage(count, workers)
+        stage.pending = list(items)
+        start = perf_counter()
+        stage.protect(Server.users)
+        result['batch of {} workers {} us'.format(count, workers)] = (perf_counter() - start) / count * 1e6
+        stage.close()
+    # Accepted objects protected and written to the three stores.
+    for custody in (False, True):
+        hddos = []
+        for i in range(count // 4):
+            hddo = HealthDominoDataObject(RawData('human_measure.weight.kg',
+                                                  50.0 + (i % 2000) / 100,
+                                                  TIMESTAMP + i))
+            hddo.addPHA(clients[i % len(clients)])
+            hddo.close()
+            hddos.append(hddo)
+        if custody:
+            Server.enableCustody(64, 1)
+        start = perf_counter()
+        for i, hddo in enumerate(hddos):
+            hddo.transmit(clients[i % len(clients)])
+        Server.flushCustody()
+        name = 'transmit with custody us' if custody else 'transmit us'
+        result[name] = (perf_counter() - start) / len(hddos) * 1e6
+    result['protected'] = len(Server.hddo_reencrypted)
+    inner_hash = hddos[0].innerHash
+    revealed = reveal_content(clients[0].user_private_key, Server.hddo_reencrypted[inner_hash],
+                              Server.hddo_encoding_keys[inner_hash],
+                              Server.hddo_encryption_keys[inner_hash])
+    if revealed != hddos[0].data.toJSON():
+        raise AssertionError('Custody changed the data of {}.'.format(inner_hash))
+    if Server.getStoredHDDO(inner_hash).data.value is not None:
+        raise AssertionError('The Server kept the data of {}.'.format(inner_hash))
+    Server.custody.close()
+    Server.custody = None
+    reset_server()
+    return result
+
+
+
+@report('server.filters')
+def report_server_filters() -> dict:
+
+    result = {}
+    reset_server()
+    for i in range(COLD_OBJECTS):
+        hddo = HealthDominoDataObject(RawData('human_measure.weight.kg',
+                                              50.0 + (i % 2000) / 100,
+                                              TIMESTAMP + i))
+        hddo.close()
+        hddo.reset_('', '{:064x}'.format(i), '')
+        Server.storeHDDO(hddo, '{:064x}'.format(i + COLD_OBJECTS), b'0' * 64)
+    # Unknown hashes, like the ones of new objects asking for a reservation.
+    missing = ['{:064x}'.format(COLD_OBJECTS * 2 + i) for i in range(COLD_OBJECTS // 10)]
+    with TemporaryDirectory() as directory:
+        Server.cold_store = SegmentStore(directory)
+        Server.sealCold()
+        start = perf_counter()
+        for inner_hash in missing:
+            Server.isStored(inner_hash)
+        result['cold miss us'] = (perf_counter() - start) / len(missing) * 1e6
+        Server.enableFilters(COLD_OBJECTS)
+        start = perf_counter()
+        for inner_hash in missing:
+            Server.isStored(inner_hash)
+        result['cold miss with filter us'] = (perf_counter() - start) / len(missing) * 1e6
+        result['false positive rate %'] = Server.filters['inner'].falsePositiveRate() * 100
+        result['filter KiB'] = sum(len(bloom.counters) for bloom in Server.filters.values()) / 2 ** 10
+        Server.cold_store.close()
+        Server.cold_store = None
+    reset_server()
+    return result
+
+
+
+@report('server.rateLimits')
+def report_server_rate_limits() -> dict:
+
+    result = {}
+    reset_server()
+    count = 100000
+    inner_hashes = ['{:064x}'.format(i) for i in range(count)]
+    start = perf_counter()
+    for inner_hash in inner_hashes[:count // 10]:
+        Server.reserveIfAvailable(inner_hash, 'flooding_pha', 'flooding_device')
+    result['reserve us'] = (perf_counter() - start) / (count // 10) * 1e6
+    reset_server()
+    # A device that ignores the back-off hints and asks as fast as it can.
+    Server.enableRateLimits(10.0, 100.0, 5.0, 50.0)
+    refused = 0
+    start = perf_counter()
+    for inner_hash in inner_hashes:
+        try:
+            Server.reserveIfAvailable(inner_hash, 'flooding_pha', 'flooding_device')
+        except HDDORateLimitException:
+            refused += 1
+    elapsed = perf_counter() - start
+    result['rate limited reserve us'] = elapsed / count * 1e6
+    result['flood requests'] = count
+    result['flood refused'] = refused
+    result['flood reserved'] = len(Server.hddo_reserved)
+    # A well behaved client waits as long as the Server asks it to.
+    reset_server()
+    Server.enableRateLimits(1000.0, 10.0, 1000.0, 10.0)
+    client = App('polite_pha')
+    start = perf_counter()
+    for inner_hash in inner_hashes[:200]:
+        client.prepareTransmission(inner_hash)
+    result['polite 200 reservations ms'] = (perf_counter() - start) * 1e3
+    result['polite refused'] = Server.limiters['source'].limited + Server.limiters['pha'].limited
+    # Buckets of idle keys are forgotten, so memory follows the active keys.
+    clock = [0.0]
+    limiter = TokenBucketLimiter(5.0, 50.0, clock=lambda: clock[0])
+    for i in range(count):
+        clock[0] = i / count
+        limiter.acquire(i)
+    result['keys after {} sources'.format(count)] = len(limiter)
+    clock[0] += limiter.idle_seconds
+    limiter.acquire('active')
+    result['keys after idle'] = len(limiter)
+    Server.limiters = {}
+    reset_server()
+    return result
+
+
+
+@report('server.scriptCache')
+def report_server_script_cache() -> dict:
+
+    result = {}
+    reset_server()
+    count = 10000
+    for i in range(count):
+        hddo = HealthDominoDataObject(RawData('human_measure.weight.kg',
+                                              50.0 + (i % 2000) / 100,
+                                              TIMESTAMP + i))
+        hddo.addScript(['<SigKey>', str(i), 'HD_ADD', str(i)])
+        hddo.close()
+        hddo.reset_('', '{:064x}'.format(i), '')
+        Server.storeHDDO(hddo, '{:064x}'.format(i + count), b'0' * 64)
+    # Data processors broadcast to a few hot objects most of the time.
+    random = Random(count)
+    inner_hashes = ['{:064x}'.format(int(random.paretovariate(1.2)) % count) for _ in range(count)]
+    with TemporaryDirectory() as directory:
+        Server.cold_store = SegmentStore(directory)
+        Server.sealCold()
+        start = perf_counter()
+        for inner_hash in inner_hashes:
+            Server.sendBroadcast(inner_hash)
+        result['cold broadcast us'] = (perf_counter() - start) / count * 1e6
+        Server.enableScriptCache(64 * 2 ** 10)
+        start = perf_counter()
+        for inner_hash in inner_hashes:
+            Server.sendBroadcast(inner_hash)
+        result['cached broadcast us'] = (perf_counter() - start) / count * 1e6
+        result['hit rate %'] = Server.script_cache.hits / count * 100
+        result['cache KiB'] = Server.script_cache.size / 2 ** 10
+        result['cached scripts'] = len(Server.script_cache)
+        Server.cold_store.close()
+        Server.cold_store = None
+    Server.script_cache = None
+    reset_server()
+    return result
+
+
+
+@report('broadcast.fanout')
+def report_broadcast_fanout() -> dict:
+
+    result = {}
+    count = 100000
+    registry = BroadcastRegistry()
+    sig_keys = [Random(i).getrandbits(63) for i in range(count)]
+    start = perf_counter()
+    for sig_key in sig_keys:
+        registry.subscribe(sig_key, capacity=16)
+    result['subscribe us'] = (perf_counter() - start) / count * 1e6
+    scripts = [['<SigKey>', str(i), 'HD_ADD', str(sig_keys[i * 997 % count] + i)] for i in range(1000)]
+    start = perf_counter()
+    for i, script in enumerate(scripts):
+        registry.publish('{:064x}'.format(i), script)
+    result['publish to one us'] = (perf_counter() - start) / len(scripts) * 1e6
+    # The same broadcast found by evaluating the script for every subscriber.
+    start = perf_counter()
+    matches = [sig_key for sig_key in sig_keys if ScriptEngine.evaluate(scripts[0], sig_key)]
+    result['evaluate all subscribers ms'] = (perf_counter() - start) * 1e3
+    if len(matches) != 1:
+        raise AssertionError('Broadcast matched {} subscribers.'.format(len(matches)))
+    # A script without <SigKey> is satisfied by every key.
+    start = perf_counter()
+    published = registry.publish('{:064x}'.format(count), ['1', '0'])
+    result['publish to all ms'] = (perf_counter() - start) * 1e3
+    result['publish to all delivered'] = published['delivered']
+    start = perf_counter()
+    received = 0
+    for subscription_id in range(count):
+        received += len(registry.take(subscription_id, 64))
+    result['receive batches ms'] = (perf_counter() - start) * 1e3
+    result['received'] = received
+    return result
+
+
+
+@report('merkle.sync')
+def report_merkle_sync() -> dict:
+
+    result = {}
+    reset_server()
+    Server.enableMerkle()
+    for i in range(COLD_OBJECTS):
+        hddo = HealthDominoDataObject(RawData('human_measure.weight.kg',
+                                              50.0 + (i % 2000) / 100,
+                                              TIMESTAMP + i))
+        hddo.close()
+        hddo.reset_('', sha256(b'inner%d' % i).hexdigest(), '')
+        Server.storeHDDO(hddo, sha256(b'outer%d' % i).hexdigest(), b'0' * 64)
+    replica = MerkleReplica()
+    start = perf_counter()
+    sync_replicas(Server, replica)
+    result['initial sync seconds'] = perf_counter() - start
+    # Diverge by a few deletes on each side, like after a network partition.
+    for outer_hash in list(Server.hddo_outer.keys())[:10]:
+        Server.dropHDDO(outer_hash)
+    for outer_hash in list(replica.hddo_outer.keys())[-10:]:
+        replica.dropHDDO(outer_hash)
+    start = perf_counter()
+    key_diff = set(Server.hddo_outer.keys()) ^ set(replica.hddo_outer.keys())
+    result['full key comparison ms'] = (perf_counter() - start) * 1e3
+    start = perf_counter()
+    stats = sync_replicas(Server, replica)
+    result['merkle sync ms'] = (perf_counter() - start) * 1e3
+    result['divergent keys'] = len(key_diff)
+    result['divergent buckets'] = stats['buckets']
+    if not stats['consistent'] or stats['copied'] + stats['dropped'] != len(key_diff):
+        raise AssertionError('Replicas are not consistent after sync.')
+    reset_server()
+    return result
+
+
+
+class LossyClient(object):
+
+
+
+    def __init__(self, loss_every: int):
+
+        self.calls = 0
+        self.loss_every = loss_every
+
+
+
+    def prepareTransmission(self, inner_hash: str):
+
+        return App.prepareTransmission(inner_hash)
+
+
+
+    def transmitHDDO(self, hddo, transmission_id):
+
+        self.calls += 1
+        result = App.transmitHDDO(hddo, transmission_id)
+        if self.calls % self.loss_every == 0:
+            raise ConnectionError('Reply lost.')
+        return result
+
+
+
+@report('outbox.drain')
+def report_outbox_drain() -> dict:
+
+    result = {}
+    reset_server()
+    count = 2000
+    with TemporaryDirectory() as directory:
+        outbox = Outbox(directory, b'0' * 32)
+        start = perf_counter()
+        for i, hddo in enumerate(build_hddos(count)):
+            outbox.put(hddo, i % 3, TIMESTAMP + i)
+        result['put us'] = (perf_counter() - start) / count * 1e6
+        client = LossyClient(10)
+        delivered = []
+        start = perf_counter()
+        while len(outbox) > 0:
+            delivered.extend(outbox.drain(client))
+            outbox.retry_at = 0.0
+        result['drain us'] = (perf_counter() - start) / count * 1e6
+        result['lost replies'] = client.calls // client.loss_every
+        result['stored objects'] = len(Server.hddo_inner)
+        if len(Server.hddo_inner) != count or len(delivered) != count:
+            raise AssertionError('Outbox stored objects twice or lost them.')
+    reset_server()
+    return result
+
+
+
+@benchmark('script.evaluate', [1000, 10000, 100000])
+def bench_script_evaluate(size: int):
+
+    sig_key = 123456789
+    scripts = [['<SigKey>', str(i), 'HD_ADD', str(sig_key + i)] for i in range(size)]
+
+    def run():
+        for script in scripts:
+            ScriptEngine.evaluate(script, sig_key)
+
+    yield run
+
+
+
+@benchmark('server.deleteHDDO', [100, 1000, 10000])
+def bench_delete(size: int):
+
+    App.registerUser()
+    requests = []
+
+    def prepare():
+        reset_server()
+        requests.clear()
+        for hddo in build_hddos(size):
+            hddo.transmit()
+            requests.append((HealthDominoDataObject.toSendable(hddo), hddo.hashBase))
+
+    def run():
+        for sendable, hash_base in requests:
+            Server.deleteHDDO(sendable, hash_base)
+
+    yield prepare, run
+    reset_server()
+
+
+
+@benchmark('vault.delete', [100, 1000, 10000])
+def bench_vault_delete(size: int):
+
+    App.registerUser()
+    with TemporaryDirectory() as directory:
+        vault = Vault(join(directory, 'vault.bin'), b'0' * 32)
+
+        def prepare():
+            reset_server()
+            hddos = build_hddos(size)
+            for hddo in hddos:
+                hddo.transmit()
+            vault.put(hddos)
+
+        def run():
+            vault.delete('human_measure.weight')
+
+        yield prepare, run
+    reset_server()
+
+
+
+def pipeline_benchmark(payload_size: int, workers: int, use_processes: bool):
+
+    def bench(size: int):
+
+        hddos = []
+
+        def prepare():
+            hddos.clear()
+            for i in range(size):
+                hddo = HealthDominoDataObject(RawData('human_measure.scan.raw',
+                                                      '{:08d}'.format(i) * (payload_size // 8),
+                                                      TIMESTAMP + i))
+                hddo.close()
+                hddos.append(hddo)
+
+        def run():
+            prepare_batch(hddos, workers, use_processes)
+
+        yield prepare, run
+
+    return bench
+
+
+
+# Small payloads are like a single weight reading, large ones like an encoded
+# ECG strip.
+for payload_name, payload_size in (('small', 8), ('large', 65536)):
+    for pool_name, use_processes in (('threads', False), ('processes', True)):
+        for workers in (1, 4, 16):
+            if use_processes and workers == 1:
+                continue
+            benchmark('pipeline.{}.{}.{}'.format(payload_name, pool_name, workers),
+                      [1000])(pipeline_benchmark(payload_size, workers, use_processes))
+
+
+
+@report('pipeline.deduplicate')
+def report_pipeline_deduplicate() -> dict:
+
+    # A scale that uploads every reading twice, e.g. after a lost connection.
+    result = {}
+    reset_server()
+    App.registerUser()
+    count = 2000
+    hddos = build_hddos(count // 2) + build_hddos(count // 2)
+    start = perf_counter()
+    firsts = deduplicate(hddos)
+    result['digest us'] = (perf_counter() - start) / count * 1e6
+    result['duplicates'] = sum(1 for index, first in enumerate(firsts) if first != index)
+    client = LossyClient(count + 1)
+    start = perf_counter()
+    transmit_batch(build_hddos(count // 2) + build_hddos(count // 2), client, workers=1)
+    result['transmit us'] = (perf_counter() - start) / count * 1e6
+    result['transmissions'] = client.calls
+    reset_server()
+    App.registerUser()
+    client = LossyClient(count + 1)
+    start = perf_counter()
+    transmit_batch(build_hddos(count), client, workers=1)
+    result['distinct transmit us'] = (perf_counter() - start) / count * 1e6
+    result['distinct transmissions'] = client.calls
+    reset_server()
+    return result
+
+
+
+@benchmark('app.encryptForUser', [10, 100])
+def bench_encrypt(size: int):
+
+    App.registerUser()
+    contents = ['human_measure.weight.kg {}'.format(60.0 + i) for i in range(size)]
+
+    def run():
+        for content in contents:
+            App.encryptForUser(content)
+
+    yield run
+
+
+
+@benchmark('app.gateway', [1000, 10000])
+def bench_gateway(size: int):
+
+    default = App.defaultClient()
+    default.registerUser()
+    cache = AppCache(max_clients=256)
+    phas = ['{:064x}'.format(i) for i in range(size // 4)]
+    hddos = []
+
+    def loader(pha):
+        return App(pha, default.user_private_key, default.user_public_key)
+
+    cache.loader = loader
+
+    def prepare():
+        reset_server()
+        hddos.clear()
+        hddos.extend(build_hddos(size))
+
+    def run():
+        for i, hddo in enumerate(hddos):
+            hddo.transmit(cache.get(phas[i % len(phas)]))
+
+    yield prepare, run
+    reset_server()
+
+
+
+@benchmark('lifecycle', [1000])
+def bench_lifecycle(size: int):
+
+    App.registerUser()
+    yield lambda: lifecycle(size)
+    reset_server()
+
+
+
+@benchmark('lifecycle.logging', [1000])
+def bench_lifecycle_logging(size: int):
+
+    App.registerUser()
+    with open(devnull, 'w') as stream:
+        LogManager.start(stream=stream)
+        yield lambda: lifecycle(size)
+        LogManager.stop()
+    reset_server()
+
+
+
+@benchmark('lifecycle.metrics', [1000])
+def bench_lifecycle_metrics(size: int):
+
+    App.registerUser()
+    recorder = MetricsRecorder()
+    Metrics.register(recorder)
+    yield lambda: lifecycle(size)
+    Metrics.unregister(recorder)
+    reset_server()
+
+
+
+def measure(prepare, run, repeat: int) -> dict:
+
+    best = None
+    for _ in range(repeat):
+        prepare()
+        start = perf_counter()
+        run()
+        elapsed = perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    prepare()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds' : best, 'peak_bytes' : peak}
+
+
+
+def run_benchmark(name: str, size: int, repeat: int) -> dict:
+
+    function, _ = BENCHMARKS[name]
+    steps = function(size)
+    step = next(steps)
+    if isinstance(step, tuple):
+        prepare, run = step
+    else:
+        prepare, run = lambda: None, step
+    try:
+        return measure(prepare, run, repeat)
+    finally:
+        next(steps, None)
+
+
+
+def measure_import(module: str, repeat: int) -> dict:
+
+    best = None
+    for _ in range(repeat):
+        process = run_process([executable, '-X', 'importtime', '-c',
+                               'import {}'.format(module)],
+                              capture_output=True, text=True,
+                              cwd=dirname(__file__) or '.')
+        for line in process.stderr.splitlines():
+            fields = [field.strip() for field in line.split('|')]
+            if len(fields) == 3 and fields[2] == module:
+                elapsed = int(fields[1]) / 1e6
+                if best is None or elapsed < best:
+                    best = elapsed
+    return {'seconds' : best, 'peak_bytes' : 0, 'size' : 1}
+
+
+
+def run_all(names: list, quick: bool=False, repeat: int=3) -> dict:
+
+    results = {}
+    for module in IMPORTS:
+        key = 'import.{}'.format(module)
+        if len(names) > 0 and not any(key.startswith(prefix) for prefix in names):
+            continue
+        results[key] = measure_import(module, repeat)
+        print_result(key, results[key])
+    for name, function in REPORTS.items():
+        if len(names) > 0 and not any(name.startswith(prefix) for prefix in names):
+            continue
+        for key, value in function().items():
+            print('{:<56} {:10.3f}'.format('{}: {}'.format(name, key), value))
+    for name, (_, sizes) in BENCHMARKS.items():
+        if len(names) > 0 and not any(name.startswith(prefix) for prefix in names):
+            continue
+        for size in sizes[:1] if quick else sizes:
+            key = '{}[{}]'.format(name, size)
+            results[key] = run_benchmark(name, size, repeat)
+            results[key]['size'] = size
+            print_result(key, results[key])
+    return results
+
+
+
+def print_result(key: str, result: dict, baseline: dict=None):
+
+    line = '{:<32} {:10.4f} s {:10.2f} us/item {:10.1f} KiB'.format(key,
+                result['seconds'], result['seconds'] / result['size'] * 1e6,
+                result['peak_bytes'] / 1024)
+    if baseline is not None:
+        line += ' {:+7.1f}%'.format((result['seconds'] / baseline['seconds'] - 1) * 100)
+    print(line)
+
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+
+    regressions = []
+    missing = []
+    print('\nComparison with baseline (tolerance {:.0f}%):'.format(tolerance * 100))
+    for key, result in results.items():
+        if key not in baseline:
+            print_result(key, result)
+            missing.append(key)
+        else:
+            print_result(key, result, baseline[key])
+            if result['seconds'] > baseline[key]['seconds'] * (1 + tolerance):
+                regressions.append(key)
+    for key in regressions:
+        print('REGRESSION: {}'.format(key))
+    # A benchmark without baseline can't be checked, that is a failure too.
+    for key in missing:
+        print('MISSING BASELINE: {}'.format(key))
+    return regressions + missing
+
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='HealthDomino benchmarks')
+    parser.add_argument('names', nargs='*', help='benchmark name prefixes to run')
+    parser.add_argument('--quick', action='store_true', help='run the smallest sizes only')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per benchmark')
+    parser.add_argument('--save', action='store_true', help='store results as baseline')
+    parser.add_argument('--compare', action='store_true', help='compare results with baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown ratio')
+    args = parser.parse_args()
+    results = run_all(args.names, args.quick, args.repeat)
+    exit_code = 0
+    if args.compare:
+        with open(BASELINE_PATH, 'r') as in_file:
+            if len(compare(results, json.load(in_file), args.tolerance)) > 0:
+                exit_code = 1
+    if args.save:
+        try:
+            with open(BASELINE_PATH, 'r') as in_file:
+                baseline = json.load(in_file)
+        except FileNotFoundError:
+            baseline = {}
+        baseline.update(results)
+        with open(BASELINE_PATH, 'w') as out_file:
+            json.dump(baseline, out_file, indent=2, sort_keys=True)
+    exit(exit_code)
@@ -25,9 +25,13 @@ of a real-world workflow.
 from copy import deepcopy
 from hddo import HealthDominoDataObject, RawData
 from mock_app import App
-from mock_other import get_readable_time, now, ScriptEngine
+from mock_other import get_readable_time, LogManager, now, ScriptEngine
 from mock_server import Server
+from mock_vault import Vault
+from os import urandom
+from os.path import join
 from random import choice, randrange, uniform
+from tempfile import TemporaryDirectory
 
 
 # The ultimate first step of a process is to start the imagined application and
@@ -44,6 +48,12 @@ from random import choice, randrange, uniform
 
 
 
+# App and Server are silent by default. To follow the workflow, let's route
+# their log records to the console in the order they occur.
+LogManager.start(asynchronous=False)
+
+
+
 # For all cases let's ganerate a Personal Health Address for our user
 # The print messages demonstrate a potential use-case where the generation
 # of keys is gamified by stroking a rabbit.
@@ -127,7 +137,7 @@ print('###############\n\n')
 # To enabel broadcast compatibility, every HealthDominoDataObject will have a
 # custom script based on the user's private key. This way of scripting is not
 # secure at all but can demonstrate how broadcasts work.
-sig_key = hash(App.user_private_key)
+sig_key = hash(App.getUserPrivateKey())
 script_template = ['<SigKey>', '0', 'HD_ADD', '0']
 hddo_container = []
 for i in range(randrange(30, 40)):
@@ -143,6 +153,10 @@ for i in range(randrange(30, 40)):
 
 
 
+# The App subscribes to the broadcasts its signature key satisfies once, instead
+# of asking the Server again and again.
+App.subscribeBroadcasts()
+
 # Since user applications usually doesn't initiate broadcasts let's connect the
 # Server directly and initiate one. Before doing this let's choice a datapoint.
 test_inner_hash = choice(list(Server.hddo_inner.keys()))
@@ -150,6 +164,30 @@ test_inner_hash = choice(list(Server.hddo_inner.keys()))
 # With the innerHash we can initiate the broadcast.
 test_script = Server.sendBroadcast(test_inner_hash)
 
-# In this example we can easily find the concerned datapoint but in a real-world
-# solution only the owner of the right signature key can accept the connection
-# request.
+# The Server pushed the broadcast to the owner of the right signature key only,
+# so the App finds the concerned datapoint without evaluating any script.
+for inner_hash, script in App.receiveBroadcasts():
+    print('[App][Log] Broadcast received for innerHash {}.'.format(inner_hash))
+
+
+
+###############
+# SCENARIO 3. #
+###############
+print('\n\n###############')
+print('# SCENARIO 3. #')
+print('###############\n\n')
+
+
+
+# Only the owner of the hashBase can delete a HealthDominoDataObject. Instead
+# of keeping every object in memory for years, the application keeps the
+# hashBase of the transmitted objects in an encrypted vault on the device.
+with TemporaryDirectory() as vault_directory:
+    vault = Vault(join(vault_directory, 'vault.bin'), urandom(32))
+    vault.put(hddo_container)
+    print('[App][Log] {} hashBase stored in the vault.'.format(len(vault)))
+
+    # Now "delete all my weight readings" is a single request to the Server.
+    deleted = vault.delete('human_measure.weight')
+    print('[App][Log] {} weight readings deleted.'.format(deleted))
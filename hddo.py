@@ -20,12 +20,16 @@ THIS FILE
 ---------
 This file contains the two most important objects; HealthDominoDataObject
 and RawData.
+
+The mock application (and with it PyCryptodome and the mock server) is
+imported on first use only, so RawData can be used without those
+dependencies.
 """
 from base64 import b64encode
 from copy import deepcopy
-from hashlib import sha256
+from hashlib import blake2b, sha256
 import json
-from mock_app import App
+from mock_metrics import Metrics, timed
 from mock_other import ScriptEngine
 from os import urandom
 from time import localtime, strftime, time
@@ -40,6 +44,12 @@ class RawData(object):
 
 
     DEFAULT_TIMESTAMP = 0
+    # Attribute name -> serialized field name, name mangling removed, of value
+    # types that are not JSON serializable, see encodeValue().
+    FIELD_NAMES = {}
+    # toJSON() starts every RawData object with this, so the decoder finds
+    # nested RawData without parsing the object first.
+    JSON_PREFIX = '{"object_type": "RawData", '
     LABELING_0 = 0
 
 
@@ -110,11 +120,113 @@ class RawData(object):
             self.__timestamp = int(time())
         else:
             self.__timestamp = timestamp
+        # JSON text of a value that is not decoded yet, see fromJSON(lazy=True).
+        self.__raw_value = None
+        self.__is_decoded = True
+
+
+
+    @classmethod
+    def decodeJSON(cls, json_string: str) -> any:
+        """
+        Decodes a JSON string with RawData objects of any nesting depth
+        ===============================================================
+
+        Parameters
+        ----------
+        json_string : str
+            A string created by .toJSON() or the JSON text of a value.
+
+        Returns
+        -------
+        any
+            RawData if the string is a RawData object, the decoded value
+            otherwise.
+
+        Throws
+        ------
+        json.decoder.JSONDecodeError
+            If the string is not valid JSON.
+        HDDOInitException
+            If a RawData object of the string is invalid.
+
+        See also
+        --------
+            Documentation of the classmethod .scanJSON().
+
+        Notes
+        -----
+            RawData objects nested in the value of each other are restored in
+            a loop instead of recursion. If the nesting is too deep for the
+            json module, the string is decoded by .scanJSON().
+        """
+
+        try:
+            content = json.loads(json_string)
+        except RecursionError:
+            return RawData.scanJSON(json_string)
+        chain = []
+        while isinstance(content, dict) and content.get('object_type') == 'RawData' and 'value' in content:
+            chain.append(content)
+            content = content['value']
+        for item in reversed(chain):
+            item['value'] = content
+            content = RawData.fromJSON(item)
+        return content
 
 
 
     @classmethod
-    def fromJSON(cls, json_string: str): # -> RawData is not written here due to Python 3.7 compatibility.
+    def encodeValue(cls, value: any) -> str:
+        """
+        Encodes a value that is not RawData to JSON
+        ===========================================
+
+        Parameters
+        ----------
+        value : any
+            The value to encode.
+
+        Returns
+        -------
+        str
+            The JSON text of the value. Objects that are not JSON serializable
+            are written with their object_type and attributes.
+
+        Throws
+        ------
+        TypeError
+            If the value is neither JSON serializable nor has attributes.
+
+        Notes
+        -----
+            The attributes are read from every value itself, since instances
+            of a type may differ. The field name of every attribute name is
+            computed once per type and kept in FIELD_NAMES.
+        """
+
+        try:
+            return json.dumps(value)
+        except (TypeError, OverflowError):
+            pass
+        value_type = type(value)
+        field_names = RawData.FIELD_NAMES.get(value_type)
+        if field_names is None:
+            field_names = {}
+            RawData.FIELD_NAMES[value_type] = field_names
+        content = {'object_type' : value_type.__name__}
+        for key, data in vars(value).items():
+            name = field_names.get(key)
+            if name is None:
+                name = key.replace('_{}'.format(value_type.__name__), '')
+                field_names[key] = name
+            content[name] = data
+        return json.dumps(content)
+
+
+
+    @classmethod
+    def fromJSON(cls, json_string: str, lazy: bool=False): # -> RawData is not written here due to Python 3.7 compatibility.
         """
         Retrieves RawData object from JSON string
         =========================================
@@ -122,7 +234,13 @@ class RawData(object):
         Parameters
         ----------
         json_string : str
-            A string to transform to a RawData object.
+            A string to transform to a RawData object. An already deserialized
+            dict is also accepted, that's how nested RawData values are
+            restored.
+        lazy : bool, optional (False if omitted)
+            If True, the value is kept as JSON text and decoded on the first
+            access of .value only. The label, timestamp and version are
+            validated immediately.
 
         Returns
         -------
@@ -168,12 +286,23 @@ class RawData(object):
         III.
             A data is considered unsupported only in case if it is deserialized
             as dict and has an object_type key.
+        IV.
+            A lazy object of an invalid value raises HDDOInitException on the
+            first access of .value instead of here.
         """
 
+        raw_value = None
         try:
-            content = json.loads(json_string)
+            if isinstance(json_string, dict):
+                content = json_string
+            elif lazy:
+                content, raw_value = RawData.splitJSON(json_string)
+            else:
+                content = RawData.decodeJSON(json_string)
         except json.decoder.JSONDecodeError:
             raise HDDOInitException('Given parameter doesn\'t seem to be a JSON string.')
+        if isinstance(content, RawData):
+            return content
         if isinstance(content, dict):
             if 'object_type' in content.keys():
                 if content['object_type'] == 'RawData':
@@ -197,7 +326,12 @@ class RawData(object):
                                 content['value'] = RawData.fromJSON(content['value'])
                             else:
                                 raise HDDOInitException('RawData value contains unsupported object.')
-                    return RawData(content['label'], content['value'], content['timestamp'], content['version'])
+                    result = RawData(content['label'], content['value'], content['timestamp'], content['version'])
+                    if raw_value is not None:
+                        result.__raw_value = raw_value
+                        result.__value = None
+                        result.__is_decoded = False
+                    return result
                 else:
                     raise HDDOInitException('Given JSON string doesn\'t seem to contain RawData object.')
             else:
@@ -207,6 +341,65 @@ class RawData(object):
 
 
 
+    def iterStr(self, chunk_size: int=65536):
+        """
+        Gets the content of the object in human readable form piece by piece
+        ====================================================================
+
+        Parameters
+        ----------
+        chunk_size : int, optional (65536 if omitted)
+            The maximal length of a piece of a str or bytes-like value.
+
+        Yields
+        ------
+        str
+            Pieces of the same string that str() returns.
+
+        Notes
+        -----
+            Large str, bytes, bytearray or memoryview values are never copied
+            as a whole, so hashing a multi-megabyte value needs constant extra
+            memory.
+        """
+
+        value = self
+        # Nested RawData is written header by header, without recursion.
+        while isinstance(value, RawData):
+            yield 'RawData obect version {}\n- {:>5} : {}\n- {:>5} : {}\n- {:>5} : '.format(value.version,
+                                                                                             'Time',
+                                                                                             strftime('%m/%d/%Y %H:%M:%S', localtime(value.timestamp)),
+                                                                                             'Label',
+                                                                                             value.label,
+                                                                                             'Value')
+            value = value.value
+        if isinstance(value, str):
+            for start in range(0, len(value), chunk_size):
+                yield value[start:start + chunk_size]
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            view = memoryview(value).cast('B')
+            # The same quote is chosen as repr() does for the whole value.
+            has_single, has_double = False, False
+            for start in range(0, len(view), chunk_size):
+                piece = bytes(view[start:start + chunk_size])
+                has_single = has_single or b"'" in piece
+                has_double = has_double or b'"' in piece
+            quote = '"' if has_single and not has_double else "'"
+            yield 'bytearray(b' + quote if isinstance(value, bytearray) else 'b' + quote
+            for start in range(0, len(view), chunk_size):
+                piece = repr(bytes(view[start:start + chunk_size]))
+                # bytearray escapes every single quote, bytes only inside
+                # single quotes.
+                if piece[1] == '"' and (quote == "'" or isinstance(value, bytearray)):
+                    yield piece[2:-1].replace("'", "\\'")
+                else:
+                    yield piece[2:-1]
+            yield quote + ')' if isinstance(value, bytearray) else quote
+        else:
+            yield str(value)
+
+
+
     @property
     def label(self) -> str:
         """
@@ -223,6 +416,204 @@ class RawData(object):
 
 
 
+    def peekValue(self) -> str:
+        """
+        Tells the kind of the value without decoding it
+        ===============================================
+
+        Returns
+        -------
+        str
+            'number' if the value is a number, 'nested' if it is or may contain
+            RawData, 'other' in every other case.
+
+        Notes
+        -----
+            A lazy value is judged from its JSON text, so indexes can skip the
+            values they don't need without decoding them.
+        """
+
+        if self.__is_decoded:
+            value = self.__value
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return 'number'
+            if isinstance(value, (RawData, list, tuple)):
+                return 'nested'
+            return 'other'
+        raw_value = self.__raw_value
+        if raw_value.startswith(RawData.JSON_PREFIX):
+            return 'nested'
+        if raw_value.startswith('['):
+            # A list is nested only if a RawData object is written in it.
+            return 'nested' if RawData.JSON_PREFIX[1:-2] in raw_value else 'other'
+        if raw_value[0] in '-0123456789':
+            return 'number'
+        return 'other'
+
+
+
+    @classmethod
+    def scanJSON(cls, json_string: str) -> any:
+        """
+        Decodes a JSON string with an explicit stack of RawData objects
+        ===============================================================
+
+        Parameters
+        ----------
+        json_string : str
+            A string created by .toJSON() or the JSON text of a value.
+
+        Returns
+        -------
+        any
+            RawData if the string is a RawData object, the decoded value
+            otherwise.
+
+        Throws
+        ------
+        json.decoder.JSONDecodeError
+            If the string is not valid JSON.
+        HDDOInitException
+            If a RawData object of the string is invalid.
+
+        Notes
+        -----
+            Every RawData object that starts like .toJSON() writes it is a
+            frame of the stack, so the nesting depth is not limited by the
+            recursion limit of Python. Other values are decoded by the json
+            module.
+        """
+
+        decoder = json.JSONDecoder()
+        # Every frame is a RawData object being decoded: [content, key].
+        frames = []
+        position = RawData.skipSpace(json_string, 0)
+        while True:
+            if json_string.startswith(RawData.JSON_PREFIX, position):
+                frames.append([{}, None])
+                position += 1
+            else:
+                value, position = decoder.raw_decode(json_string, position)
+                while True:
+                    position = RawData.skipSpace(json_string, position)
+                    if len(frames) == 0:
+                        if position != len(json_string):
+                            raise json.decoder.JSONDecodeError('Extra data', json_string, position)
+                        return value
+                    content, key = frames[-1]
+                    content[key] = value
+                    if json_string[position:position + 1] != '}':
+                        break
+                    position += 1
+                    frames.pop()
+                    value = RawData.fromJSON(content)
+                if json_string[position:position + 1] != ',':
+                    raise json.decoder.JSONDecodeError('Expecting \',\' delimiter', json_string, position)
+                position += 1
+            position = RawData.skipSpace(json_string, position)
+            key, position = decoder.raw_decode(json_string, position)
+            if not isinstance(key, str):
+                raise json.decoder.JSONDecodeError('Expecting property name enclosed in double quotes',
+                                                   json_string, position)
+            position = RawData.skipSpace(json_string, position)
+            if json_string[position:position + 1] != ':':
+                raise json.decoder.JSONDecodeError('Expecting \':\' delimiter', json_string, position)
+            frames[-1][1] = key
+            position = RawData.skipSpace(json_string, position + 1)
+
+
+
+    @classmethod
+    def splitJSON(cls, json_string: str) -> tuple:
+        """
+        Parses a RawData JSON string except its value
+        =============================================
+
+        Parameters
+        ----------
+        json_string : str
+            A string created by .toJSON().
+
+        Returns
+        -------
+        tuple(dict, str)
+            The parsed keys with None as value, and the JSON text of the
+            value. If the value is not the last key or it is nested too deep,
+            the whole string is parsed and the JSON text is None.
+
+        Throws
+        ------
+        json.decoder.JSONDecodeError
+            If the string is not a JSON object, the value is not valid JSON or
+            anything but whitespace follows the object.
+        """
+
+        decoder = json.JSONDecoder()
+        content = {}
+        position = RawData.skipSpace(json_string, 0)
+        if json_string[position:position + 1] != '{':
+            return json.loads(json_string), None
+        position += 1
+        while True:
+            position = RawData.skipSpace(json_string, position)
+            key, position = decoder.raw_decode(json_string, position)
+            position = RawData.skipSpace(json_string, position)
+            if json_string[position:position + 1] != ':':
+                raise json.decoder.JSONDecodeError('Expecting \':\' delimiter', json_string, position)
+            position = RawData.skipSpace(json_string, position + 1)
+            if key == 'value' and len(content) == 4:
+                # toJSON() writes the value last. It is decoded once to find
+                # its end and to reject what the eager path rejects, only its
+                # text is kept.
+                try:
+                    value, end = decoder.raw_decode(json_string, position)
+                except RecursionError:
+                    return RawData.decodeJSON(json_string), None
+                rest = RawData.skipSpace(json_string, end)
+                if json_string[rest:rest + 1] != '}' or RawData.skipSpace(json_string, rest + 1) != len(json_string):
+                    raise json.decoder.JSONDecodeError('Extra data', json_string, rest)
+                # Nested RawData is validated by fromJSON() as well.
+                if isinstance(value, dict) and 'object_type' in value.keys():
+                    content['value'] = value
+                else:
+                    content['value'] = None
+                return content, json_string[position:end]
+            if key == 'value':
+                return json.loads(json_string), None
+            content[key], position = decoder.raw_decode(json_string, position)
+            position = RawData.skipSpace(json_string, position)
+            if json_string[position:position + 1] == ',':
+                position += 1
+            else:
+                return json.loads(json_string), None
+
+
+
+    @classmethod
+    def skipSpace(cls, json_string: str, position: int) -> int:
+        """
+        Skips JSON whitespace
+        =====================
+
+        Parameters
+        ----------
+        json_string : str
+            The string to read.
+        position : int
+            The position to start at.
+
+        Returns
+        -------
+        int
+            The position of the first non-whitespace character.
+        """
+
+        while position < len(json_string) and json_string[position] in ' \t\n\r':
+            position += 1
+        return position
+
+
+
     @property
     def timestamp(self) -> int:
         """
@@ -266,24 +657,26 @@ class RawData(object):
             approach. In production ready or future releases this part might
             be solved on a totally different way.
         """
-        try:
-            _ = json.dumps(self.value)
-            value = self.value
-        except (TypeError, OverflowError):
-            value = {}
-            value['object_type'] = self.value.__class__.__name__
-            if isinstance(self.value, RawData):
-                type_str = '_{}__'.format(value['object_type'])
-                for key, data in self.value.__dict__.items():
-                    value[key.replace(type_str, '')] = data
-            else:
-                type_str = '_{}'.format(value['object_type'])
-                for key, data in self.value.__dict__.items():
-                    value[key.replace(type_str, '')] = data
-
-        return json.dumps({'object_type' : 'RawData', 'version' : self.version,
-                           'timestamp' : self.timestamp, 'label' : self.label,
-                           'value' : value})
+        # Nested RawData is written with an explicit list of prefixes and
+        # suffixes instead of recursion, so its depth is not limited.
+        header = json.dumps({'object_type' : 'RawData', 'version' : self.version,
+                             'timestamp' : self.timestamp, 'label' : self.label})
+        prefixes = ['{}, "value": '.format(header[:-1])]
+        suffixes = ['}']
+        node = self
+        while node.__raw_value is None and isinstance(node.value, RawData):
+            node = node.value
+            prefixes.append('{}"label": {}, "version": {}, "value": '.format(RawData.JSON_PREFIX,
+                                                                             json.dumps(node.label),
+                                                                             json.dumps(node.version)))
+            suffixes.append(', "timestamp": {}}}'.format(json.dumps(node.timestamp)))
+        if node.__raw_value is not None:
+            # The value is written as it was read, without decoding it.
+            prefixes.append(node.__raw_value)
+        else:
+            prefixes.append(RawData.encodeValue(node.value))
+        prefixes.extend(reversed(suffixes))
+        return ''.join(prefixes)
 
 
 
@@ -297,8 +690,25 @@ class RawData(object):
         -------
         any
             The value of the RawData object.
+
+        Throws
+        ------
+        HDDOInitException
+            If the value of a lazy object turns out to be invalid.
         """
 
+        if not self.__is_decoded:
+            try:
+                value = RawData.decodeJSON(self.__raw_value)
+            except json.decoder.JSONDecodeError:
+                raise HDDOInitException('RawData value is not valid JSON.')
+            if isinstance(value, dict) and 'object_type' in value.keys():
+                if value['object_type'] == 'RawData':
+                    value = RawData.fromJSON(value)
+                else:
+                    raise HDDOInitException('RawData value contains unsupported object.')
+            self.__value = value
+            self.__is_decoded = True
         return self.__value
 
 
@@ -416,7 +826,7 @@ class RawData(object):
                                                                                              'Label',
                                                                                              self.label,
                                                                                              'Value',
-                                                                                             self.value)
+                                                                                             self.value.tobytes() if isinstance(self.value, memoryview) else self.value)
 
 
 
@@ -428,6 +838,8 @@ class HealthDominoDataObject(object):
 
 
     VERSION_0 = 0
+    # innerHash and outerHash are BLAKE2b instead of SHA-256 from VERSION_1.
+    VERSION_1 = 1
 
 
 
@@ -442,7 +854,9 @@ class HealthDominoDataObject(object):
         data : RawData
             RawData to store or transmit with this object.
         HDDO_version : int, optional (0 if omitted)
-            The version identifier of the HealthDominoDataObject
+            The version identifier of the HealthDominoDataObject. The version
+            also selects the hash function of innerHash and outerHash, see
+            newHash().
         compatibility_limit : int, optional (0 if omitted)
             The version identifier to restrict backward compatibility of a
             HealthDominoDataObject. This will be useful in future releases when
@@ -472,10 +886,12 @@ class HealthDominoDataObject(object):
         self.__inner_hash = ''
         self.__is_transmitted = False
         self.__outer_hash = ''
+        # Digest of the closed content, see contentDigest.
+        self.__content_digest = ''
 
 
 
-    def addInfo(label: str, value: str):
+    def addInfo(self, label: str, value: str):
         """
         Adds a new element to the identity informations
         ===============================================
@@ -535,11 +951,17 @@ class HealthDominoDataObject(object):
 
 
 
-    def addPHA(self):
+    def addPHA(self, client=None): # App is not written here to keep mock_app lazily imported.
         """
         Adds the user's Personal Health Address to the object
         =====================================================
 
+        Parameters
+        ----------
+        client : App, optional (None if omitted)
+            The App client of the user whose Personal Health Address to add.
+            If it's omitted, the default App client is used.
+
         Throws
         ------
         HDDOPermissionException
@@ -551,7 +973,9 @@ class HealthDominoDataObject(object):
 
         if not self.isClosed:
             if self.__pha == '':
-                self.__pha = App.getUserPHA()
+                if client is None:
+                    from mock_app import App as client
+                self.__pha = client.getUserPHA()
             else:
                 raise HDDOPermissionException('Tried to add Personal Health Address twice to a closed HealthDominoDataObject.')
         else:
@@ -612,6 +1036,7 @@ class HealthDominoDataObject(object):
 
 
 
+    @timed('hddo.close')
     def close(self):
         """
         Closes the object
@@ -646,6 +1071,70 @@ class HealthDominoDataObject(object):
 
 
 
+    @property
+    def contentDigest(self) -> str:
+        """
+        Gets the digest of the content of the closed object
+        ===================================================
+
+        Returns
+        -------
+        str
+            The hexadecimal digest of the hashable content without hashBase.
+
+        Throws
+        ------
+        HDDOPermissionException
+            If the object is not yet closed.
+
+        Notes
+        -----
+        I.
+            A closed object can't be modified, so the digest is computed once
+            on first use and cached. It isn't computed by close() itself,
+            since toSendable() and restored objects are closed as well and
+            would decode lazy RawData values for nothing.
+        II.
+            Two objects of the same digest are byte-identical readings, see
+            __eq__().
+        """
+
+        if not self.isClosed:
+            raise HDDOPermissionException('Tried to get the content digest of a non-closed HealthDominoDataObject.')
+        if self.__content_digest == '':
+            self.__content_digest = self.computeHash('')
+        return self.__content_digest
+
+
+
+    def computeHash(self, hash_base: str=None, suffix: bytes=b'') -> str:
+        """
+        Computes the hash of the object without building its hashable string
+        ====================================================================
+
+        Parameters
+        ----------
+        hash_base : str, optional (None if omitted)
+            The hashBase to hash with. If it's omitted, the hashBase of the
+            object is used.
+        suffix : bytes, optional (b'' if omitted)
+            Bytes to hash after the content, like the nounce of outerHash.
+
+        Returns
+        -------
+        str
+            The hexadecimal digest, the same as the digest of
+            toHashable() + suffix if hash_base is omitted.
+        """
+
+        hasher = HealthDominoDataObject.newHash(self.version)
+        for chunk in self.iterHashable(hash_base):
+            hasher.update(chunk)
+        hasher.update(suffix)
+        return hasher.hexdigest()
+
+
+
     @property
     def data(self) -> RawData:
         """
@@ -662,7 +1151,7 @@ class HealthDominoDataObject(object):
 
 
 
-    def delInfo(label: str):
+    def delInfo(self, label: str):
         """
         Deletes an existing element from the identity informations
         ==========================================================
@@ -877,6 +1366,43 @@ class HealthDominoDataObject(object):
 
 
 
+    def iterHashable(self, hash_base: str=None, chunk_size: int=65536):
+        """
+        Gets the hashable content of the object piece by piece
+        ======================================================
+
+        Parameters
+        ----------
+        hash_base : str, optional (None if omitted)
+            The hashBase to start with. If it's omitted, the hashBase of the
+            object is used.
+        chunk_size : int, optional (65536 if omitted)
+            The maximal length of a piece of a large RawData value.
+
+        Yields
+        ------
+        bytes
+            Pieces of the same bytes that toHashable() returns.
+        """
+
+        yield (self.hashBase if hash_base is None else hash_base).encode('utf-8')
+        for chunk in self.data.iterStr(chunk_size):
+            yield chunk.encode('utf-8')
+        self_repr = '{}{}'.format(self.version, self.compatibilityLimit)
+        if len(self.script) > 0:
+            self_repr += ' '.join(self.script)
+        if self.seriesSignature != '':
+            self_repr += self.seriesSignature
+        if self.pha != '':
+            self_repr += self.pha
+        for key, value in self.identityInfo.items():
+            self_repr += '{}{}'.format(key, value)
+        if self.message != '':
+            self_repr += self.message
+        yield self_repr.encode('utf-8')
+
+
+
     @property
     def message(self) -> str:
         """
@@ -894,6 +1420,44 @@ class HealthDominoDataObject(object):
 
 
 
+    @classmethod
+    def newHash(cls, version: int, content: bytes=b''):
+        """
+        Creates the hash object of innerHash and outerHash
+        ==================================================
+
+        Parameters
+        ----------
+        version : int
+            The HDDO_version of the object to hash.
+        content : bytes, optional (b'' if omitted)
+            Content to feed the hash object with.
+
+        Returns
+        -------
+        hashlib hash object
+            SHA-256 for VERSION_0, BLAKE2b with 32 bytes digest for
+            VERSION_1.
+
+        Throws
+        ------
+        HDDOInitException
+            If the version is unknown.
+
+        Notes
+        -----
+            Both digests are 64 hexadecimal characters long, so objects of
+            different versions can be stored side by side.
+        """
+
+        if version == HealthDominoDataObject.VERSION_0:
+            return sha256(content)
+        if version == HealthDominoDataObject.VERSION_1:
+            return blake2b(content, digest_size=32)
+        raise HDDOInitException('There is no hash function for HDDO_version {}.'.format(version))
+
+
+
     @property
     def outerHash(self) -> str:
         """
@@ -953,6 +1517,41 @@ class HealthDominoDataObject(object):
 
 
 
+    def sendableView(self): # -> HealthDominoDataObject is not written here due to Python 3.7 compatibility.
+        """
+        Gets the object without its hashBase
+        ====================================
+
+        Returns
+        -------
+        HealthDominoDataObject
+            A closed object that shares every field of this object except
+            hashBase, which is empty.
+
+        Throws
+        ------
+        HDDOPermissionException
+            If the object is not yet closed.
+
+        Notes
+        -----
+        I.
+            A closed object can't be modified, so its data, script and
+            identityInfo are shared instead of copied and the script is not
+            validated again. The view costs the same for any size of data.
+        II.
+            reset_() of the view doesn't change this object.
+        """
+
+        if not self.isClosed:
+            raise HDDOPermissionException('Tried to get a sendable view of a non-closed HealthDominoDataObject.')
+        result = HealthDominoDataObject.__new__(HealthDominoDataObject)
+        result.__dict__.update(self.__dict__)
+        result.__hash_base = ''
+        return result
+
+
+
     @property
     def seriesSignature(self) -> str:
         """
@@ -999,7 +1598,7 @@ class HealthDominoDataObject(object):
 
 
 
-    def setInfo(label: str, value: str):
+    def setInfo(self, label: str, value: str):
         """
         Sets the value of an existing element in the identity informations
         ==================================================================
@@ -1078,6 +1677,7 @@ class HealthDominoDataObject(object):
 
 
     @classmethod
+    @timed('hddo.toSendable')
     def toSendable(cls, hddo): # HealthDominoDataObject is not written here due to Python 3.7 compatibility.
         """
         Transforms HealthDominoDataObject to secure sendable object
@@ -1095,10 +1695,16 @@ class HealthDominoDataObject(object):
 
         Notes
         -----
+        I.
             The use of this classmethod is the canonical way to remove hashBase
             from a HealthDominoDataObject.
+        II.
+            A closed object is transformed to its sendableView(), a non-closed
+            one is copied and closed.
         """
 
+        if hddo.isClosed:
+            return hddo.sendableView()
         result = HealthDominoDataObject(hddo.data, hddo.version, hddo.compatibilityLimit)
         result.addScript(hddo.script)
         result.addSeriesSignature(hddo.seriesSignature)
@@ -1110,11 +1716,18 @@ class HealthDominoDataObject(object):
         return result
 
 
-    def transmit(self):
+    @timed('hddo.transmit')
+    def transmit(self, client=None): # App is not written here to keep mock_app lazily imported.
         """
         Transmits the object
         ====================
 
+        Parameters
+        ----------
+        client : App, optional (None if omitted)
+            The App client to transmit the object with. If it's omitted, the
+            default App client is used.
+
         Throws
         ------
         HDDOPermissionException
@@ -1126,16 +1739,22 @@ class HealthDominoDataObject(object):
 
         if self.isClosed:
             if not self.isTransmitted:
+                if client is None:
+                    from mock_app import App as client
                 self.__hash_base = b64encode(urandom(64)).decode('utf-8')
-                inner_hash = sha256(self.toHashable()).hexdigest()
-                transmission_id = App.prepareTransmission(inner_hash)
+                inner_hash = self.computeHash()
+                transmission_id = client.prepareTransmission(inner_hash)
+                retries = 0
                 while transmission_id == '':
                     self.__hash_base = b64encode(urandom(64)).decode('utf-8')
-                    inner_hash = sha256(self.toHashable()).hexdigest()
-                    transmission_id = App.prepareTransmission(inner_hash)
+                    inner_hash = self.computeHash()
+                    transmission_id = client.prepareTransmission(inner_hash)
+                    retries += 1
+                if Metrics.hooks:
+                    Metrics.count('hddo.transmit.reservation_retries', retries)
                 self.__inner_hash = inner_hash
                 sendable = HealthDominoDataObject.toSendable(self)
-                self.__outer_hash = App.transmitHDDO(sendable, transmission_id)
+                self.__outer_hash = client.transmitHDDO(sendable, transmission_id)
                 if self.__outer_hash != '':
                     self.__is_transmitted = True
             else:
@@ -1161,7 +1780,8 @@ class HealthDominoDataObject(object):
 
 
 
-    def reset_(self, pha: str, inner_hash: str, outer_hash: str):
+    def reset_(self, pha: str, inner_hash: str, outer_hash: str,
+               hash_base: str=''):
         """
         Helper function to recreate the object
         ======================================
@@ -1174,6 +1794,8 @@ class HealthDominoDataObject(object):
             The value of innerHash to restore.
         outer_hash : str
             The value of outerHash to restore.
+        hash_base : str, optional ('' if omitted)
+            The value of hashBase to restore.
 
         Notes
         -----
@@ -1184,14 +1806,47 @@ class HealthDominoDataObject(object):
             Please never use this function from outside.
         """
 
+        if pha != self.__pha:
+            self.__content_digest = ''
         self.__pha = pha
         self.__inner_hash = inner_hash
         self.__outer_hash = outer_hash
+        self.__hash_base = hash_base
         if inner_hash != '' and outer_hash != '':
             self.__is_transmitted = True
 
 
 
+    def __eq__(self, other) -> bool:
+        """
+        Compares the object with another one
+        ====================================
+
+        Parameters
+        ----------
+        other : any
+            The object to compare with.
+
+        Returns
+        -------
+        bool
+            True if both objects are closed and have the same contentDigest,
+            or if they are the same object.
+
+        Notes
+        -----
+            hashBase, innerHash and outerHash are not compared, so a reading
+            and its transmitted copy are equal.
+        """
+
+        if not isinstance(other, HealthDominoDataObject):
+            return NotImplemented
+        if self.isClosed and other.isClosed:
+            return self.contentDigest == other.contentDigest
+        return self is other
+
+
+
     def __hash__(self) -> int:
         """
         Gets the hash value of the object
@@ -1215,7 +1870,13 @@ class HealthDominoDataObject(object):
             Production ready type of hashes should be more likely strings instead
             of int because it will produced with much more advanced hash methods
             like for example SHA-256.
+        IV.
+            Closed objects are hashed by their cached contentDigest, so they
+            can be deduplicated in sets and dicts.
         """
+
+        if self.isClosed:
+            return int(self.contentDigest[:16], 16)
         return hash((hash(self.data), self.version, self.compatibilityLimit,
                           self.script, self.seriesSignature, self.pha,
                           self.identityInfo, self.message))
@@ -1305,3 +1966,16 @@ class HDDOPermissionException(Exception):
     """
 
     pass
+
+
+
+class HDDORateLimitException(Exception):
+    """
+    This class is used to indicate that the Server refuses requests for now.
+    The client should wait retry_after seconds before it tries again.
+    """
+
+    def __init__(self, retry_after: float):
+
+        super().__init__('Rate limit exceeded, retry after {:.3f} seconds.'.format(retry_after))
+        self.retry_after = retry_after
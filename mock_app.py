@@ -20,13 +20,43 @@ THIS FILE
 ---------
 This file contains the mock application functionality. Aside of the expected
 behavior nothing is well implemented.
+
+PyCryptodome is imported on first use of encryption or key generation.
 """
 from base64 import b64decode, b64encode
-from Crypto.Cipher import PKCS1_OAEP
-from Crypto.PublicKey import RSA
+from collections import OrderedDict
 from hashlib import sha256
+from hddo import HDDORateLimitException
+from mock_broadcast import Subscription
+from mock_metrics import Metrics, timed
+from mock_other import get_logger
 from mock_server import Server
 from os import urandom
+from threading import Lock
+from time import monotonic, sleep
+
+
+
+LOGGER = get_logger('App')
+
+
+
+class clientmethod(object):
+
+
+
+    def __init__(self, function):
+
+        self.function = function
+        self.__doc__ = function.__doc__
+
+
+
+    def __get__(self, instance, owner):
+
+        if instance is None:
+            instance = owner.defaultClient()
+        return self.function.__get__(instance, owner)
 
 
 
@@ -34,96 +64,256 @@ class App(object):
 
 
 
-    user_pha = ''
-    user_private_key = ''
-    user_public_key = ''
+    default_client = None
+    # Longest total back-off of one reservation before giving up.
+    MAX_WAIT_SECONDS = 5.0
 
 
 
-    @classmethod
-    def decryptForUser(cls, content):
+    def __init__(self, user_pha: str='', user_private_key='',
+                 user_public_key=''):
 
-        return PKCS1_OAEP.new(RSA.importKey(App.user_private_key)).decrypt(b64decode(content)).decode('utf-8')
+        self.user_pha = user_pha
+        self.user_private_key = user_private_key
+        self.user_public_key = user_public_key
+        self.subscription_id = -1
+        # Identifies the transmission source for the rate limits of the Server.
+        self.client_id = urandom(8).hex()
 
 
 
     @classmethod
-    def getUserPHA(cls):
+    def defaultClient(cls):
 
-        if App.user_pha == '':
-            App.registerUser()
-        return App.user_pha
+        if App.default_client is None:
+            App.default_client = App()
+        return App.default_client
 
 
 
-    @classmethod
-    def getUserPrivateKey(cls):
+    @clientmethod
+    @timed('app.decryptForUser')
+    def decryptForUser(self, content):
 
-        if App.user_private_key == '':
-            App.registerUser()
-        return App.user_private_key
+        from Crypto.Cipher import PKCS1_OAEP
+        from Crypto.PublicKey import RSA
+        return PKCS1_OAEP.new(RSA.importKey(self.getUserPrivateKey())).decrypt(b64decode(content)).decode('utf-8')
 
 
 
-    @classmethod
-    def getUserPublicKey(cls):
+    @clientmethod
+    def getUserPHA(self):
 
-        if App.user_public_key == '':
-            App.registerUser()
-        return App.user_public_key
+        if self.user_pha == '':
+            self.registerUser()
+        return self.user_pha
 
 
 
-    @classmethod
-    def encryptForUser(cls, content):
+    @clientmethod
+    def getUserPrivateKey(self):
 
-        if App.user_private_key == '':
-            App.registerUser()
+        if self.user_private_key == '':
+            self.registerUser()
+        return self.user_private_key
 
-        return b64encode(PKCS1_OAEP.new(RSA.importKey(App.user_private_key)).encrypt(content.encode('utf-8')))
 
 
+    @clientmethod
+    def getUserPublicKey(self):
 
-    @classmethod
-    def prepareTransmission(cls, inner_hash: str) -> str:
+        if self.user_public_key == '':
+            self.registerUser()
+        return self.user_public_key
 
-        print('[App] Preparing transmission of a HealthDominoDataObject...')
-        return Server.reserveIfAvailable(inner_hash)
 
 
-    @classmethod
-    def registerUser(cls):
+    @clientmethod
+    @timed('app.encryptForUser')
+    def encryptForUser(self, content):
+
+        from Crypto.Cipher import PKCS1_OAEP
+        from Crypto.PublicKey import RSA
+        return b64encode(PKCS1_OAEP.new(RSA.importKey(self.getUserPrivateKey())).encrypt(content.encode('utf-8')))
+
+
+
+    @clientmethod
+    @timed('app.prepareTransmission')
+    def prepareTransmission(self, inner_hash: str) -> str:
+
+        LOGGER.info('Preparing transmission of a HealthDominoDataObject...')
+        waited = 0.0
+        while True:
+            try:
+                return Server.reserveIfAvailable(inner_hash, self.user_pha, self.client_id)
+            except HDDORateLimitException as exception:
+                # Honor the back-off hint of the Server instead of asking
+                # again right away.
+                if waited + exception.retry_after > App.MAX_WAIT_SECONDS:
+                    raise
+                if Metrics.hooks:
+                    Metrics.count('app.rate_limited')
+                LOGGER.info('Server is busy, retrying after %.3f seconds.', exception.retry_after)
+                sleep(exception.retry_after)
+                waited += exception.retry_after
+
+
 
-        if App.user_pha == '' and App.user_private_key == '' and App.user_public_key == '':
-            print('[App] Registering user.')
+    @clientmethod
+    @timed('app.receiveBroadcasts')
+    def receiveBroadcasts(self, max_count: int=64) -> list:
+
+        if self.subscription_id < 0:
+            return []
+        return Server.receiveBroadcasts(self.subscription_id, max_count)
+
+
+
+    @clientmethod
+    @timed('app.registerUser')
+    def registerUser(self):
+
+        if self.user_pha == '' and self.user_private_key == '' and self.user_public_key == '':
+            from Crypto.PublicKey import RSA
+            LOGGER.info('Registering user.')
             pha = sha256(urandom(16)).hexdigest()
-            print('[App] Please stroke the rabbit to help creating a key pair just for you. Thanks.')
+            LOGGER.info('Please stroke the rabbit to help creating a key pair just for you. Thanks.')
             key_pair = RSA.generate(2048)
             private_key = key_pair.exportKey()
             public_key = key_pair.publickey().exportKey()
-            print('[App] The rabbit is happy. Keys generated sucessfully.')
-            print('[App] Registering account...')
+            LOGGER.info('The rabbit is happy. Keys generated sucessfully.')
+            LOGGER.info('Registering account...')
             while not Server.createAccountIfAvailable(pha, public_key):
                 pha = sha256(urandom(16)).hexdigest()
-            App.user_pha = pha
-            App.user_private_key = private_key
-            App.user_public_key = public_key
-            print('[App] Your Personal Health Address is: {}'.format(App.user_pha))
-            print('      You don\'t have to remember it, this App will remember.')
+            self.user_pha = pha
+            self.user_private_key = private_key
+            self.user_public_key = public_key
+            LOGGER.info('Your Personal Health Address is: %s', self.user_pha)
+            LOGGER.info('You don\'t have to remember it, this App will remember.')
 
 
 
-    @classmethod
-    def requestDelete(cls, hddo, hash_base):
+    @clientmethod
+    @timed('app.requestDelete')
+    def requestDelete(self, hddo, hash_base):
 
-        print('[App] Requesting deletion of HealthDominoDataObject with innerHash {}.'.format(hddo.innerHash))
+        LOGGER.info('Requesting deletion of HealthDominoDataObject with innerHash %s.', hddo.innerHash)
         result = Server.deleteHDDO(hddo, hash_base)
-        print('[App] All occurences of the HealthDominoDataObject is deleted.')
+        if result:
+            LOGGER.info('All occurences of the HealthDominoDataObject is deleted.')
+        else:
+            LOGGER.info('Deletion of the HealthDominoDataObject is refused.')
+        return result
 
 
 
-    @classmethod
-    def transmitHDDO(cls, hddo, transmission_id):
+    @clientmethod
+    @timed('app.requestDeleteBatch')
+    def requestDeleteBatch(self, requests: list) -> list:
+
+        LOGGER.info('Requesting deletion of %s HealthDominoDataObjects.', len(requests))
+        return Server.deleteHDDOs(requests)
+
 
-        print('[App] Transmitting HealthDominoDataObject...')
+
+    @clientmethod
+    @timed('app.subscribeBroadcasts')
+    def subscribeBroadcasts(self, capacity: int=1024, policy: str=Subscription.DROP) -> int:
+
+        # Broadcasts of the scripts this user's signature key satisfies.
+        if self.subscription_id < 0:
+            self.subscription_id = Server.subscribeBroadcasts(hash(self.getUserPrivateKey()),
+                                                              capacity=capacity, policy=policy)
+        return self.subscription_id
+
+
+
+    @clientmethod
+    @timed('app.transmitHDDO')
+    def transmitHDDO(self, hddo, transmission_id):
+
+        LOGGER.info('Transmitting HealthDominoDataObject...')
         return Server.acceptHDDO(hddo, transmission_id)
+
+
+
+class AppCache(object):
+
+
+
+    def __init__(self, max_clients: int=10000, idle_seconds: float=600.0,
+                 loader=None):
+
+        self.clients = OrderedDict()
+        self.idle_seconds = idle_seconds
+        self.loader = loader
+        self.lock = Lock()
+        self.max_clients = max_clients
+
+
+
+    def evictIdle(self) -> int:
+
+        limit = monotonic() - self.idle_seconds
+        evicted = 0
+        with self.lock:
+            while len(self.clients) > 0:
+                pha, (client, last_used) = next(iter(self.clients.items()))
+                if last_used > limit:
+                    break
+                del self.clients[pha]
+                evicted += 1
+        if evicted > 0 and Metrics.hooks:
+            Metrics.count('app.cache.evictions', evicted)
+        return evicted
+
+
+
+    def get(self, pha: str):
+
+        with self.lock:
+            if pha in self.clients:
+                client, _ = self.clients.pop(pha)
+                self.clients[pha] = (client, monotonic())
+                return client
+        if self.loader is None:
+            return None
+        client = self.loader(pha)
+        if client is not None:
+            self.put(client)
+        return client
+
+
+
+    def put(self, client: App):
+
+        evicted = 0
+        with self.lock:
+            self.clients.pop(client.user_pha, None)
+            self.clients[client.user_pha] = (client, monotonic())
+            while len(self.clients) > self.max_clients:
+                self.clients.popitem(last=False)
+                evicted += 1
+        if evicted > 0 and Metrics.hooks:
+            Metrics.count('app.cache.evictions', evicted)
+        self.evictIdle()
+
+
+
+    def remove(self, pha: str):
+
+        with self.lock:
+            self.clients.pop(pha, None)
+
+
+
+    def __contains__(self, pha: str) -> bool:
+
+        return pha in self.clients
+
+
+
+    def __len__(self) -> int:
+
+        return len(self.clients)
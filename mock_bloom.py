@@ -0,0 +1,112 @@
+"""
+HealthDomino
+============
+
+HealthDomino is a GDPR or HIPAA compatible data driven service, that helps
+the user to store, manage, share or use their own personal medical records or
+health data securely with the advantages of being anonymous or with revealed
+identity at the same time.
+
+WHY PYTHON?
+-----------
+We use Python for planning, modeling and prototyping purposes. We think Python
+code is much easier to read at the first time.
+
+The use of Python doesn't mean that we'll develop our production ready solution
+in Python or in Python only. We transform our solutions to C++ or Java quite
+often.
+
+THIS FILE
+---------
+This file contains the mock counting Bloom filter of the server. It answers
+most "not present" questions without touching the backing store and stays
+correct under deletion since every position holds a counter instead of a bit.
+Aside of the expected behavior nothing is well implemented.
+"""
+from hashlib import blake2b
+from math import ceil, log
+
+
+
+class CountingBloomFilter(object):
+
+
+
+    MAX_COUNT = 255
+
+
+
+    def __init__(self, capacity: int=100000, error_rate: float=0.01):
+
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.size = max(int(ceil(-self.capacity * log(error_rate) / log(2) ** 2)), 8)
+        self.hash_count = max(int(round(self.size / self.capacity * log(2))), 1)
+        self.counters = bytearray(self.size)
+        self.count = 0
+        self.negatives = 0
+        self.false_positives = 0
+        self.true_positives = 0
+
+
+
+    def add(self, key: str):
+
+        counters = self.counters
+        for position in self.positions(key):
+            if counters[position] < CountingBloomFilter.MAX_COUNT:
+                counters[position] += 1
+        self.count += 1
+
+
+
+    def falsePositiveRate(self) -> float:
+
+        checked = self.negatives + self.false_positives
+        return self.false_positives / checked if checked > 0 else 0.0
+
+
+
+    def isFull(self) -> bool:
+
+        return self.count > self.capacity
+
+
+
+    def mightContain(self, key: str) -> bool:
+
+        counters = self.counters
+        for position in self.positions(key):
+            if counters[position] == 0:
+                self.negatives += 1
+                return False
+        return True
+
+
+
+    def positions(self, key: str) -> list:
+
+        digest = blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+
+
+    def record(self, is_present: bool):
+
+        if is_present:
+            self.true_positives += 1
+        else:
+            self.false_positives += 1
+
+
+
+    def remove(self, key: str):
+
+        counters = self.counters
+        for position in self.positions(key):
+            # Saturated counters lost track of their real value, keep them.
+            if 0 < counters[position] < CountingBloomFilter.MAX_COUNT:
+                counters[position] -= 1
+        self.count -= 1
@@ -0,0 +1,277 @@
+"""
+HealthDomino
+============
+
+HealthDomino is a GDPR or HIPAA compatible data driven service, that helps
+the user to store, manage, share or use their own personal medical records or
+health data securely with the advantages of being anonymous or with revealed
+identity at the same time.
+
+WHY PYTHON?
+-----------
+We use Python for planning, modeling and prototyping purposes. We think Python
+code is much easier to read at the first time.
+
+The use of Python doesn't mean that we'll develop our production ready solution
+in Python or in Python only. We transform our solutions to C++ or Java quite
+often.
+
+THIS FILE
+---------
+This file contains the mock broadcast subscriptions of the server. Clients
+subscribe once with their signature key or with a predicate over scripts. A
+script is compiled to the one signature key that satisfies it, so a broadcast
+is pushed to the matching subscribers only instead of evaluating every
+subscriber. Every subscription has a bounded queue that either drops the
+oldest broadcast or refuses the new one when it's full, and clients receive
+their broadcasts in batches. The scripts of hot objects are kept in a
+bounded LRU cache, so repeated broadcasts don't fetch the object again. Aside
+of the expected behavior nothing is well implemented.
+"""
+from collections import deque, OrderedDict
+from mock_metrics import Metrics, timed
+from mock_other import ScriptEngine
+from sys import getsizeof
+
+
+
+class ScriptCache(object):
+
+
+
+    # Estimated size of an OrderedDict entry besides its key and value.
+    ENTRY_OVERHEAD = 100
+
+
+
+    def __init__(self, max_bytes: int=16 * 2 ** 20):
+
+        # innerHash -> (script as tuple, estimated size)
+        self.entries = OrderedDict()
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+
+    def clear(self):
+
+        self.entries.clear()
+        self.size = 0
+
+
+
+    def get(self, inner_hash: str):
+
+        entry = self.entries.get(inner_hash)
+        if entry is None:
+            self.misses += 1
+            if Metrics.hooks:
+                Metrics.count('server.script_cache.misses')
+            return None
+        self.entries.move_to_end(inner_hash)
+        self.hits += 1
+        if Metrics.hooks:
+            Metrics.count('server.script_cache.hits')
+        return entry[0]
+
+
+
+    def put(self, inner_hash: str, script) -> tuple:
+
+        script = tuple(script)
+        size = (ScriptCache.ENTRY_OVERHEAD + getsizeof(inner_hash) + getsizeof(script)
+                + sum(getsizeof(command) for command in script))
+        if size > self.max_bytes:
+            return script
+        self.remove(inner_hash)
+        self.entries[inner_hash] = (script, size)
+        self.size += size
+        evicted = 0
+        while self.size > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            evicted += 1
+        if evicted > 0:
+            self.evictions += evicted
+            if Metrics.hooks:
+                Metrics.count('server.script_cache.evictions', evicted)
+        return script
+
+
+
+    def remove(self, inner_hash: str):
+
+        entry = self.entries.pop(inner_hash, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+
+
+    def __len__(self) -> int:
+
+        return len(self.entries)
+
+
+
+class Subscription(object):
+
+
+
+    # Drop the oldest broadcast of a full queue.
+    DROP = 'drop'
+    # Refuse new broadcasts while the queue is full, so the initiator can
+    # repeat them later.
+    BACKPRESSURE = 'backpressure'
+
+
+
+    def __init__(self, sig_key=None, predicate=None, capacity: int=1024,
+                 policy: str=DROP):
+
+        if policy not in (Subscription.DROP, Subscription.BACKPRESSURE):
+            raise ValueError('Unknown broadcast queue policy: {}.'.format(policy))
+        self.sig_key = sig_key
+        self.predicate = predicate
+        self.capacity = max(capacity, 1)
+        self.policy = policy
+        self.queue = deque()
+        self.dropped = 0
+        self.refused = 0
+
+
+
+    def take(self, max_count: int=64) -> list:
+
+        queue = self.queue
+        return [queue.popleft() for _ in range(min(max_count, len(queue)))]
+
+
+
+    def __len__(self) -> int:
+
+        return len(self.queue)
+
+
+
+class BroadcastRegistry(object):
+
+
+
+    def __init__(self):
+
+        self.subscriptions = {}
+        # sig_key -> ids of the subscriptions with that key
+        self.sig_keys = {}
+        # id -> predicate of the subscriptions without sig_key
+        self.predicates = {}
+        self.next_id = 0
+
+
+
+    def clear(self):
+
+        self.subscriptions.clear()
+        self.sig_keys.clear()
+        self.predicates.clear()
+
+
+
+    def match(self, script: list) -> list:
+
+        coefficient, target = ScriptEngine.linearize(script)
+        if coefficient == 0:
+            # The script doesn't depend on the key: all or nothing.
+            result = list(self.sig_keys.values()) if target == 0 else []
+            result = [subscription_id for ids in result for subscription_id in ids]
+        elif target % coefficient == 0:
+            result = list(self.sig_keys.get(target // coefficient, ()))
+        else:
+            result = []
+        for subscription_id, predicate in self.predicates.items():
+            if predicate(script):
+                result.append(subscription_id)
+        return result
+
+
+
+    @timed('broadcast.publish')
+    def publish(self, inner_hash: str, script: list, subscription_ids=None) -> dict:
+
+        # Every queue holds the same immutable item.
+        item = (inner_hash, tuple(script))
+        if subscription_ids is None:
+            subscription_ids = self.match(script)
+        subscriptions = self.subscriptions
+        dropped = 0
+        refused = []
+        for subscription_id in subscription_ids:
+            subscription = subscriptions.get(subscription_id)
+            if subscription is None:
+                continue
+            queue = subscription.queue
+            if len(queue) >= subscription.capacity:
+                if subscription.policy == Subscription.BACKPRESSURE:
+                    subscription.refused += 1
+                    refused.append(subscription_id)
+                    continue
+                queue.popleft()
+                subscription.dropped += 1
+                dropped += 1
+            queue.append(item)
+        delivered = len(subscription_ids) - len(refused)
+        if Metrics.hooks:
+            Metrics.count('broadcast.delivered', delivered)
+            Metrics.count('broadcast.dropped', dropped)
+            Metrics.count('broadcast.refused', len(refused))
+        return {'matched' : len(subscription_ids), 'delivered' : delivered,
+                'dropped' : dropped, 'refused' : refused}
+
+
+
+    def subscribe(self, sig_key=None, predicate=None, capacity: int=1024,
+                  policy: str=Subscription.DROP) -> int:
+
+        if (sig_key is None) == (predicate is None):
+            raise ValueError('A subscription needs either a sig_key or a predicate.')
+        subscription = Subscription(sig_key, predicate, capacity, policy)
+        subscription_id = self.next_id
+        self.next_id += 1
+        self.subscriptions[subscription_id] = subscription
+        if sig_key is not None:
+            self.sig_keys.setdefault(sig_key, []).append(subscription_id)
+        else:
+            self.predicates[subscription_id] = predicate
+        return subscription_id
+
+
+
+    def take(self, subscription_id: int, max_count: int=64) -> list:
+
+        subscription = self.subscriptions.get(subscription_id)
+        if subscription is None:
+            return []
+        return subscription.take(max_count)
+
+
+
+    def unsubscribe(self, subscription_id: int):
+
+        subscription = self.subscriptions.pop(subscription_id, None)
+        if subscription is None:
+            return
+        if subscription.sig_key is not None:
+            ids = self.sig_keys[subscription.sig_key]
+            ids.remove(subscription_id)
+            if len(ids) == 0:
+                del self.sig_keys[subscription.sig_key]
+        else:
+            del self.predicates[subscription_id]
+
+
+
+    def __len__(self) -> int:
+
+        return len(self.subscriptions)
@@ -0,0 +1,182 @@
+"""
+HealthDomino
+============
+
+HealthDomino is a GDPR or HIPAA compatible data driven service, that helps
+the user to store, manage, share or use their own personal medical records or
+health data securely with the advantages of being anonymous or with revealed
+identity at the same time.
+
+WHY PYTHON?
+-----------
+We use Python for planning, modeling and prototyping purposes. We think Python
+code is much easier to read at the first time.
+
+The use of Python doesn't mean that we'll develop our production ready solution
+in Python or in Python only. We transform our solutions to C++ or Java quite
+often.
+
+THIS FILE
+---------
+This file contains the mock custody stage of the server. Accepted objects are
+queued and protected in batches: the data of every object is encoded with a
+new encoding key and encrypted with a new encryption key, and the encoding key
+is wrapped with the public key of the object's PHA, so only the user can undo
+the encoding. The re-encrypted data, the encoding key and the encryption key
+are written to three separate stores. A batch is grouped by PHA and spread
+over a process pool, every process keeps the public keys it parsed, so a key
+is parsed once per process instead of once per object. Protected objects are
+written to the write-ahead log as records of base64 text. PyCryptodome is
+imported on first use. Aside of the expected behavior nothing is well
+implemented.
+"""
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from mock_metrics import Metrics, timed
+from mock_outbox import decrypt_content, encrypt_content
+from os import cpu_count, urandom
+
+
+
+# pha -> (public key as stored, parsed key) in this process, least recently
+# used first.
+PARSED_KEYS = OrderedDict()
+PARSED_KEYS_LIMIT = 4096
+
+
+
+class CustodyStage(object):
+
+
+
+    def __init__(self, batch_size: int=256, workers: int=0):
+
+        self.batch_size = max(batch_size, 1)
+        self.workers = workers if workers > 0 else (cpu_count() or 1)
+        self.executor = None
+        # (inner_hash, pha, data as JSON) of the objects of the next batch
+        self.pending = []
+
+
+
+    def close(self):
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+
+    def discard(self, inner_hash: str):
+
+        self.pending = [item for item in self.pending if item[0] != inner_hash]
+
+
+
+    @timed('custody.protect')
+    def protect(self, users: dict) -> list:
+
+        pending, self.pending = self.pending, []
+        groups = {}
+        for inner_hash, pha, content in pending:
+            if pha in users:
+                groups.setdefault(pha, []).append((inner_hash, content))
+        # Anonymous objects have no public key to wrap their encoding key.
+        skipped = len(pending) - sum(len(items) for items in groups.values())
+        chunk_size = max(len(pending) // (self.workers * 4), 1)
+        tasks = [(pha, users[pha], items[start:start + chunk_size])
+                 for pha, items in groups.items()
+                 for start in range(0, len(items), chunk_size)]
+        if self.workers <= 1 or len(tasks) <= 1:
+            results = [protect_chunk(task) for task in tasks]
+        else:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            results = self.executor.map(protect_chunk, tasks)
+        if Metrics.hooks:
+            Metrics.count('custody.skipped', skipped)
+        return [record for result in results for record in result]
+
+
+
+    def put(self, inner_hash: str, pha: str, content: str) -> bool:
+
+        self.pending.append((inner_hash, pha, content))
+        return len(self.pending) >= self.batch_size
+
+
+
+    def __len__(self) -> int:
+
+        return len(self.pending)
+
+
+
+def custody_from_record(items: list) -> list:
+
+    return [(item[0],) + tuple(b64decode(value) for value in item[1:]) for item in items]
+
+
+
+def custody_to_record(records: list) -> list:
+
+    return [[record[0]] + [b64encode(value).decode('utf-8') for value in record[1:]]
+            for record in records]
+
+
+
+def decode_content(key: bytes, content: bytes) -> bytes:
+
+    from Crypto.Cipher import AES
+    cipher = AES.new(key, AES.MODE_CTR, nonce=content[:8])
+    return cipher.decrypt(content[8:])
+
+
+
+def encode_content(key: bytes, content: bytes) -> bytes:
+
+    from Crypto.Cipher import AES
+    cipher = AES.new(key, AES.MODE_CTR, nonce=urandom(8))
+    return cipher.nonce + cipher.encrypt(content)
+
+
+
+def parsed_key(pha: str, public_key: bytes):
+
+    entry = PARSED_KEYS.get(pha)
+    if entry is not None and entry[0] == public_key:
+        PARSED_KEYS.move_to_end(pha)
+        return entry[1]
+    from Crypto.PublicKey import RSA
+    key = RSA.importKey(public_key)
+    PARSED_KEYS[pha] = (public_key, key)
+    if len(PARSED_KEYS) > PARSED_KEYS_LIMIT:
+        PARSED_KEYS.popitem(last=False)
+    return key
+
+
+
+def protect_chunk(task: tuple) -> list:
+
+    from Crypto.Cipher import PKCS1_OAEP
+    pha, public_key, items = task
+    wrapper = PKCS1_OAEP.new(parsed_key(pha, public_key))
+    result = []
+    for inner_hash, content in items:
+        encoding_key = urandom(32)
+        encryption_key = urandom(32)
+        encoded = encode_content(encoding_key, content.encode('utf-8'))
+        result.append((inner_hash, encrypt_content(encryption_key, encoded),
+                       wrapper.encrypt(encoding_key), encryption_key))
+    return result
+
+
+
+def reveal_content(private_key: bytes, reencrypted: bytes, encoding_key: bytes,
+                   encryption_key: bytes) -> str:
+
+    from Crypto.Cipher import PKCS1_OAEP
+    from Crypto.PublicKey import RSA
+    encoding_key = PKCS1_OAEP.new(RSA.importKey(private_key)).decrypt(encoding_key)
+    return decode_content(encoding_key, decrypt_content(encryption_key, reencrypted)).decode('utf-8')
@@ -0,0 +1,211 @@
+"""
+HealthDomino
+============
+
+HealthDomino is a GDPR or HIPAA compatible data driven service, that helps
+the user to store, manage, share or use their own personal medical records or
+health data securely with the advantages of being anonymous or with revealed
+identity at the same time.
+
+WHY PYTHON?
+-----------
+We use Python for planning, modeling and prototyping purposes. We think Python
+code is much easier to read at the first time.
+
+The use of Python doesn't mean that we'll develop our production ready solution
+in Python or in Python only. We transform our solutions to C++ or Java quite
+often.
+
+THIS FILE
+---------
+This file contains the mock anti-entropy functionality of the server. Every
+store keeps a Merkle tree over its keys, bucketed by hash prefix, so two
+replicas find their differences by comparing O(diff * log N) tree nodes
+instead of every key. Aside of the expected behavior nothing is well
+implemented.
+"""
+from base64 import b64decode, b64encode
+from hashlib import sha256
+from mock_wal import hddo_from_record, hddo_to_record
+
+
+
+class MerkleTree(object):
+
+
+
+    EMPTY = bytes(32)
+
+
+
+    def __init__(self, depth: int=12):
+
+        self.depth = depth
+        self.leaf_count = 1 << depth
+        # Heap layout: node 1 is the root, children of node i are 2i and
+        # 2i + 1, leaves are leaf_count ... 2 * leaf_count - 1.
+        self.nodes = [MerkleTree.EMPTY] * (2 * self.leaf_count)
+        self.leaves = [0] * self.leaf_count
+        self.buckets = [{} for _ in range(self.leaf_count)]
+
+
+
+    def add(self, key: str, value: str=''):
+
+        bucket = self.bucket(key)
+        previous = self.buckets[bucket].get(key)
+        if previous == value:
+            return
+        if previous is not None:
+            self.leaves[bucket] ^= entry_digest(key, previous)
+        self.buckets[bucket][key] = value
+        self.leaves[bucket] ^= entry_digest(key, value)
+        self.update(bucket)
+
+
+
+    def bucket(self, key: str) -> int:
+
+        return int(key[:8], 16) >> (32 - self.depth)
+
+
+
+    def diff(self, other) -> list:
+
+        result = []
+        stack = [1]
+        while len(stack) > 0:
+            node = stack.pop()
+            if self.nodes[node] == other.nodes[node]:
+                continue
+            if node >= self.leaf_count:
+                result.append(node - self.leaf_count)
+            else:
+                stack.append(2 * node + 1)
+                stack.append(2 * node)
+        return result
+
+
+
+    def remove(self, key: str):
+
+        bucket = self.bucket(key)
+        value = self.buckets[bucket].pop(key, None)
+        if value is not None:
+            self.leaves[bucket] ^= entry_digest(key, value)
+            self.update(bucket)
+
+
+
+    def root(self) -> bytes:
+
+        return self.nodes[1]
+
+
+
+    def update(self, bucket: int):
+
+        node = self.leaf_count + bucket
+        self.nodes[node] = self.leaves[bucket].to_bytes(32, 'big')
+        node //= 2
+        while node > 0:
+            left, right = self.nodes[2 * node], self.nodes[2 * node + 1]
+            if left == MerkleTree.EMPTY and right == MerkleTree.EMPTY:
+                self.nodes[node] = MerkleTree.EMPTY
+            else:
+                self.nodes[node] = sha256(left + right).digest()
+            node //= 2
+
+
+
+class MerkleReplica(object):
+
+
+
+    def __init__(self, depth: int=12):
+
+        self.hddo_inner = {}
+        self.hddo_nounces = {}
+        self.hddo_outer = {}
+        self.trees = {'inner' : MerkleTree(depth), 'nounces' : MerkleTree(depth),
+                      'outer' : MerkleTree(depth)}
+
+
+
+    def dropHDDO(self, outer_hash: str):
+
+        inner_hash = self.hddo_outer.pop(outer_hash)
+        del self.hddo_inner[inner_hash]
+        del self.hddo_nounces[inner_hash]
+        self.trees['inner'].remove(inner_hash)
+        self.trees['nounces'].remove(inner_hash)
+        self.trees['outer'].remove(outer_hash)
+
+
+
+    def exportHDDO(self, outer_hash: str) -> dict:
+
+        inner_hash = self.hddo_outer[outer_hash]
+        return {'type' : 'accept', 'hddo' : hddo_to_record(self.hddo_inner[inner_hash]),
+                'outer_hash' : outer_hash,
+                'nounce' : b64encode(self.hddo_nounces[inner_hash]).decode('utf-8')}
+
+
+
+    def importHDDO(self, record: dict):
+
+        hddo = hddo_from_record(record['hddo'])
+        nounce = b64decode(record['nounce'])
+        self.hddo_inner[hddo.innerHash] = hddo
+        self.hddo_nounces[hddo.innerHash] = nounce
+        self.hddo_outer[record['outer_hash']] = hddo.innerHash
+        self.trees['inner'].add(hddo.innerHash)
+        self.trees['nounces'].add(hddo.innerHash, nounce.hex())
+        self.trees['outer'].add(record['outer_hash'], hddo.innerHash)
+
+
+
+    def merkleBucket(self, name: str, bucket: int) -> dict:
+
+        return self.trees[name].buckets[bucket]
+
+
+
+    def merkleTree(self, name: str):
+
+        return self.trees[name]
+
+
+
+def entry_digest(key: str, value: str) -> int:
+
+    return int.from_bytes(sha256('{}\0{}'.format(key, value).encode('utf-8')).digest(), 'big')
+
+
+
+def sync_replicas(source, target) -> dict:
+
+    # The outer tree maps outerHash to innerHash, so its buckets alone tell
+    # which objects to copy or drop. The inner and nounce trees follow it.
+    source_tree = source.merkleTree('outer')
+    target_tree = target.merkleTree('outer')
+    if source_tree.depth != target_tree.depth:
+        raise ValueError('Replicas with different Merkle tree depth cannot be synced.')
+    buckets = source_tree.diff(target_tree)
+    missing, extra = [], []
+    for bucket in buckets:
+        source_entries = dict(source.merkleBucket('outer', bucket))
+        target_entries = dict(target.merkleBucket('outer', bucket))
+        extra.extend(outer_hash for outer_hash, inner_hash in target_entries.items()
+                     if source_entries.get(outer_hash) != inner_hash)
+        missing.extend(outer_hash for outer_hash, inner_hash in source_entries.items()
+                       if target_entries.get(outer_hash) != inner_hash)
+    # Drop first: an innerHash may move to an outerHash of another bucket.
+    for outer_hash in extra:
+        target.dropHDDO(outer_hash)
+    for outer_hash in missing:
+        target.importHDDO(source.exportHDDO(outer_hash))
+    is_consistent = all(source.merkleTree(name).root() == target.merkleTree(name).root()
+                        for name in ('inner', 'nounces', 'outer'))
+    return {'buckets' : len(buckets), 'copied' : len(missing), 'dropped' : len(extra),
+            'consistent' : is_consistent}
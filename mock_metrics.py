@@ -0,0 +1,225 @@
+"""
+HealthDomino
+============
+
+HealthDomino is a GDPR or HIPAA compatible data driven service, that helps
+the user to store, manage, share or use their own personal medical records or
+health data securely with the advantages of being anonymous or with revealed
+identity at the same time.
+
+WHY PYTHON?
+-----------
+We use Python for planning, modeling and prototyping purposes. We think Python
+code is much easier to read at the first time.
+
+The use of Python doesn't mean that we'll develop our production ready solution
+in Python or in Python only. We transform our solutions to C++ or Java quite
+often.
+
+THIS FILE
+---------
+This file contains the mock metrics functionality. Hooks can be registered to
+receive latencies, counters and gauges of the HDDO lifecycle. Without any
+registered hook the instrumentation does nothing.
+"""
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+
+
+
+class Metrics(object):
+
+
+
+    hooks = []
+
+
+
+    @classmethod
+    def count(cls, name: str, value: int=1):
+
+        for hook in Metrics.hooks:
+            hook.count(name, value)
+
+
+
+    @classmethod
+    def gauge(cls, name: str, value: float):
+
+        for hook in Metrics.hooks:
+            hook.gauge(name, value)
+
+
+
+    @classmethod
+    def observe(cls, name: str, seconds: float):
+
+        for hook in Metrics.hooks:
+            hook.observe(name, seconds)
+
+
+
+    @classmethod
+    def register(cls, hook):
+
+        if hook not in Metrics.hooks:
+            Metrics.hooks = Metrics.hooks + [hook]
+
+
+
+    @classmethod
+    def unregister(cls, hook):
+
+        Metrics.hooks = [item for item in Metrics.hooks if item is not hook]
+
+
+
+class MetricsRecorder(object):
+
+
+
+    BUCKETS = [0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+               0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+    PREFIX = 'healthdomino_'
+
+
+
+    def __init__(self, buckets: list=None):
+
+        self.buckets = sorted(buckets) if buckets is not None else MetricsRecorder.BUCKETS
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = Lock()
+
+
+
+    def count(self, name: str, value: int=1):
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+
+    def gauge(self, name: str, value: float):
+
+        with self.lock:
+            self.gauges[name] = value
+
+
+
+    def observe(self, name: str, seconds: float):
+
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = {'buckets' : [0] * (len(self.buckets) + 1),
+                                         'count' : 0, 'sum' : 0.0}
+            histogram = self.histograms[name]
+            histogram['buckets'][bisect_left(self.buckets, seconds)] += 1
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+
+
+
+    def toPrometheus(self) -> str:
+
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                metric = MetricsRecorder.metricName(name) + '_total'
+                lines.append('# TYPE {} counter'.format(metric))
+                lines.append('{} {}'.format(metric, value))
+            for name, value in sorted(self.gauges.items()):
+                metric = MetricsRecorder.metricName(name)
+                lines.append('# TYPE {} gauge'.format(metric))
+                lines.append('{} {}'.format(metric, value))
+            for name, histogram in sorted(self.histograms.items()):
+                metric = MetricsRecorder.metricName(name) + '_seconds'
+                lines.append('# TYPE {} histogram'.format(metric))
+                cumulative = 0
+                for bound, amount in zip(self.buckets, histogram['buckets']):
+                    cumulative += amount
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(metric, bound, cumulative))
+                lines.append('{}_bucket{{le="+Inf"}} {}'.format(metric, histogram['count']))
+                lines.append('{}_sum {}'.format(metric, histogram['sum']))
+                lines.append('{}_count {}'.format(metric, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+
+
+    def writePrometheus(self, path: str):
+
+        with open(path, 'w') as out_file:
+            out_file.write(self.toPrometheus())
+
+
+
+    @staticmethod
+    def metricName(name: str) -> str:
+
+        return MetricsRecorder.PREFIX + name.replace('.', '_').lower()
+
+
+
+class OpenTelemetryHook(object):
+
+
+
+    def __init__(self, meter_name: str='HealthDomino'):
+
+        from opentelemetry import metrics
+        self.meter = metrics.get_meter(meter_name)
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = Lock()
+
+
+
+    def count(self, name: str, value: int=1):
+
+        if name not in self.counters:
+            with self.lock:
+                self.counters.setdefault(name, self.meter.create_counter(name))
+        self.counters[name].add(value)
+
+
+
+    def gauge(self, name: str, value: float):
+
+        if name not in self.gauges:
+            with self.lock:
+                self.gauges.setdefault(name, self.meter.create_gauge(name))
+        self.gauges[name].set(value)
+
+
+
+    def observe(self, name: str, seconds: float):
+
+        if name not in self.histograms:
+            with self.lock:
+                self.histograms.setdefault(name, self.meter.create_histogram(name, unit='s'))
+        self.histograms[name].record(seconds)
+
+
+
+def timed(name: str):
+
+    def decorator(function):
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+
+            if not Metrics.hooks:
+                return function(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                Metrics.observe(name, perf_counter() - start)
+
+        return wrapper
+
+    return decorator
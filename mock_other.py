@@ -21,10 +21,73 @@ THIS FILE
 This file contains the some other mock functionality. Aside of the expected
 behavior nothing is well implemented.
 """
+import logging
+from sys import stdout
 from time import localtime, strftime, time
 
 
 
+LOGGER_NAME = 'HealthDomino'
+logging.getLogger(LOGGER_NAME).addHandler(logging.NullHandler())
+
+
+
+class LogManager(object):
+
+
+
+    handler = None
+    listener = None
+
+
+
+    @classmethod
+    def start(cls, level: int=logging.INFO, stream=None,
+              asynchronous: bool=True):
+
+        LogManager.stop()
+        output = logging.StreamHandler(stream if stream is not None else stdout)
+        output.setFormatter(ComponentFormatter('[%(component)s] %(message)s'))
+        if asynchronous:
+            from logging.handlers import QueueHandler, QueueListener
+            from queue import SimpleQueue
+            queue = SimpleQueue()
+            LogManager.handler = QueueHandler(queue)
+            LogManager.listener = QueueListener(queue, output)
+            LogManager.listener.start()
+        else:
+            LogManager.handler = output
+        root = logging.getLogger(LOGGER_NAME)
+        root.addHandler(LogManager.handler)
+        root.setLevel(level)
+
+
+
+    @classmethod
+    def stop(cls):
+
+        root = logging.getLogger(LOGGER_NAME)
+        if LogManager.handler is not None:
+            root.removeHandler(LogManager.handler)
+            LogManager.handler = None
+        if LogManager.listener is not None:
+            LogManager.listener.stop()
+            LogManager.listener = None
+        root.setLevel(logging.NOTSET)
+
+
+
+class ComponentFormatter(logging.Formatter):
+
+
+
+    def format(self, record):
+
+        record.component = record.name.rsplit('.', 1)[-1]
+        return super().format(record)
+
+
+
 class ScriptEngine(object):
 
 
@@ -43,7 +106,7 @@ class ScriptEngine(object):
                 memmory[pointer] = int(command)
                 pointer += 1
             elif command == '<SigKey>':
-                memmory[pointer] = int(command)
+                memmory[pointer] = sig_key
                 pointer += 1
             elif command == 'HD_ADD':
                 memmory[0] = memmory[0] + memmory[1]
@@ -54,6 +117,30 @@ class ScriptEngine(object):
 
 
 
+    @classmethod
+    def linearize(cls, script: list) -> tuple:
+
+        # evaluate() only loads and adds, so it accepts sig_key exactly if
+        # coefficient * sig_key == target.
+        pointer = 0
+        memmory = [(0, 0), (0, 0)]
+        for command in script[:-1]:
+            if command.isnumeric():
+                memmory[pointer] = (0, int(command))
+                pointer += 1
+            elif command == '<SigKey>':
+                memmory[pointer] = (1, 0)
+                pointer += 1
+            elif command == 'HD_ADD':
+                memmory[0] = (memmory[0][0] + memmory[1][0], memmory[0][1] + memmory[1][1])
+                pointer = 0
+            if pointer > 1:
+                pointer = 0
+        coefficient, constant = memmory[pointer]
+        return coefficient, int(script[-1]) - constant
+
+
+
     @classmethod
     def validate(cls, script: list) -> bool:
 
@@ -65,12 +152,18 @@ class ScriptEngine(object):
                 is_int = False
             if not is_int:
                 if command not in ScriptEngine.COMMANDS:
-                    print(command)
+                    LOGGER.debug('Unknown script command: %s', command)
                     return False
         return True
 
 
 
+def get_logger(component: str):
+
+    return logging.getLogger('{}.{}'.format(LOGGER_NAME, component))
+
+
+
 def get_readable_time(timestamp):
 
     return strftime('%m/%d/%Y %H:%M:%S', localtime(timestamp))
@@ -80,3 +173,7 @@ def get_readable_time(timestamp):
 def now():
 
     return int(time())
+
+
+
+LOGGER = get_logger('ScriptEngine')
@@ -0,0 +1,385 @@
+"""
+HealthDomino
+============
+
+HealthDomino is a GDPR or HIPAA compatible data driven service, that helps
+the user to store, manage, share or use their own personal medical records or
+health data securely with the advantages of being anonymous or with revealed
+identity at the same time.
+
+WHY PYTHON?
+-----------
+We use Python for planning, modeling and prototyping purposes. We think Python
+code is much easier to read at the first time.
+
+The use of Python doesn't mean that we'll develop our production ready solution
+in Python or in Python only. We transform our solutions to C++ or Java quite
+often.
+
+THIS FILE
+---------
+This file contains the mock offline outbox of the App. Closed objects are
+persisted encrypted on the device until they can be transmitted. The outbox
+drains by priority and deadline in batches that shrink when the connection
+fails and grow when it works. A reading that is already waiting in the outbox
+is not queued again. Every transmission attempt is persisted before it's sent,
+so a lost reply is repeated with the same innerHash instead of storing the
+object twice. The hashBase of delivered objects is kept encrypted for later
+deletion, in a Vault if one is given. Without a Vault they are appended to a
+log, forgotten objects get a tombstone line and the log is rewritten when it
+has more dead lines than live ones. Aside of the expected behavior nothing
+is well implemented.
+
+PyCryptodome is imported on first use of encryption.
+"""
+from base64 import b64decode, b64encode
+from hddo import HDDOPermissionException, HDDORateLimitException, HealthDominoDataObject
+import json
+from mock_metrics import Metrics, timed
+from mock_other import get_logger
+from mock_wal import hddo_from_record, hddo_to_record
+from os import fsync, listdir, makedirs, remove, replace, urandom
+from os.path import join
+from time import monotonic, time
+
+
+
+LOGGER = get_logger('Outbox')
+
+
+
+class Outbox(object):
+
+
+
+    ENTRY_FORMAT = 'entry-{:020d}.bin'
+    DELIVERED = 'delivered.log'
+    MAX_BACKOFF_SECONDS = 60.0
+
+
+
+    def __init__(self, directory: str, key: bytes, max_bytes: int=64 * 2 ** 20,
+                 batch_size: int=64, vault=None):
+
+        makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.key = key
+        self.max_bytes = max_bytes
+        self.max_batch_size = batch_size
+        self.batch_size = batch_size
+        self.backoff = 0.0
+        self.retry_at = 0.0
+        self.vault = vault
+        # entry id -> (priority, deadline, size on disk, contentDigest)
+        self.entries = {}
+        # contentDigest -> entry id
+        self.digests = {}
+        # innerHash -> (outerHash, hashBase)
+        self.delivered = {}
+        # Lines of the delivered log that are replaced or forgotten
+        self.dead = 0
+        self.next_id = 0
+        self.size = 0
+        for name in sorted(listdir(directory)):
+            if name.startswith('entry-') and name.endswith('.bin'):
+                with open(join(directory, name), 'rb') as in_file:
+                    content = in_file.read()
+                entry = json.loads(decrypt_content(key, content))
+                self.entries[entry['id']] = (entry['priority'], entry['deadline'], len(content),
+                                             entry['digest'])
+                self.digests[entry['digest']] = entry['id']
+                self.size += len(content)
+                self.next_id = entry['id'] + 1
+        path = join(directory, Outbox.DELIVERED)
+        valid_bytes = 0
+        lines = 0
+        try:
+            with open(path, 'rb') as in_file:
+                for line in in_file:
+                    if not line.endswith(b'\n'):
+                        break
+                    # A complete line that doesn't decrypt means a wrong key
+                    # or a damaged file, that raises ValueError.
+                    delivery = json.loads(decrypt_content(key, b64decode(line)))
+                    if delivery.get('forget', False):
+                        self.delivered.pop(delivery['inner_hash'], None)
+                    else:
+                        self.delivered[delivery['inner_hash']] = (delivery['outer_hash'],
+                                                                  delivery['hash_base'])
+                    valid_bytes += len(line)
+                    lines += 1
+                is_torn = in_file.tell() > valid_bytes
+        except FileNotFoundError:
+            is_torn = False
+        if is_torn:
+            # A torn write at the end of the log. Drop it, so the next
+            # deliveries are appended right after the last valid one.
+            with open(path, 'r+b') as out_file:
+                out_file.truncate(valid_bytes)
+        self.dead = lines - len(self.delivered)
+        if self.dead > len(self.delivered):
+            self.compact()
+
+
+
+    def compact(self) -> int:
+
+        dead = self.dead
+        path = join(self.directory, Outbox.DELIVERED)
+        content = b''.join(self.deliveryLine({'inner_hash' : inner_hash, 'outer_hash' : outer_hash,
+                                              'hash_base' : hash_base})
+                           for inner_hash, (outer_hash, hash_base) in self.delivered.items())
+        with open(path + '.tmp', 'wb') as out_file:
+            out_file.write(content)
+            out_file.flush()
+            fsync(out_file.fileno())
+        replace(path + '.tmp', path)
+        self.dead = 0
+        return dead
+
+
+
+    def deliver(self, entry_id: int, hddo, inner_hash: str, outer_hash: str,
+                hash_base: str):
+
+        hddo.reset_(hddo.pha, inner_hash, outer_hash, hash_base)
+        if self.vault is not None:
+            self.vault.put([hddo])
+            self.discard(entry_id)
+            return hddo
+        self.writeDelivered(self.deliveryLine({'inner_hash' : inner_hash, 'outer_hash' : outer_hash,
+                                               'hash_base' : hash_base}))
+        if inner_hash in self.delivered:
+            self.dead += 1
+        self.delivered[inner_hash] = (outer_hash, hash_base)
+        self.discard(entry_id)
+        return hddo
+
+
+
+    def deliveryLine(self, delivery: dict) -> bytes:
+
+        return b64encode(encrypt_content(self.key, json.dumps(delivery).encode('utf-8'))) + b'\n'
+
+
+
+    def discard(self, entry_id: int):
+
+        _, _, size, digest = self.entries.pop(entry_id)
+        del self.digests[digest]
+        self.size -= size
+        remove(join(self.directory, Outbox.ENTRY_FORMAT.format(entry_id)))
+
+
+
+    @timed('outbox.drain')
+    def drain(self, client=None, max_batches: int=0) -> list:
+
+        if client is None:
+            from mock_app import App as client
+        result = []
+        if monotonic() < self.retry_at:
+            return result
+        batches = 0
+        while len(self.entries) > 0 and (max_batches <= 0 or batches < max_batches):
+            batch = self.order()[:self.batch_size]
+            sent = 0
+            for entry_id in batch:
+                try:
+                    hddo = self.send(entry_id, client)
+                except OSError:
+                    # Connectivity is lost again. Back off and send less at once.
+                    self.backoff = min(max(2 * self.backoff, 0.5), Outbox.MAX_BACKOFF_SECONDS)
+                    self.retry_at = monotonic() + self.backoff
+                    self.batch_size = max(self.batch_size // 2, 1)
+                    LOGGER.info('Draining outbox... Failed, retrying in %s seconds.', self.backoff)
+                    if Metrics.hooks:
+                        Metrics.count('outbox.failures')
+                        Metrics.gauge('outbox.size', len(self.entries))
+                    return result
+                except HDDORateLimitException as exception:
+                    # The Server is up, it only asks to wait, so the batch
+                    # size stays.
+                    self.retry_at = monotonic() + exception.retry_after
+                    LOGGER.info('Draining outbox... Rate limited, retrying in %.3f seconds.',
+                                exception.retry_after)
+                    if Metrics.hooks:
+                        Metrics.count('outbox.rate_limited')
+                        Metrics.gauge('outbox.size', len(self.entries))
+                    return result
+                if hddo is not None:
+                    result.append(hddo)
+                    sent += 1
+            batches += 1
+            if sent == 0:
+                break
+            self.backoff = 0.0
+            if sent == len(batch):
+                self.batch_size = min(self.batch_size + 1, self.max_batch_size)
+        if Metrics.hooks:
+            Metrics.count('outbox.delivered', len(result))
+            Metrics.gauge('outbox.size', len(self.entries))
+        return result
+
+
+
+    def evict(self):
+
+        if self.size <= self.max_bytes:
+            return
+        # Objects of the lowest priority and latest deadline go first, the
+        # newest entry included.
+        for entry_id in reversed(self.order()):
+            if self.size <= self.max_bytes:
+                break
+            LOGGER.info('Outbox is full, dropping entry %s.', entry_id)
+            self.discard(entry_id)
+            if Metrics.hooks:
+                Metrics.count('outbox.evictions')
+
+
+
+    def forget(self, inner_hashes: list) -> int:
+
+        # Deleted objects don't need their hashBase any more.
+        inner_hashes = [inner_hash for inner_hash in dict.fromkeys(inner_hashes)
+                        if inner_hash in self.delivered]
+        if len(inner_hashes) == 0:
+            return 0
+        self.writeDelivered(b''.join(self.deliveryLine({'inner_hash' : inner_hash, 'forget' : True})
+                                     for inner_hash in inner_hashes))
+        for inner_hash in inner_hashes:
+            del self.delivered[inner_hash]
+        # The delivery and the tombstone
+        self.dead += 2 * len(inner_hashes)
+        if self.dead > len(self.delivered):
+            self.compact()
+        return len(inner_hashes)
+
+
+
+    def hashBase(self, inner_hash: str) -> str:
+
+        if self.vault is not None:
+            return self.vault.hashBase(inner_hash)
+        return self.delivered[inner_hash][1] if inner_hash in self.delivered else ''
+
+
+
+    def order(self) -> list:
+
+        return sorted(self.entries.keys(), key=lambda entry_id: (-self.entries[entry_id][0],
+                                                                 self.entries[entry_id][1],
+                                                                 entry_id))
+
+
+
+    def put(self, hddo, priority: int=0, deadline: float=None) -> int:
+
+        if not hddo.isClosed:
+            raise HDDOPermissionException('Tried to queue a non-closed HealthDominoDataObject.')
+        if hddo.isTransmitted:
+            raise HDDOPermissionException('Tried to queue a transmitted HealthDominoDataObject.')
+        if hddo.contentDigest in self.digests:
+            # The same reading is uploaded again before the first one is
+            # delivered.
+            if Metrics.hooks:
+                Metrics.count('outbox.duplicates')
+            return self.digests[hddo.contentDigest]
+        entry_id = self.next_id
+        self.next_id += 1
+        entry = {'id' : entry_id, 'priority' : priority,
+                 'deadline' : deadline if deadline is not None else float('inf'),
+                 'created' : time(), 'hddo' : hddo_to_record(hddo),
+                 'digest' : hddo.contentDigest, 'attempt' : None}
+        self.write(entry_id, entry)
+        self.evict()
+        return entry_id
+
+
+
+    def read(self, entry_id: int) -> dict:
+
+        with open(join(self.directory, Outbox.ENTRY_FORMAT.format(entry_id)), 'rb') as in_file:
+            return json.loads(decrypt_content(self.key, in_file.read()))
+
+
+
+    def send(self, entry_id: int, client):
+
+        entry = self.read(entry_id)
+        hddo = hddo_from_record(entry['hddo'])
+        attempt = entry['attempt']
+        if attempt is not None:
+            # The reply of an earlier attempt may be lost. The server answers
+            # the same transmission with the same outerHash.
+            hddo.reset_(hddo.pha, attempt['inner_hash'], '', attempt['hash_base'])
+            outer_hash = client.transmitHDDO(HealthDominoDataObject.toSendable(hddo),
+                                             attempt['transmission_id'].encode('utf-8'))
+            if outer_hash != '':
+                return self.deliver(entry_id, hddo, attempt['inner_hash'], outer_hash,
+                                    attempt['hash_base'])
+        transmission_id = ''
+        while transmission_id == '':
+            hash_base = b64encode(urandom(64)).decode('utf-8')
+            hddo.reset_(hddo.pha, '', '', hash_base)
+            inner_hash = hddo.computeHash()
+            transmission_id = client.prepareTransmission(inner_hash)
+        entry['attempt'] = {'hash_base' : hash_base, 'inner_hash' : inner_hash,
+                            'transmission_id' : transmission_id.decode('utf-8')}
+        self.write(entry_id, entry)
+        hddo.reset_(hddo.pha, inner_hash, '', hash_base)
+        outer_hash = client.transmitHDDO(HealthDominoDataObject.toSendable(hddo), transmission_id)
+        if outer_hash == '':
+            return None
+        return self.deliver(entry_id, hddo, inner_hash, outer_hash, hash_base)
+
+
+
+    def write(self, entry_id: int, entry: dict):
+
+        content = encrypt_content(self.key, json.dumps(entry).encode('utf-8'))
+        path = join(self.directory, Outbox.ENTRY_FORMAT.format(entry_id))
+        with open(path + '.tmp', 'wb') as out_file:
+            out_file.write(content)
+            out_file.flush()
+            fsync(out_file.fileno())
+        replace(path + '.tmp', path)
+        if entry_id in self.entries:
+            self.size -= self.entries[entry_id][2]
+        self.entries[entry_id] = (entry['priority'], entry['deadline'], len(content),
+                                  entry['digest'])
+        self.digests[entry['digest']] = entry_id
+        self.size += len(content)
+
+
+
+    def writeDelivered(self, content: bytes):
+
+        with open(join(self.directory, Outbox.DELIVERED), 'ab') as out_file:
+            out_file.write(content)
+            out_file.flush()
+            fsync(out_file.fileno())
+
+
+
+    def __len__(self) -> int:
+
+        return len(self.entries)
+
+
+
+def decrypt_content(key: bytes, content: bytes) -> bytes:
+
+    from Crypto.Cipher import AES
+    cipher = AES.new(key, AES.MODE_GCM, nonce=content[:12])
+    return cipher.decrypt_and_verify(content[28:], content[12:28])
+
+
+
+def encrypt_content(key: bytes, content: bytes) -> bytes:
+
+    from Crypto.Cipher import AES
+    cipher = AES.new(key, AES.MODE_GCM, nonce=urandom(12))
+    encrypted, tag = cipher.encrypt_and_digest(content)
+    return cipher.nonce + tag + encrypted
@@ -0,0 +1,122 @@
+"""
+HealthDomino
+============
+
+HealthDomino is a GDPR or HIPAA compatible data driven service, that helps
+the user to store, manage, share or use their own personal medical records or
+health data securely with the advantages of being anonymous or with revealed
+identity at the same time.
+
+WHY PYTHON?
+-----------
+We use Python for planning, modeling and prototyping purposes. We think Python
+code is much easier to read at the first time.
+
+The use of Python doesn't mean that we'll develop our production ready solution
+in Python or in Python only. We transform our solutions to C++ or Java quite
+often.
+
+THIS FILE
+---------
+This file contains the mock batch transmission pipeline of the App. Repeated
+uploads of the same reading are dropped first, then the preparation of a batch
+(hashBase generation, toHashBase, SHA-256 and toSendable) is spread over a
+thread or a process pool, while reservation and transmission stay in order in
+the calling thread. Aside of the expected behavior nothing is well
+implemented.
+"""
+from base64 import b64encode
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from hddo import HDDOPermissionException, HealthDominoDataObject
+from mock_metrics import Metrics, timed
+from os import cpu_count, urandom
+
+
+
+@timed('pipeline.deduplicate')
+def deduplicate(hddos: list) -> list:
+
+    for hddo in hddos:
+        if not hddo.isClosed:
+            raise HDDOPermissionException('Tried to transmit a non-closed HealthDominoDataObject.')
+    # Closed objects are equal by their contentDigest, so the first of the
+    # byte-identical readings stands for all of them.
+    first = {}
+    return [first.setdefault(hddo, index) for index, hddo in enumerate(hddos)]
+
+
+
+@timed('pipeline.prepare')
+def prepare_batch(hddos: list, workers: int=0, use_processes: bool=False) -> list:
+
+    for hddo in hddos:
+        if not hddo.isClosed:
+            raise HDDOPermissionException('Tried to transmit a non-closed HealthDominoDataObject.')
+        if hddo.isTransmitted:
+            raise HDDOPermissionException('Tried to transmit a transmitted HealthDominoDataObject.')
+    if workers <= 0:
+        workers = cpu_count() or 1
+    if workers <= 1:
+        prepared = [prepare_one(hddo) for hddo in hddos]
+    else:
+        # Threads help as long as hashlib releases the GIL, that is on large
+        # payloads. Processes also run toHashBase in parallel but have to
+        # pickle every object both ways.
+        executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        with executor_class(max_workers=workers) as executor:
+            chunk_size = max(len(hddos) // (workers * 4), 1)
+            prepared = list(executor.map(prepare_one, hddos, chunksize=chunk_size))
+    result = []
+    for hddo, (hash_base, inner_hash, sendable) in zip(hddos, prepared):
+        hddo.reset_(hddo.pha, inner_hash, '', hash_base)
+        result.append(sendable)
+    return result
+
+
+
+def prepare_one(hddo) -> tuple:
+
+    hash_base, inner_hash = prepare_hash(hddo)
+    sendable = HealthDominoDataObject.toSendable(hddo)
+    sendable.reset_(hddo.pha, inner_hash, '')
+    return hash_base, inner_hash, sendable
+
+
+
+def prepare_hash(hddo) -> tuple:
+
+    hash_base = b64encode(urandom(64)).decode('utf-8')
+    return hash_base, hddo.computeHash(hash_base)
+
+
+
+@timed('pipeline.transmit')
+def transmit_batch(hddos: list, client=None, workers: int=0,
+                   use_processes: bool=False) -> list:
+
+    if client is None:
+        from mock_app import App as client
+    firsts = deduplicate(hddos)
+    unique = [hddo for index, hddo in enumerate(hddos) if firsts[index] == index]
+    sendables = prepare_batch(unique, workers, use_processes)
+    outer_hashes = []
+    retries = 0
+    for hddo, sendable in zip(unique, sendables):
+        transmission_id = client.prepareTransmission(hddo.innerHash)
+        while transmission_id == '':
+            # Taken innerHash, prepare this one again with a new hashBase.
+            hash_base, inner_hash = prepare_hash(hddo)
+            hddo.reset_(hddo.pha, inner_hash, '', hash_base)
+            sendable = HealthDominoDataObject.toSendable(hddo)
+            transmission_id = client.prepareTransmission(inner_hash)
+            retries += 1
+        outer_hash = client.transmitHDDO(sendable, transmission_id)
+        if outer_hash != '':
+            hddo.reset_(hddo.pha, hddo.innerHash, outer_hash, hddo.hashBase)
+        outer_hashes.append(outer_hash)
+    if Metrics.hooks:
+        Metrics.count('hddo.transmit.reservation_retries', retries)
+        Metrics.count('pipeline.duplicates', len(hddos) - len(unique))
+    # Dropped duplicates are not transmitted, like failed transmissions.
+    outer_hashes = iter(outer_hashes)
+    return [next(outer_hashes) if first == index else '' for index, first in enumerate(firsts)]
@@ -0,0 +1,337 @@
+"""
+HealthDomino
+============
+
+HealthDomino is a GDPR or HIPAA compatible data driven service, that helps
+the user to store, manage, share or use their own personal medical records or
+health data securely with the advantages of being anonymous or with revealed
+identity at the same time.
+
+WHY PYTHON?
+-----------
+We use Python for planning, modeling and prototyping purposes. We think Python
+code is much easier to read at the first time.
+
+The use of Python doesn't mean that we'll develop our production ready solution
+in Python or in Python only. We transform our solutions to C++ or Java quite
+often.
+
+THIS FILE
+---------
+This file contains the mock query functionality of the server. The index maps
+labels to time ordered RawData objects, so range queries don't have to iterate
+over every stored HealthDominoDataObject. The aggregator keeps running
+count, sum, mean, variance, min and max values of numeric data per label and
+time window. Aside of the expected behavior nothing is well implemented.
+"""
+from bisect import bisect_left, bisect_right
+from fractions import Fraction
+from hddo import RawData
+from math import isfinite
+
+
+
+class DataIndex(object):
+
+
+
+    # Per label: timestamps in ascending order and the (inner_hash, path) keys
+    # in the same order. Paths locate nested RawData objects in the top one.
+    label_keys = {}
+    label_timestamps = {}
+    inner_labels = {}
+    items = {}
+    # Function (inner_hash, path) -> RawData for released, cold objects.
+    resolver = None
+
+
+
+    @classmethod
+    def add(cls, inner_hash: str, data):
+
+        labels = []
+        # Walk first, so a failure leaves the index untouched.
+        for path, raw_data in list(walk_raw_data(data)):
+            key = (inner_hash, path)
+            timestamps = DataIndex.label_timestamps.setdefault(raw_data.label, [])
+            keys = DataIndex.label_keys.setdefault(raw_data.label, [])
+            position = bisect_right(timestamps, raw_data.timestamp)
+            timestamps.insert(position, raw_data.timestamp)
+            keys.insert(position, key)
+            DataIndex.items[key] = raw_data
+            labels.append((raw_data.label, raw_data.timestamp, path))
+        DataIndex.inner_labels[inner_hash] = labels
+
+
+
+    @classmethod
+    def clear(cls):
+
+        DataIndex.label_keys.clear()
+        DataIndex.label_timestamps.clear()
+        DataIndex.inner_labels.clear()
+        DataIndex.items.clear()
+
+
+
+    @classmethod
+    def labels(cls, prefix: str='') -> list:
+
+        return sorted(label for label in DataIndex.label_keys.keys()
+                      if label.startswith(prefix))
+
+
+
+    @classmethod
+    def query(cls, label: str, start=None, end=None):
+
+        for inner_hash, path in DataIndex.queryKeys(label, start, end):
+            raw_data = DataIndex.resolve(inner_hash, path)
+            if raw_data is not None:
+                yield raw_data
+
+
+
+    @classmethod
+    def queryBatches(cls, label: str, start=None, end=None,
+                     batch_size: int=1024):
+
+        batch = {'inner_hash' : [], 'timestamp' : [], 'value' : []}
+        for inner_hash, path in DataIndex.queryKeys(label, start, end):
+            raw_data = DataIndex.resolve(inner_hash, path)
+            if raw_data is None:
+                continue
+            batch['inner_hash'].append(inner_hash)
+            batch['timestamp'].append(raw_data.timestamp)
+            batch['value'].append(raw_data.value)
+            if len(batch['inner_hash']) >= batch_size:
+                yield batch
+                batch = {'inner_hash' : [], 'timestamp' : [], 'value' : []}
+        if len(batch['inner_hash']) > 0:
+            yield batch
+
+
+
+    @classmethod
+    def resolve(cls, inner_hash: str, path: tuple):
+
+        raw_data = DataIndex.items.get((inner_hash, path))
+        if raw_data is None and DataIndex.resolver is not None:
+            raw_data = DataIndex.resolver(inner_hash, path)
+        return raw_data
+
+
+
+    @classmethod
+    def queryKeys(cls, label: str, start=None, end=None) -> list:
+
+        if label not in DataIndex.label_keys:
+            return []
+        timestamps = DataIndex.label_timestamps[label]
+        low = 0 if start is None else bisect_left(timestamps, start)
+        high = len(timestamps) if end is None else bisect_right(timestamps, end)
+        return DataIndex.label_keys[label][low:high]
+
+
+
+    @classmethod
+    def release(cls, inner_hash: str):
+
+        for _, _, path in DataIndex.inner_labels.get(inner_hash, []):
+            DataIndex.items.pop((inner_hash, path), None)
+
+
+
+    @classmethod
+    def remove(cls, inner_hash: str):
+
+        for label, timestamp, path in DataIndex.inner_labels.pop(inner_hash, []):
+            key = (inner_hash, path)
+            timestamps = DataIndex.label_timestamps[label]
+            keys = DataIndex.label_keys[label]
+            position = bisect_left(timestamps, timestamp)
+            while keys[position] != key:
+                position += 1
+            del timestamps[position]
+            del keys[position]
+            DataIndex.items.pop(key, None)
+            if len(keys) == 0:
+                del DataIndex.label_timestamps[label]
+                del DataIndex.label_keys[label]
+
+
+
+def walk_raw_data(data, path: tuple=()):
+
+    # An explicit stack instead of recursion, RawData can be nested deeper
+    # than the recursion limit. Nodes come in the same preorder.
+    stack = [(path, data)]
+    while len(stack) > 0:
+        path, data = stack.pop()
+        if isinstance(data, RawData):
+            yield path, data
+            # Other values have no RawData in them, they stay undecoded.
+            if data.peekValue() != 'nested':
+                continue
+            value = data.value
+            if isinstance(value, RawData):
+                stack.append((path + (0,), value))
+            elif isinstance(value, (list, tuple)):
+                for position in range(len(value) - 1, -1, -1):
+                    stack.append((path + (position,), value[position]))
+
+
+
+class Aggregator(object):
+
+
+
+    # Label prefix -> (window size, window step) in seconds. The longest
+    # matching prefix is used. Equal size and step means tumbling windows.
+    windows = {'' : (3600, 3600)}
+    # Label -> pane start -> running aggregate. Panes are step long, sliding
+    # windows are merged from size / step consecutive panes.
+    panes = {}
+
+
+
+    @classmethod
+    def add(cls, data):
+
+        # Walk first, so a failure leaves the panes untouched.
+        values = [(raw_data, Fraction(raw_data.value)) for _, raw_data in walk_raw_data(data)
+                  if raw_data.peekValue() == 'number' and is_number(raw_data.value)]
+        for raw_data, value in values:
+            pane = Aggregator.pane(raw_data.label, raw_data.timestamp, True)
+            pane['count'] += 1
+            pane['sum'] += value
+            pane['sum_sq'] += value * value
+            if not pane['dirty']:
+                if pane['min'] is None or raw_data.value < pane['min']:
+                    pane['min'] = raw_data.value
+                if pane['max'] is None or raw_data.value > pane['max']:
+                    pane['max'] = raw_data.value
+
+
+
+    @classmethod
+    def clear(cls):
+
+        Aggregator.panes.clear()
+
+
+
+    @classmethod
+    def configure(cls, prefix: str, size: int, step: int=None):
+
+        if step is None:
+            step = size
+        if size % step != 0:
+            raise ValueError('Window size must be a multiple of window step.')
+        Aggregator.windows[prefix] = (size, step)
+        for label in list(Aggregator.panes.keys()):
+            if label.startswith(prefix):
+                del Aggregator.panes[label]
+                for raw_data in DataIndex.query(label):
+                    Aggregator.add(raw_data)
+
+
+
+    @classmethod
+    def pane(cls, label: str, timestamp: int, create: bool=False) -> dict:
+
+        _, step = Aggregator.window(label)
+        start = timestamp - timestamp % step
+        label_panes = Aggregator.panes.setdefault(label, {}) if create else Aggregator.panes.get(label, {})
+        if start not in label_panes:
+            if not create:
+                return None
+            label_panes[start] = {'count' : 0, 'sum' : Fraction(0),
+                                  'sum_sq' : Fraction(0), 'min' : None,
+                                  'max' : None, 'dirty' : False}
+        return label_panes[start]
+
+
+
+    @classmethod
+    def query(cls, label: str, start: int, end: int) -> list:
+
+        size, step = Aggregator.window(label)
+        label_panes = Aggregator.panes.get(label, {})
+        result = []
+        first = start - start % step
+        for window_start in range(first, end + 1, step):
+            window = {'start' : window_start, 'end' : window_start + size - 1,
+                      'count' : 0, 'sum' : Fraction(0), 'sum_sq' : Fraction(0),
+                      'min' : None, 'max' : None}
+            for pane_start in range(window_start, window_start + size, step):
+                pane = label_panes.get(pane_start)
+                if pane is None:
+                    continue
+                if pane['dirty']:
+                    Aggregator.refresh(label, pane_start, pane)
+                window['count'] += pane['count']
+                window['sum'] += pane['sum']
+                window['sum_sq'] += pane['sum_sq']
+                if window['min'] is None or pane['min'] < window['min']:
+                    window['min'] = pane['min']
+                if window['max'] is None or pane['max'] > window['max']:
+                    window['max'] = pane['max']
+            if window['count'] > 0:
+                mean = window['sum'] / window['count']
+                window['mean'] = float(mean)
+                window['variance'] = float(window['sum_sq'] / window['count'] - mean * mean)
+                window['sum'] = float(window['sum'])
+                del window['sum_sq']
+                result.append(window)
+        return result
+
+
+
+    @classmethod
+    def refresh(cls, label: str, pane_start: int, pane: dict):
+
+        _, step = Aggregator.window(label)
+        values = [raw_data.value for raw_data in DataIndex.query(label, pane_start, pane_start + step - 1)
+                  if is_number(raw_data.value)]
+        pane['min'] = min(values) if len(values) > 0 else None
+        pane['max'] = max(values) if len(values) > 0 else None
+        pane['dirty'] = False
+
+
+
+    @classmethod
+    def remove(cls, data):
+
+        for _, raw_data in walk_raw_data(data):
+            if raw_data.peekValue() == 'number' and is_number(raw_data.value):
+                pane = Aggregator.pane(raw_data.label, raw_data.timestamp)
+                if pane is None:
+                    continue
+                value = Fraction(raw_data.value)
+                pane['count'] -= 1
+                pane['sum'] -= value
+                pane['sum_sq'] -= value * value
+                if pane['count'] == 0:
+                    _, step = Aggregator.window(raw_data.label)
+                    del Aggregator.panes[raw_data.label][raw_data.timestamp - raw_data.timestamp % step]
+                elif raw_data.value == pane['min'] or raw_data.value == pane['max']:
+                    pane['dirty'] = True
+
+
+
+    @classmethod
+    def window(cls, label: str) -> tuple:
+
+        best = ''
+        for prefix in Aggregator.windows.keys():
+            if label.startswith(prefix) and len(prefix) >= len(best):
+                best = prefix
+        return Aggregator.windows[best]
+
+
+
+def is_number(value) -> bool:
+
+    # NaN and infinity can't be aggregated exactly.
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and isfinite(value)
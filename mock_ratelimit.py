@@ -0,0 +1,108 @@
+"""
+HealthDomino
+============
+
+HealthDomino is a GDPR or HIPAA compatible data driven service, that helps
+the user to store, manage, share or use their own personal medical records or
+health data securely with the advantages of being anonymous or with revealed
+identity at the same time.
+
+WHY PYTHON?
+-----------
+We use Python for planning, modeling and prototyping purposes. We think Python
+code is much easier to read at the first time.
+
+The use of Python doesn't mean that we'll develop our production ready solution
+in Python or in Python only. We transform our solutions to C++ or Java quite
+often.
+
+THIS FILE
+---------
+This file contains the mock admission control of the server. Every PHA and
+every transmission source has a token bucket, so a misbehaving device can't
+flood the reservations. A refused request gets the time after which a token
+is available again. Buckets of idle keys are full again after a while, so
+they are forgotten and memory only grows with the active keys. Aside of the
+expected behavior nothing is well implemented.
+"""
+from collections import OrderedDict
+from time import monotonic
+
+
+
+class TokenBucketLimiter(object):
+
+
+
+    def __init__(self, rate: float, burst: float, idle_seconds: float=0.0,
+                 clock=monotonic):
+
+        if rate <= 0.0 or burst < 1.0:
+            raise ValueError('Token bucket needs a positive rate and a burst of at least 1.')
+        self.rate = rate
+        self.burst = burst
+        # A bucket idle for burst / rate seconds is full again, so forgetting
+        # it changes nothing.
+        self.idle_seconds = max(idle_seconds, burst / rate)
+        self.clock = clock
+        # key -> [tokens, time of last update], least recently used first
+        self.buckets = OrderedDict()
+        self.limited = 0
+
+
+
+    def acquire(self, key, cost: float=1.0) -> float:
+
+        now = self.clock()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = [self.burst, now]
+            self.buckets[key] = bucket
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self.buckets.move_to_end(key)
+        self.evictIdle(now)
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            return 0.0
+        self.limited += 1
+        return (cost - bucket[0]) / self.rate
+
+
+
+    def clear(self):
+
+        self.buckets.clear()
+        self.limited = 0
+
+
+
+    def evictIdle(self, now: float=None) -> int:
+
+        if now is None:
+            now = self.clock()
+        limit = now - self.idle_seconds
+        buckets = self.buckets
+        evicted = 0
+        while len(buckets) > 0:
+            key, bucket = next(iter(buckets.items()))
+            if bucket[1] > limit:
+                break
+            del buckets[key]
+            evicted += 1
+        return evicted
+
+
+
+    def refund(self, key, cost: float=1.0):
+
+        bucket = self.buckets.get(key)
+        if bucket is not None:
+            bucket[0] = min(self.burst, bucket[0] + cost)
+
+
+
+    def __len__(self) -> int:
+
+        return len(self.buckets)
@@ -0,0 +1,338 @@
+"""
+HealthDomino
+============
+
+HealthDomino is a GDPR or HIPAA compatible data driven service, that helps
+the user to store, manage, share or use their own personal medical records or
+health data securely with the advantages of being anonymous or with revealed
+identity at the same time.
+
+WHY PYTHON?
+-----------
+We use Python for planning, modeling and prototyping purposes. We think Python
+code is much easier to read at the first time.
+
+The use of Python doesn't mean that we'll develop our production ready solution
+in Python or in Python only. We transform our solutions to C++ or Java quite
+often.
+
+THIS FILE
+---------
+This file contains the mock cold storage of the server. Objects that are not
+touched any more are sealed into immutable segment files. Segment files are
+memory-mapped and carry their own sorted innerHash index, so a cold object
+costs no Python memory until it is accessed. Deletions are tombstones that are
+dropped by compaction. Aside of the expected behavior nothing is well
+implemented.
+"""
+from hashlib import sha256
+import json
+from mmap import ACCESS_READ, mmap
+from mock_wal import hddo_from_record, hddo_to_record
+from os import fsync, listdir, makedirs, remove, replace
+from os.path import join
+from struct import calcsize, pack, unpack_from
+from threading import Event, Lock, Thread
+
+
+
+class Segment(object):
+
+
+
+    MAGIC = b'HDSG'
+    # Header: magic, format version, count.
+    HEADER = '>4sII'
+    # Index entry: key digest, offset, length.
+    ENTRY = '>32sQI'
+    # Footer: index offset, count, magic.
+    FOOTER = '>QI4s'
+
+
+
+    def __init__(self, path: str):
+
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap(self.file.fileno(), 0, access=ACCESS_READ)
+        footer_size = calcsize(Segment.FOOTER)
+        self.index_offset, self.count, magic = unpack_from(Segment.FOOTER, self.map,
+                                                           len(self.map) - footer_size)
+        if magic != Segment.MAGIC:
+            raise ValueError('File {} is not a HealthDomino segment.'.format(path))
+        self.entry_size = calcsize(Segment.ENTRY)
+        self.dead = 0
+
+
+
+    def close(self):
+
+        self.map.close()
+        self.file.close()
+
+
+
+    def entry(self, position: int) -> tuple:
+
+        return unpack_from(Segment.ENTRY, self.map, self.index_offset + position * self.entry_size)
+
+
+
+    def find(self, key: bytes) -> int:
+
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start = self.index_offset + middle * self.entry_size
+            current = self.map[start:start + 32]
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                return middle
+        return -1
+
+
+
+    def items(self):
+
+        for position in range(self.count):
+            key, offset, length = self.entry(position)
+            yield key, self.map[offset:offset + length]
+
+
+
+    def read(self, key: bytes):
+
+        position = self.find(key)
+        if position < 0:
+            return None
+        _, offset, length = self.entry(position)
+        return self.map[offset:offset + length]
+
+
+
+    @classmethod
+    def write(cls, path: str, items: list):
+
+        items = sorted(items, key=lambda item: item[0])
+        with open(path + '.tmp', 'wb') as out_file:
+            out_file.write(pack(Segment.HEADER, Segment.MAGIC, 1, len(items)))
+            offset = calcsize(Segment.HEADER)
+            entries = []
+            for key, content in items:
+                out_file.write(content)
+                entries.append(pack(Segment.ENTRY, key, offset, len(content)))
+                offset += len(content)
+            out_file.write(b''.join(entries))
+            out_file.write(pack(Segment.FOOTER, offset, len(items), Segment.MAGIC))
+            out_file.flush()
+            fsync(out_file.fileno())
+        replace(path + '.tmp', path)
+
+
+
+class SegmentStore(object):
+
+
+
+    SEGMENT_FORMAT = 'segment-{:08d}.seg'
+    TOMBSTONES = 'tombstones.log'
+
+
+
+    def __init__(self, directory: str, compaction_ratio: float=0.3):
+
+        makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.compaction_ratio = compaction_ratio
+        self.lock = Lock()
+        self.segments = []
+        self.tombstones = set()
+        self.next_id = 0
+        self.compactor = None
+        self.stop_event = Event()
+        for name in sorted(listdir(directory)):
+            if name.startswith('segment-') and name.endswith('.seg'):
+                self.segments.append(Segment(join(directory, name)))
+                self.next_id = int(name[8:16]) + 1
+        try:
+            with open(join(directory, SegmentStore.TOMBSTONES), 'r') as in_file:
+                for line in in_file:
+                    if line.strip() != '':
+                        self.tombstones.add(line.strip())
+        except FileNotFoundError:
+            pass
+        for inner_hash in self.tombstones:
+            segment = self.locate(inner_hash)
+            if segment is not None:
+                segment.dead += 1
+
+
+
+    def close(self):
+
+        self.stopCompaction()
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+            self.segments = []
+
+
+
+    def compact(self) -> int:
+
+        with self.lock:
+            selected = [segment for segment in self.segments
+                        if segment.count > 0 and segment.dead / segment.count >= self.compaction_ratio]
+            if len(selected) == 0:
+                return 0
+            tombstone_keys = {key_digest(inner_hash) : inner_hash for inner_hash in self.tombstones}
+            live = []
+            dropped = set()
+            for segment in selected:
+                for key, content in segment.items():
+                    if key in tombstone_keys:
+                        dropped.add(tombstone_keys[key])
+                    else:
+                        live.append((key, bytes(content)))
+            new_segments = [segment for segment in self.segments if segment not in selected]
+            if len(live) > 0:
+                path = join(self.directory, SegmentStore.SEGMENT_FORMAT.format(self.next_id))
+                self.next_id += 1
+                Segment.write(path, live)
+                new_segments.append(Segment(path))
+            self.segments = new_segments
+            self.tombstones -= dropped
+            self.writeTombstones()
+        for segment in selected:
+            segment.close()
+            remove(segment.path)
+        return len(dropped)
+
+
+
+    def contains(self, inner_hash: str) -> bool:
+
+        with self.lock:
+            return inner_hash not in self.tombstones and self.locate(inner_hash) is not None
+
+
+
+    def delete(self, inner_hash: str) -> bool:
+
+        with self.lock:
+            segment = self.locate(inner_hash)
+            if segment is None or inner_hash in self.tombstones:
+                return False
+            self.tombstones.add(inner_hash)
+            segment.dead += 1
+            with open(join(self.directory, SegmentStore.TOMBSTONES), 'a') as out_file:
+                out_file.write(inner_hash + '\n')
+                out_file.flush()
+                fsync(out_file.fileno())
+        return True
+
+
+
+    def get(self, inner_hash: str):
+
+        key = key_digest(inner_hash)
+        with self.lock:
+            if inner_hash in self.tombstones:
+                return None
+            for segment in reversed(self.segments):
+                content = segment.read(key)
+                if content is not None:
+                    break
+            else:
+                return None
+        return hddo_from_record(json.loads(content))
+
+
+
+    def innerHashes(self):
+
+        with self.lock:
+            contents = [bytes(content) for segment in self.segments
+                        for _, content in segment.items()]
+        for content in contents:
+            inner_hash = json.loads(content)['inner_hash']
+            if inner_hash not in self.tombstones:
+                yield inner_hash
+
+
+
+    def locate(self, inner_hash: str):
+
+        key = key_digest(inner_hash)
+        for segment in reversed(self.segments):
+            if segment.find(key) >= 0:
+                return segment
+        return None
+
+
+
+    def seal(self, hddos: list):
+
+        if len(hddos) == 0:
+            return
+        items = [(key_digest(hddo.innerHash),
+                  json.dumps(hddo_to_record(hddo), separators=(',', ':')).encode('utf-8'))
+                 for hddo in hddos]
+        with self.lock:
+            path = join(self.directory, SegmentStore.SEGMENT_FORMAT.format(self.next_id))
+            self.next_id += 1
+            Segment.write(path, items)
+            self.segments.append(Segment(path))
+
+
+
+    def size(self) -> int:
+
+        return sum(segment.count - segment.dead for segment in self.segments)
+
+
+
+    def startCompaction(self, interval_seconds: float=60.0):
+
+        if self.compactor is None:
+            self.stop_event.clear()
+            self.compactor = Thread(target=self.compactionLoop,
+                                    args=(interval_seconds,), daemon=True)
+            self.compactor.start()
+
+
+
+    def compactionLoop(self, interval_seconds: float):
+
+        while not self.stop_event.wait(interval_seconds):
+            self.compact()
+
+
+
+    def stopCompaction(self):
+
+        if self.compactor is not None:
+            self.stop_event.set()
+            self.compactor.join()
+            self.compactor = None
+
+
+
+    def writeTombstones(self):
+
+        path = join(self.directory, SegmentStore.TOMBSTONES)
+        with open(path + '.tmp', 'w') as out_file:
+            for inner_hash in self.tombstones:
+                out_file.write(inner_hash + '\n')
+            out_file.flush()
+            fsync(out_file.fileno())
+        replace(path + '.tmp', path)
+
+
+
+def key_digest(inner_hash: str) -> bytes:
+
+    return sha256(inner_hash.encode('utf-8')).digest()
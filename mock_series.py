@@ -0,0 +1,380 @@
+"""
+HealthDomino
+============
+
+HealthDomino is a GDPR or HIPAA compatible data driven service, that helps
+the user to store, manage, share or use their own personal medical records or
+health data securely with the advantages of being anonymous or with revealed
+identity at the same time.
+
+WHY PYTHON?
+-----------
+We use Python for planning, modeling and prototyping purposes. We think Python
+code is much easier to read at the first time.
+
+The use of Python doesn't mean that we'll develop our production ready solution
+in Python or in Python only. We transform our solutions to C++ or Java quite
+often.
+
+THIS FILE
+---------
+This file contains the mock series storage functionality of the server.
+Numeric data points that share a series signature are stored in compressed
+blocks: timestamps are delta-of-delta encoded, values are XOR encoded like in
+Facebook's Gorilla paper. The store is a secondary index: the stored objects
+of the server are the source of truth, it isn't logged or snapshotted, recovery
+rebuilds it from the objects. Aside of the expected behavior nothing is well
+implemented.
+"""
+from heapq import merge
+from struct import pack, unpack
+
+
+
+class BitWriter(object):
+
+
+
+    def __init__(self):
+
+        self.buffer = bytearray()
+        self.word = 0
+        self.word_bits = 0
+
+
+
+    def getBytes(self) -> bytes:
+
+        result = bytearray(self.buffer)
+        if self.word_bits > 0:
+            result.append((self.word << (8 - self.word_bits)) & 0xff)
+        return bytes(result)
+
+
+
+    def write(self, value: int, bits: int):
+
+        self.word = (self.word << bits) | (value & ((1 << bits) - 1))
+        self.word_bits += bits
+        while self.word_bits >= 8:
+            self.word_bits -= 8
+            self.buffer.append((self.word >> self.word_bits) & 0xff)
+        self.word &= (1 << self.word_bits) - 1
+
+
+
+class BitReader(object):
+
+
+
+    def __init__(self, data: bytes):
+
+        self.data = data
+        self.position = 0
+
+
+
+    def read(self, bits: int) -> int:
+
+        result = 0
+        while bits > 0:
+            byte_index, bit_index = divmod(self.position, 8)
+            available = 8 - bit_index
+            taken = available if available < bits else bits
+            byte = self.data[byte_index]
+            chunk = (byte >> (available - taken)) & ((1 << taken) - 1)
+            result = (result << taken) | chunk
+            self.position += taken
+            bits -= taken
+        return result
+
+
+
+    def readSigned(self, bits: int) -> int:
+
+        value = self.read(bits)
+        if value >= 1 << (bits - 1):
+            value -= 1 << bits
+        return value
+
+
+
+class SeriesBlock(object):
+
+
+
+    # Bucket prefixes and widths of delta-of-delta timestamp encoding.
+    DOD_BUCKETS = [(0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12)]
+
+
+
+    def __init__(self, label: str):
+
+        self.label = label
+        self.encoded = b''
+        self.inner_hashes = []
+        self.is_int = True
+        # Timestamps of the first and the last point
+        self.first = None
+        self.last = None
+
+
+
+    @classmethod
+    def encode(cls, points: list) -> bytes:
+
+        writer = BitWriter()
+        if len(points) == 0:
+            return writer.getBytes()
+        first_timestamp, first_value = points[0]
+        writer.write(first_timestamp, 64)
+        previous_bits = float_bits(first_value)
+        writer.write(previous_bits, 64)
+        previous_timestamp = first_timestamp
+        previous_delta = 0
+        leading, trailing = 65, 0
+        for timestamp, value in points[1:]:
+            delta = timestamp - previous_timestamp
+            dod = delta - previous_delta
+            if dod == 0:
+                writer.write(0, 1)
+            else:
+                for prefix, prefix_bits, value_bits in SeriesBlock.DOD_BUCKETS:
+                    if -(1 << (value_bits - 1)) <= dod < 1 << (value_bits - 1):
+                        writer.write(prefix, prefix_bits)
+                        writer.write(dod, value_bits)
+                        break
+                else:
+                    writer.write(0b1111, 4)
+                    writer.write(dod, 64)
+            previous_delta = delta
+            previous_timestamp = timestamp
+            value_bits = float_bits(value)
+            xor = value_bits ^ previous_bits
+            previous_bits = value_bits
+            if xor == 0:
+                writer.write(0, 1)
+                continue
+            writer.write(1, 1)
+            new_leading = min(64 - xor.bit_length(), 31)
+            new_trailing = (xor & -xor).bit_length() - 1
+            if leading <= new_leading and trailing <= new_trailing:
+                writer.write(0, 1)
+                writer.write(xor >> trailing, 64 - leading - trailing)
+            else:
+                leading, trailing = new_leading, new_trailing
+                meaningful = 64 - leading - trailing
+                writer.write(1, 1)
+                writer.write(leading, 5)
+                writer.write(meaningful - 1, 6)
+                writer.write(xor >> trailing, meaningful)
+        return writer.getBytes()
+
+
+
+    @classmethod
+    def decode(cls, encoded: bytes, count: int) -> list:
+
+        if count == 0:
+            return []
+        reader = BitReader(encoded)
+        timestamp = reader.readSigned(64)
+        value_bits = reader.read(64)
+        result = [(timestamp, value_bits)]
+        delta = 0
+        leading, trailing = 0, 0
+        for _ in range(count - 1):
+            if reader.read(1) == 0:
+                dod = 0
+            elif reader.read(1) == 0:
+                dod = reader.readSigned(7)
+            elif reader.read(1) == 0:
+                dod = reader.readSigned(9)
+            elif reader.read(1) == 0:
+                dod = reader.readSigned(12)
+            else:
+                dod = reader.readSigned(64)
+            delta += dod
+            timestamp += delta
+            if reader.read(1) == 1:
+                if reader.read(1) == 1:
+                    leading = reader.read(5)
+                    meaningful = reader.read(6) + 1
+                    trailing = 64 - leading - meaningful
+                value_bits ^= reader.read(64 - leading - trailing) << trailing
+            result.append((timestamp, value_bits))
+        return [(timestamp, bits_float(bits)) for timestamp, bits in result]
+
+
+
+    def points(self) -> list:
+
+        points = SeriesBlock.decode(self.encoded, len(self.inner_hashes))
+        if self.is_int:
+            points = [(timestamp, int(value)) for timestamp, value in points]
+        return points
+
+
+
+    def setPoints(self, points: list, inner_hashes: list):
+
+        self.is_int = all(isinstance(value, int) for _, value in points)
+        self.encoded = SeriesBlock.encode(points)
+        self.inner_hashes = list(inner_hashes)
+        self.first = points[0][0]
+        self.last = points[-1][0]
+
+
+
+class SeriesStore(object):
+
+
+
+    BLOCK_SIZE = 1024
+
+
+
+    # Series key (signature, label) -> sealed blocks and the open tail.
+    series = {}
+    # innerHash -> (series key, block or None for the tail)
+    locations = {}
+
+
+
+    @classmethod
+    def append(cls, signature: str, label: str, inner_hash: str,
+               timestamp: int, value):
+
+        key = (signature, label)
+        if key not in SeriesStore.series:
+            SeriesStore.series[key] = {'blocks' : [], 'tail' : [],
+                                       'tail_hashes' : []}
+        entry = SeriesStore.series[key]
+        tail = entry['tail']
+        if len(tail) > 0 and timestamp < tail[-1][0]:
+            # Late points are rare in device streams. Keep the tail ordered.
+            position = len(tail)
+            while position > 0 and tail[position - 1][0] > timestamp:
+                position -= 1
+            tail.insert(position, (timestamp, value))
+            entry['tail_hashes'].insert(position, inner_hash)
+        else:
+            tail.append((timestamp, value))
+            entry['tail_hashes'].append(inner_hash)
+        SeriesStore.locations[inner_hash] = (key, None)
+        if len(tail) >= SeriesStore.BLOCK_SIZE:
+            SeriesStore.seal(key)
+
+
+
+    @classmethod
+    def clear(cls):
+
+        SeriesStore.series.clear()
+        SeriesStore.locations.clear()
+
+
+
+    @classmethod
+    def encodedSize(cls) -> int:
+
+        result = 0
+        for entry in SeriesStore.series.values():
+            for block in entry['blocks']:
+                result += len(block.encoded)
+            result += 16 * len(entry['tail'])
+        return result
+
+
+
+    @classmethod
+    def remove(cls, inner_hash: str) -> bool:
+
+        if inner_hash not in SeriesStore.locations:
+            return False
+        key, block = SeriesStore.locations.pop(inner_hash)
+        entry = SeriesStore.series[key]
+        if block is None:
+            position = entry['tail_hashes'].index(inner_hash)
+            del entry['tail'][position]
+            del entry['tail_hashes'][position]
+        else:
+            position = block.inner_hashes.index(inner_hash)
+            points = block.points()
+            hashes = block.inner_hashes
+            del points[position]
+            del hashes[position]
+            if len(points) > 0:
+                block.setPoints(points, hashes)
+            else:
+                entry['blocks'].remove(block)
+        if len(entry['blocks']) == 0 and len(entry['tail']) == 0:
+            del SeriesStore.series[key]
+        return True
+
+
+
+    @classmethod
+    def runPoints(cls, entry: dict, block):
+
+        if block is None:
+            return zip(entry['tail'], entry['tail_hashes'])
+        return zip(block.points(), block.inner_hashes)
+
+
+
+    @classmethod
+    def scan(cls, signature: str, label: str, start=None, end=None):
+
+        entry = SeriesStore.series.get((signature, label))
+        if entry is None:
+            return
+        # Every block and the tail is ordered, but a late point can be older
+        # than the points of a sealed block. Overlapping runs are merged, the
+        # others are read one after the other, so few blocks are decoded at
+        # the same time.
+        runs = [(block.first, block.last, block) for block in entry['blocks']]
+        if len(entry['tail']) > 0:
+            runs.append((entry['tail'][0][0], entry['tail'][-1][0], None))
+        runs.sort(key=lambda run: run[0])
+        groups = []
+        for first, last, block in runs:
+            if len(groups) > 0 and first <= groups[-1][1]:
+                groups[-1][1] = max(groups[-1][1], last)
+                groups[-1][2].append(block)
+            else:
+                groups.append([first, last, [block]])
+        for first, last, blocks in groups:
+            if (start is not None and last < start) or (end is not None and first > end):
+                continue
+            points = [SeriesStore.runPoints(entry, block) for block in blocks]
+            points = points[0] if len(points) == 1 else merge(*points, key=lambda point: point[0][0])
+            for (timestamp, value), inner_hash in points:
+                if (start is None or timestamp >= start) and (end is None or timestamp <= end):
+                    yield inner_hash, timestamp, value
+
+
+
+    @classmethod
+    def seal(cls, key: tuple):
+
+        entry = SeriesStore.series[key]
+        block = SeriesBlock(key[1])
+        block.setPoints(entry['tail'], entry['tail_hashes'])
+        entry['blocks'].append(block)
+        for inner_hash in block.inner_hashes:
+            SeriesStore.locations[inner_hash] = (key, block)
+        entry['tail'] = []
+        entry['tail_hashes'] = []
+
+
+
+def bits_float(bits: int) -> float:
+
+    return unpack('>d', pack('>Q', bits))[0]
+
+
+
+def float_bits(value) -> int:
+
+    return unpack('>Q', pack('>d', float(value)))[0]
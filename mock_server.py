@@ -21,99 +21,445 @@ THIS FILE
 This file contains the mock server functionality. Aside of the expected behavior
 nothing is well implemented.
 """
-from base64 import b64encode
-from copy import deepcopy
-from hashlib import sha256
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from hddo import HDDORateLimitException, RawData
+from logging import INFO
+from mock_bloom import CountingBloomFilter
+from mock_broadcast import BroadcastRegistry, ScriptCache, Subscription
+from mock_custody import CustodyStage, custody_from_record, custody_to_record
+from mock_merkle import MerkleTree
+from mock_metrics import Metrics, timed
+from mock_other import get_logger
+from mock_query import Aggregator, DataIndex, is_number, walk_raw_data
+from mock_ratelimit import TokenBucketLimiter
+from mock_series import SeriesStore
+from mock_wal import hddo_from_record, hddo_to_record
 from os import urandom
 
 
 
+LOGGER = get_logger('Server')
+
+
+
 class Server(object):
 
 
 
     # Those dictionaries represent databases. They can be stored on different nodes.
+    # innerHash -> (transmission_id, outerHash) of recent accepts, so a
+    # client that lost the reply can repeat the transmission safely.
+    hddo_accepted = OrderedDict()
+    ACCEPTED_LIMIT = 100000
+    # innerHash -> wrapped encoding key, encryption key and re-encrypted data
+    # of the objects protected by the custody stage.
+    hddo_encoding_keys = {}
+    hddo_encryption_keys = {}
     hddo_inner = {}
     hddo_nounces = {}
     hddo_outer = {}
+    hddo_reencrypted = {}
     hddo_reserved = {}
     users = {}
+    # Numeric data of objects with series signature is also kept compressed.
+    series_storage = False
+    # Optional WriteAheadLog to make every mutation durable.
+    wal = None
+    # Optional SegmentStore holding sealed, cold objects of hddo_inner.
+    cold_store = None
+    # Optional counting Bloom filters of the 'inner', 'outer' and 'reserved'
+    # stores to answer most negative lookups without touching the stores.
+    filters = {}
+    # Optional Merkle trees of the 'inner', 'nounces' and 'outer' stores for
+    # anti-entropy sync with replicas, see mock_merkle.sync_replicas.
+    trees = {}
+    # Broadcast subscriptions of the clients, sendBroadcast pushes to them.
+    broadcasts = BroadcastRegistry()
+    # Optional LRU cache of broadcast scripts by innerHash.
+    script_cache = None
+    # Optional CustodyStage protecting accepted objects in batches.
+    custody = None
+    # Optional token bucket limiters of reservations by 'pha' and by
+    # 'source', the client that transmits.
+    limiters = {}
 
 
 
     @classmethod
+    @timed('server.acceptHDDO')
     def acceptHDDO(cls, hddo, transmission_id):
 
-        print('[Server] Accepting HealthDominoDataObject... ', end='')
         result = ''
-        if hddo.innerHash in Server.hddo_reserved.keys():
+        if Server.isReserved(hddo.innerHash):
             if transmission_id == Server.hddo_reserved[hddo.innerHash]:
-                print('Success.')
+                LOGGER.info('Accepting HealthDominoDataObject %s... Success.', hddo.innerHash)
                 nounce = urandom(64)
-                outer_hash = sha256(hddo.toHashable() +  nounce).hexdigest()
-                while outer_hash in Server.hddo_outer.keys():
+                outer_hash = hddo.computeHash(suffix=nounce)
+                retries = 0
+                while Server.isOuterStored(outer_hash):
                     nounce = urandom(64)
-                    outer_hash = sha256(hddo.toHashable() +  nounce).hexdigest()
-                Server.hddo_nounces[hddo.innerHash] = nounce
-                Server.hddo_outer[outer_hash] = hddo.innerHash
-                Server.hddo_inner[hddo.innerHash] = hddo
-                del Server.hddo_reserved[hddo.innerHash]
+                    outer_hash = hddo.computeHash(suffix=nounce)
+                    retries += 1
+                if Server.wal is not None:
+                    Server.wal.append({'type' : 'accept', 'hddo' : hddo_to_record(hddo),
+                                       'outer_hash' : outer_hash,
+                                       'nounce' : b64encode(nounce).decode('utf-8'),
+                                       'transmission_id' : transmission_id.decode('utf-8')})
+                Server.storeHDDO(hddo, outer_hash, nounce)
+                Server.rememberAccepted(hddo.innerHash, transmission_id, outer_hash)
+                if Server.custody is not None and Server.custody.put(hddo.innerHash, hddo.pha,
+                                                                     hddo.data.toJSON()):
+                    Server.flushCustody()
                 result = outer_hash
+                if Metrics.hooks:
+                    Metrics.count('server.acceptHDDO.nounce_retries', retries)
+                    Server.reportStoreSizes()
             else:
-                print('Failed because of bad transmission_id.')
+                LOGGER.info('Accepting HealthDominoDataObject %s... Failed because of bad transmission_id.', hddo.innerHash)
+        elif hddo.innerHash in Server.hddo_accepted:
+            accepted_id, outer_hash = Server.hddo_accepted[hddo.innerHash]
+            if transmission_id == accepted_id:
+                LOGGER.info('Accepting HealthDominoDataObject %s... Already accepted.', hddo.innerHash)
+                result = outer_hash
+                if Metrics.hooks:
+                    Metrics.count('server.acceptHDDO.replays')
+            else:
+                LOGGER.info('Accepting HealthDominoDataObject %s... Failed because of bad transmission_id.', hddo.innerHash)
         else:
-            print('Failed because transmission is not prepared.')
+            LOGGER.info('Accepting HealthDominoDataObject %s... Failed because transmission is not prepared.', hddo.innerHash)
         return result
 
 
 
 
     @classmethod
+    @timed('server.createAccountIfAvailable')
     def createAccountIfAvailable(cls, account_pha, account_public_key):
 
-        print('[Server] Checking PHA availability... ', end='')
         result = account_pha not in Server.users.keys()
         if result:
-            print('Success.')
+            if Server.wal is not None:
+                Server.wal.append({'type' : 'account', 'pha' : account_pha,
+                                   'public_key' : account_public_key.decode('utf-8')})
             Server.users[account_pha] = account_public_key
-            print('[Server] Account "{}" registered succefully.'.format(account_pha))
+            if Metrics.hooks:
+                Server.reportStoreSizes()
+            LOGGER.info('Checking PHA availability... Success.')
+            LOGGER.info('Account "%s" registered succefully.', account_pha)
         else:
-            print('Failed.')
+            LOGGER.info('Checking PHA availability... Failed.')
         return result
 
 
 
     @classmethod
+    @timed('server.deleteHDDO')
     def deleteHDDO(cls, hddo, hash_base):
 
         result = False
-        print('[Server] Searching for HealthDominoDataObject... ', end='')
-        if hddo.innerHash in Server.hddo_inner.keys():
-            print('Success.')
-            print('[Server] Comparing HealthDominoDataObjects... ', end='')
-            if hddo.toHashable() == Server.hddo_inner[hddo.innerHash].toHashable():
-                print('Success.')
-                print('[Server] Validating hashBase... ', end='')
-                base_str = '{}{}'.format(hash_base, Server.hddo_inner[hddo.innerHash].toHashBase())
-                test_inner_hash = sha256(base_str.encode('utf-8')).hexdigest()
-                if test_inner_hash == Server.hddo_inner[hddo.innerHash].innerHash:
-                    print('Success.')
-                    print('[Server] Deleting HealthDominoDataObject occurences... ', end='')
-                    del Server.hddo_nounces[hddo.innerHash]
-                    del Server.hddo_inner[hddo.innerHash]
-                    del Server.hddo_outer[hddo.outerHash]
-                    print('Finished.')
+        stored = Server.getStoredHDDO(hddo.innerHash)
+        # The outerHash is sent by the client, it must belong to the object
+        # before anything is logged or removed.
+        if stored is not None and Server.hddo_outer.get(hddo.outerHash) == hddo.innerHash:
+            LOGGER.info('Searching for HealthDominoDataObject %s... Success.', hddo.innerHash)
+            if hddo.innerHash in Server.hddo_reencrypted:
+                # The data of a protected object is withheld, the copy of the
+                # client has to give the stored innerHash instead.
+                stored = hddo
+            if hddo.computeHash() == stored.computeHash():
+                LOGGER.info('Comparing HealthDominoDataObjects... Success.')
+                test_inner_hash = stored.computeHash(hash_base)
+                if test_inner_hash == stored.innerHash:
+                    LOGGER.info('Validating hashBase... Success.')
+                    if Server.wal is not None:
+                        Server.wal.append({'type' : 'delete', 'inner_hash' : hddo.innerHash,
+                                           'outer_hash' : hddo.outerHash})
+                    Server.removeHDDO(hddo.innerHash, hddo.outerHash)
+                    if Metrics.hooks:
+                        Server.reportStoreSizes()
+                    LOGGER.info('Deleting HealthDominoDataObject occurences... Finished.')
                     result = True
                 else:
-                    print('Failed.')
+                    LOGGER.info('Validating hashBase... Failed.')
             else:
-                print('Failed.')
+                LOGGER.info('Comparing HealthDominoDataObjects... Failed.')
         else:
-            print('Failed.')
+            LOGGER.info('Searching for HealthDominoDataObject %s... Failed.', hddo.innerHash)
+        return result
+
+
+
+    @classmethod
+    @timed('server.deleteHDDOs')
+    def deleteHDDOs(cls, requests: list) -> list:
+
+        # Each request is (innerHash, outerHash, hashBase). The hashBase
+        # alone proves the ownership, so the object itself is not needed.
+        # Protected objects have no data to hash, see deleteHDDO.
+        result = []
+        deleted = 0
+        last_lsn = 0
+        for inner_hash, outer_hash, hash_base in requests:
+            stored = Server.getStoredHDDO(inner_hash)
+            is_valid = stored is not None and Server.hddo_outer.get(outer_hash) == inner_hash
+            if is_valid:
+                is_valid = stored.computeHash(hash_base) == inner_hash
+            if is_valid:
+                # Every delete is applied right after it is logged, so a
+                # snapshot taken by a later append of the batch contains it.
+                if Server.wal is not None:
+                    last_lsn = Server.wal.append({'type' : 'delete', 'inner_hash' : inner_hash,
+                                                  'outer_hash' : outer_hash}, wait=False)
+                Server.removeHDDO(inner_hash, outer_hash)
+                deleted += 1
+            result.append(is_valid)
+        # One durable write for the whole batch before answering.
+        if Server.wal is not None and last_lsn > 0:
+            Server.wal.waitDurable(last_lsn)
+        LOGGER.info('Deleting %s of %s HealthDominoDataObjects... Finished.', deleted, len(requests))
+        if Metrics.hooks:
+            Metrics.count('server.deleteHDDOs.deleted', deleted)
+            Server.reportStoreSizes()
+        return result
+
+
+
+    @classmethod
+    def admit(cls, pha: str, source: str) -> float:
+
+        # A request without PHA is limited by its source only. Requests
+        # without source share the bucket of ''.
+        retry_after = 0.0
+        if pha != '':
+            retry_after = Server.limiters['pha'].acquire(pha)
+        if retry_after == 0.0:
+            retry_after = Server.limiters['source'].acquire(source)
+            if retry_after > 0.0 and pha != '':
+                Server.limiters['pha'].refund(pha)
+        return retry_after
+
+
+
+    @classmethod
+    def addReservation(cls, inner_hash: str, transmission_id: bytes):
+
+        is_new = inner_hash not in Server.hddo_reserved
+        # Stored first, so a rebuild of the filters includes it.
+        Server.hddo_reserved[inner_hash] = transmission_id
+        if is_new and 'reserved' in Server.filters:
+            Server.filters['reserved'].add(inner_hash)
+            if Server.filters['reserved'].isFull():
+                Server.enableFilters(2 * Server.filters['reserved'].capacity,
+                                     Server.filters['reserved'].error_rate)
+
+
+
+    @classmethod
+    def applyRecord(cls, record: dict):
+
+        if record['type'] == 'reserve':
+            Server.addReservation(record['inner_hash'], record['transmission_id'].encode('utf-8'))
+        elif record['type'] == 'accept':
+            Server.storeHDDO(hddo_from_record(record['hddo']), record['outer_hash'],
+                             b64decode(record['nounce']))
+            if 'transmission_id' in record:
+                Server.rememberAccepted(record['hddo']['inner_hash'],
+                                        record['transmission_id'].encode('utf-8'),
+                                        record['outer_hash'])
+        elif record['type'] == 'delete':
+            Server.removeHDDO(record['inner_hash'], record['outer_hash'])
+        elif record['type'] == 'seal':
+            Server.releaseSealed(record['inner_hashes'])
+        elif record['type'] == 'custody':
+            Server.storeCustody(custody_from_record(record['items']))
+        elif record['type'] == 'account':
+            Server.users[record['pha']] = record['public_key'].encode('utf-8')
+
+
+
+    @classmethod
+    def dropHDDO(cls, outer_hash: str):
+
+        inner_hash = Server.hddo_outer[outer_hash]
+        if Server.wal is not None:
+            Server.wal.append({'type' : 'delete', 'inner_hash' : inner_hash,
+                               'outer_hash' : outer_hash})
+        Server.removeHDDO(inner_hash, outer_hash)
+
+
+
+    @classmethod
+    def enableCustody(cls, batch_size: int=256, workers: int=0):
+
+        if Server.custody is not None:
+            Server.flushCustody()
+            Server.custody.close()
+        Server.custody = CustodyStage(batch_size, workers)
+
+
+
+    @classmethod
+    def enableFilters(cls, capacity: int=100000, error_rate: float=0.01):
+
+        capacity = max(capacity, 2 * len(Server.hddo_outer), 2 * len(Server.hddo_reserved))
+        filters = {'inner' : CountingBloomFilter(capacity, error_rate),
+                   'outer' : CountingBloomFilter(capacity, error_rate),
+                   'reserved' : CountingBloomFilter(capacity, error_rate)}
+        # hddo_outer maps to the innerHash of every stored object, also the
+        # cold ones, so there's no need to read the cold store.
+        for outer_hash, inner_hash in Server.hddo_outer.items():
+            filters['inner'].add(inner_hash)
+            filters['outer'].add(outer_hash)
+        for inner_hash in Server.hddo_reserved.keys():
+            filters['reserved'].add(inner_hash)
+        Server.filters = filters
+
+
+
+    @classmethod
+    def enableMerkle(cls, depth: int=12):
+
+        trees = {'inner' : MerkleTree(depth), 'nounces' : MerkleTree(depth),
+                 'outer' : MerkleTree(depth)}
+        for outer_hash, inner_hash in Server.hddo_outer.items():
+            trees['inner'].add(inner_hash)
+            trees['nounces'].add(inner_hash, Server.hddo_nounces[inner_hash].hex())
+            trees['outer'].add(outer_hash, inner_hash)
+        Server.trees = trees
+
+
+
+    @classmethod
+    def enableRateLimits(cls, pha_rate: float=10.0, pha_burst: float=100.0,
+                         source_rate: float=5.0, source_burst: float=50.0):
+
+        Server.limiters = {'pha' : TokenBucketLimiter(pha_rate, pha_burst),
+                           'source' : TokenBucketLimiter(source_rate, source_burst)}
+
+
+
+    @classmethod
+    def enableScriptCache(cls, max_bytes: int=16 * 2 ** 20):
+
+        Server.script_cache = ScriptCache(max_bytes)
+
+
+
+    @classmethod
+    def exportHDDO(cls, outer_hash: str) -> dict:
+
+        inner_hash = Server.hddo_outer[outer_hash]
+        return {'type' : 'accept', 'hddo' : hddo_to_record(Server.getStoredHDDO(inner_hash)),
+                'outer_hash' : outer_hash,
+                'nounce' : b64encode(Server.hddo_nounces[inner_hash]).decode('utf-8')}
+
+
+
+    @classmethod
+    @timed('server.flushCustody')
+    def flushCustody(cls) -> int:
+
+        if Server.custody is None or len(Server.custody) == 0:
+            return 0
+        records = Server.custody.protect(Server.users)
+        if Server.wal is not None and len(records) > 0:
+            Server.wal.append({'type' : 'custody', 'items' : custody_to_record(records)})
+        Server.storeCustody(records)
+        if Metrics.hooks:
+            Metrics.count('server.custody.protected', len(records))
+            Server.reportStoreSizes()
+        return len(records)
+
+
+
+    @classmethod
+    def getState(cls) -> dict:
+
+        outer_hashes = {inner_hash : outer_hash for outer_hash, inner_hash in Server.hddo_outer.items()}
+        return {'accepted' : [[inner_hash, transmission_id.decode('utf-8'), outer_hash]
+                              for inner_hash, (transmission_id, outer_hash) in Server.hddo_accepted.items()],
+                'hddo' : [[hddo_to_record(Server.getStoredHDDO(inner_hash)), outer_hashes[inner_hash],
+                           b64encode(Server.hddo_nounces[inner_hash]).decode('utf-8')]
+                          for inner_hash in Server.storedInnerHashes()],
+                # Sealed objects are in the cold store, recovery only keeps
+                # their records if there is no cold store to read them from.
+                'cold' : [inner_hash for inner_hash in Server.storedInnerHashes()
+                          if inner_hash not in Server.hddo_inner],
+                'custody' : custody_to_record((inner_hash, reencrypted,
+                                               Server.hddo_encoding_keys[inner_hash],
+                                               Server.hddo_encryption_keys[inner_hash])
+                                              for inner_hash, reencrypted in Server.hddo_reencrypted.items()),
+                'reserved' : {inner_hash : transmission_id.decode('utf-8')
+                              for inner_hash, transmission_id in Server.hddo_reserved.items()},
+                'users' : {pha : public_key.decode('utf-8')
+                           for pha, public_key in Server.users.items()}}
+
+
+
+    @classmethod
+    def getStoredHDDO(cls, inner_hash: str):
+
+        result = Server.hddo_inner.get(inner_hash)
+        if result is None and Server.cold_store is not None:
+            result = Server.cold_store.get(inner_hash)
+        return result
+
+
+
+    @classmethod
+    def isOuterStored(cls, outer_hash: str) -> bool:
+
+        return Server.probe('outer', outer_hash, Server.hddo_outer.__contains__)
+
+
+
+    @classmethod
+    def isReserved(cls, inner_hash: str) -> bool:
+
+        return Server.probe('reserved', inner_hash, Server.hddo_reserved.__contains__)
+
+
+
+    @classmethod
+    def isStored(cls, inner_hash: str) -> bool:
+
+        return Server.probe('inner', inner_hash, Server.lookupStored)
+
+
+
+    @classmethod
+    def lookupStored(cls, inner_hash: str) -> bool:
+
+        if inner_hash in Server.hddo_inner:
+            return True
+        return Server.cold_store is not None and Server.cold_store.contains(inner_hash)
+
+
+
+    @classmethod
+    def probe(cls, name: str, key: str, lookup) -> bool:
+
+        bloom = Server.filters.get(name)
+        if bloom is None:
+            return lookup(key)
+        if not bloom.mightContain(key):
+            return False
+        result = lookup(key)
+        bloom.record(result)
         return result
 
 
 
+    @classmethod
+    def importHDDO(cls, record: dict):
+
+        if Server.wal is not None:
+            Server.wal.append(record)
+        Server.applyRecord(record)
+
+
+
     @classmethod
     def isValidUser(cls, account_pha):
 
@@ -122,32 +468,373 @@ class Server(object):
 
 
     @classmethod
-    def reserveIfAvailable(cls, inner_hash):
+    def aggregateData(cls, label: str, start: int, end: int) -> list:
+
+        return Aggregator.query(label, start, end)
+
+
+
+    @classmethod
+    def merkleBucket(cls, name: str, bucket: int) -> dict:
+
+        return Server.trees[name].buckets[bucket]
+
+
+
+    @classmethod
+    def merkleTree(cls, name: str):
+
+        return Server.trees[name]
+
+
+
+    @classmethod
+    def queryData(cls, label: str, start=None, end=None):
+
+        return DataIndex.query(label, start, end)
+
+
+
+    @classmethod
+    def receiveBroadcasts(cls, subscription_id: int, max_count: int=64) -> list:
+
+        return Server.broadcasts.take(subscription_id, max_count)
+
+
+
+    @classmethod
+    def recover(cls, wal):
+
+        state, records = wal.recover()
+        Server.reset()
+        if state is not None:
+            for record, outer_hash, nounce in state['hddo']:
+                Server.storeHDDO(hddo_from_record(record), outer_hash, b64decode(nounce))
+            for inner_hash, transmission_id in state['reserved'].items():
+                Server.addReservation(inner_hash, transmission_id.encode('utf-8'))
+            for pha, public_key in state['users'].items():
+                Server.users[pha] = public_key.encode('utf-8')
+            # Replay protection of the transmissions accepted lately.
+            for inner_hash, transmission_id, outer_hash in state.get('accepted', []):
+                Server.rememberAccepted(inner_hash, transmission_id.encode('utf-8'), outer_hash)
+            Server.releaseSealed(state.get('cold', []))
+            Server.storeCustody(custody_from_record(state.get('custody', [])))
+        for record in records:
+            Server.applyRecord(record)
+        wal.snapshot_provider = Server.getState
+        Server.wal = wal
+        if Server.custody is not None:
+            # Objects accepted but not protected before the restart.
+            for inner_hash in Server.storedInnerHashes():
+                if inner_hash not in Server.hddo_reencrypted:
+                    stored = Server.getStoredHDDO(inner_hash)
+                    Server.custody.put(inner_hash, stored.pha, stored.data.toJSON())
+        return len(records)
+
+
+
+    @classmethod
+    def rememberAccepted(cls, inner_hash: str, transmission_id: bytes, outer_hash: str):
+
+        Server.hddo_accepted[inner_hash] = (transmission_id, outer_hash)
+        if len(Server.hddo_accepted) > Server.ACCEPTED_LIMIT:
+            Server.hddo_accepted.popitem(last=False)
+
+
+
+    @classmethod
+    def releaseSealed(cls, inner_hashes: list):
+
+        # Only objects that made it into the cold store lose their hot copy,
+        # a seal interrupted by a crash leaves them hot.
+        if Server.cold_store is None:
+            return
+        for inner_hash in inner_hashes:
+            if inner_hash in Server.hddo_inner and Server.cold_store.contains(inner_hash):
+                del Server.hddo_inner[inner_hash]
+                DataIndex.release(inner_hash)
+
+
+
+    @classmethod
+    def removeHDDO(cls, inner_hash: str, outer_hash: str):
+
+        stored = Server.hddo_inner.pop(inner_hash, None)
+        if Server.cold_store is not None:
+            if stored is None:
+                stored = Server.cold_store.get(inner_hash)
+            # A sealed object may have a hot copy as well, the cold one is
+            # always tombstoned.
+            Server.cold_store.delete(inner_hash)
+        stored_data = stored.data
+        del Server.hddo_nounces[inner_hash]
+        del Server.hddo_outer[outer_hash]
+        Server.hddo_accepted.pop(inner_hash, None)
+        if Server.custody is not None:
+            Server.custody.discard(inner_hash)
+        Server.hddo_reencrypted.pop(inner_hash, None)
+        Server.hddo_encoding_keys.pop(inner_hash, None)
+        Server.hddo_encryption_keys.pop(inner_hash, None)
+        if Server.script_cache is not None:
+            Server.script_cache.remove(inner_hash)
+        if len(Server.filters) > 0:
+            Server.filters['inner'].remove(inner_hash)
+            Server.filters['outer'].remove(outer_hash)
+        if len(Server.trees) > 0:
+            Server.trees['inner'].remove(inner_hash)
+            Server.trees['nounces'].remove(inner_hash)
+            Server.trees['outer'].remove(outer_hash)
+        DataIndex.remove(inner_hash)
+        Aggregator.remove(stored_data)
+        SeriesStore.remove(inner_hash)
+
+
+
+    @classmethod
+    def reportStoreSizes(cls):
+
+        Metrics.gauge('server.hddo_inner.size', len(Server.hddo_inner))
+        if Server.cold_store is not None:
+            Metrics.gauge('server.cold_store.size', Server.cold_store.size())
+        if Server.custody is not None:
+            Metrics.gauge('server.custody.pending', len(Server.custody))
+            Metrics.gauge('server.hddo_reencrypted.size', len(Server.hddo_reencrypted))
+        for name, bloom in Server.filters.items():
+            Metrics.gauge('server.filter.{}.false_positive_rate'.format(name), bloom.falsePositiveRate())
+            Metrics.gauge('server.filter.{}.negatives'.format(name), bloom.negatives)
+        Metrics.gauge('server.hddo_nounces.size', len(Server.hddo_nounces))
+        Metrics.gauge('server.hddo_outer.size', len(Server.hddo_outer))
+        Metrics.gauge('server.hddo_reserved.size', len(Server.hddo_reserved))
+        for name, limiter in Server.limiters.items():
+            Metrics.gauge('server.limiter.{}.keys'.format(name), len(limiter))
+        if Server.script_cache is not None:
+            Metrics.gauge('server.script_cache.bytes', Server.script_cache.size)
+            Metrics.gauge('server.script_cache.size', len(Server.script_cache))
+        Metrics.gauge('server.users.size', len(Server.users))
 
-        print('[Server] Checking HDDO transmission availability... ', end='')
-        if inner_hash not in Server.hddo_inner.keys() and inner_hash not in Server.hddo_reserved.keys():
-            print('Success.')
-            Server.hddo_reserved[inner_hash] = b64encode(urandom(64))
+
+
+    @classmethod
+    def reset(cls):
+
+        Server.hddo_accepted.clear()
+        Server.hddo_encoding_keys.clear()
+        Server.hddo_encryption_keys.clear()
+        Server.hddo_inner.clear()
+        Server.hddo_nounces.clear()
+        Server.hddo_outer.clear()
+        Server.hddo_reencrypted.clear()
+        Server.hddo_reserved.clear()
+        Server.users.clear()
+        if Server.custody is not None:
+            Server.custody.pending.clear()
+        Server.broadcasts.clear()
+        if Server.script_cache is not None:
+            Server.script_cache.clear()
+        for limiter in Server.limiters.values():
+            limiter.clear()
+        DataIndex.clear()
+        Aggregator.clear()
+        SeriesStore.clear()
+        if len(Server.filters) > 0:
+            Server.enableFilters(Server.filters['inner'].capacity,
+                                 Server.filters['inner'].error_rate)
+        if len(Server.trees) > 0:
+            Server.enableMerkle(Server.trees['inner'].depth)
+
+
+
+    @classmethod
+    @timed('server.reserveIfAvailable')
+    def reserveIfAvailable(cls, inner_hash, pha: str='', source: str=''):
+
+        if len(Server.limiters) > 0:
+            retry_after = Server.admit(pha, source)
+            if retry_after > 0.0:
+                LOGGER.info('Checking HDDO transmission availability... Rate limited.')
+                if Metrics.hooks:
+                    Metrics.count('server.reserveIfAvailable.rate_limited')
+                raise HDDORateLimitException(retry_after)
+        if not Server.isReserved(inner_hash) and not Server.isStored(inner_hash):
+            LOGGER.info('Checking HDDO transmission availability... Success.')
+            transmission_id = b64encode(urandom(64))
+            if Server.wal is not None:
+                Server.wal.append({'type' : 'reserve', 'inner_hash' : inner_hash,
+                                   'transmission_id' : transmission_id.decode('utf-8')})
+            Server.addReservation(inner_hash, transmission_id)
+            if Metrics.hooks:
+                Server.reportStoreSizes()
             return Server.hddo_reserved[inner_hash]
         else:
-            print('Failed.')
+            LOGGER.info('Checking HDDO transmission availability... Failed.')
             return ''
 
     @classmethod
+    def resolveRawData(cls, inner_hash: str, path: tuple):
+
+        stored = Server.getStoredHDDO(inner_hash)
+        if stored is not None:
+            for data_path, raw_data in walk_raw_data(stored.data):
+                if data_path == path:
+                    return raw_data
+        return None
+
+
+
+    @classmethod
+    def scanSeries(cls, signature: str, label: str, start=None, end=None):
+
+        return SeriesStore.scan(signature, label, start, end)
+
+
+
+    @classmethod
+    def sealCold(cls, keep_hot: int=0) -> int:
+
+        # hddo_inner keeps insertion order, so the first objects are the
+        # oldest ones.
+        count = len(Server.hddo_inner) - keep_hot
+        if Server.cold_store is None or count <= 0:
+            return 0
+        inner_hashes = []
+        for inner_hash in Server.hddo_inner.keys():
+            if len(inner_hashes) >= count:
+                break
+            inner_hashes.append(inner_hash)
+        if Server.wal is not None:
+            Server.wal.append({'type' : 'seal', 'inner_hashes' : inner_hashes})
+        Server.cold_store.seal([Server.hddo_inner[inner_hash] for inner_hash in inner_hashes])
+        Server.releaseSealed(inner_hashes)
+        if Metrics.hooks:
+            Server.reportStoreSizes()
+        return count
+
+
+
+    @classmethod
+    def storeCustody(cls, records: list):
+
+        # One bulk write per store, every store can be a different database.
+        Server.hddo_reencrypted.update((record[0], record[1]) for record in records)
+        Server.hddo_encoding_keys.update((record[0], record[2]) for record in records)
+        Server.hddo_encryption_keys.update((record[0], record[3]) for record in records)
+        Server.withholdData([record[0] for record in records])
+
+
+
+    @classmethod
+    def storedInnerHashes(cls):
+
+        yield from list(Server.hddo_inner.keys())
+        if Server.cold_store is not None:
+            yield from Server.cold_store.innerHashes()
+
+
+
+    @classmethod
+    def storeHDDO(cls, hddo, outer_hash: str, nounce: bytes):
+
+        # Indexes first, a failure there must not leave a half stored object.
+        DataIndex.add(hddo.innerHash, hddo.data)
+        try:
+            Aggregator.add(hddo.data)
+        except Exception:
+            DataIndex.remove(hddo.innerHash)
+            raise
+        Server.hddo_nounces[hddo.innerHash] = nounce
+        Server.hddo_outer[outer_hash] = hddo.innerHash
+        Server.hddo_inner[hddo.innerHash] = hddo
+        if Server.series_storage and hddo.seriesSignature != '' and is_number(hddo.data.value) and abs(hddo.data.value) < 2 ** 53:
+            SeriesStore.append(hddo.seriesSignature, hddo.data.label,
+                               hddo.innerHash, hddo.data.timestamp,
+                               hddo.data.value)
+        if Server.hddo_reserved.pop(hddo.innerHash, None) is not None and 'reserved' in Server.filters:
+            Server.filters['reserved'].remove(hddo.innerHash)
+        if len(Server.trees) > 0:
+            Server.trees['inner'].add(hddo.innerHash)
+            Server.trees['nounces'].add(hddo.innerHash, nounce.hex())
+            Server.trees['outer'].add(outer_hash, hddo.innerHash)
+        if len(Server.filters) > 0:
+            Server.filters['inner'].add(hddo.innerHash)
+            Server.filters['outer'].add(outer_hash)
+            if Server.filters['inner'].isFull() or Server.filters['outer'].isFull():
+                # Scale up instead of letting the false positive rate grow.
+                Server.enableFilters(2 * Server.filters['inner'].capacity,
+                                     Server.filters['inner'].error_rate)
+
+
+
+    @classmethod
+    def subscribeBroadcasts(cls, sig_key=None, predicate=None, capacity: int=1024,
+                            policy: str=Subscription.DROP) -> int:
+
+        LOGGER.info('Subscribing to broadcasts...')
+        return Server.broadcasts.subscribe(sig_key, predicate, capacity, policy)
+
+
+
+    @classmethod
+    def unsubscribeBroadcasts(cls, subscription_id: int):
+
+        Server.broadcasts.unsubscribe(subscription_id)
+
+
+
+    @classmethod
+    @timed('server.sendBroadcast')
     def sendBroadcast(cls, inner_hash):
 
         result = []
-        print('[Server] Broadcast intiative accepted.')
-        print('[Server] Searching for HealthDominoDataObject... ')
-        if inner_hash in Server.hddo_inner.keys():
-            print('Success.')
-            print('[Server] Validating HealthDominoDataObject against broadcast availability... ')
-            if len(Server.hddo_inner[inner_hash].script) > 0:
-                print('Success.')
-                result = deepcopy(Server.hddo_inner[inner_hash].script)
-                print('[Server] BROADCAST: Connection is available for script "{}"'.format(' '.join(result)))
+        LOGGER.info('Broadcast intiative accepted.')
+        script = None
+        if Server.script_cache is not None:
+            script = Server.script_cache.get(inner_hash)
+        if script is None:
+            stored = Server.getStoredHDDO(inner_hash)
+            if stored is not None:
+                script = stored.script
+                if Server.script_cache is not None:
+                    # Scripts of closed objects never change, only removeHDDO
+                    # invalidates them.
+                    script = Server.script_cache.put(inner_hash, script)
+        if script is not None:
+            LOGGER.info('Searching for HealthDominoDataObject... Success.')
+            if len(script) > 0:
+                LOGGER.info('Validating HealthDominoDataObject against broadcast availability... Success.')
+                result = list(script)
+                if LOGGER.isEnabledFor(INFO):
+                    LOGGER.info('BROADCAST: Connection is available for script "%s"', ' '.join(result))
+                if len(Server.broadcasts) > 0:
+                    published = Server.broadcasts.publish(inner_hash, result)
+                    LOGGER.info('BROADCAST: Pushed to %s of %s matching subscriptions.',
+                                published['delivered'], published['matched'])
             else:
-                print('Failed.')
+                LOGGER.info('Validating HealthDominoDataObject against broadcast availability... Failed.')
         else:
-            print('Failed.')
+            LOGGER.info('Searching for HealthDominoDataObject... Failed.')
         return result
+
+
+
+    @classmethod
+    def withholdData(cls, inner_hashes: list):
+
+        # Only the user can reveal the data of a protected object. It leaves
+        # the indexes and the stored object keeps its header with no value.
+        for inner_hash in inner_hashes:
+            stored = Server.getStoredHDDO(inner_hash)
+            if stored is None:
+                continue
+            DataIndex.remove(inner_hash)
+            Aggregator.remove(stored.data)
+            SeriesStore.remove(inner_hash)
+            record = hddo_to_record(stored)
+            record['data'] = RawData(stored.data.label, None, stored.data.timestamp,
+                                     stored.data.version).toJSON()
+            Server.hddo_inner[inner_hash] = hddo_from_record(record)
+            if Server.cold_store is not None:
+                Server.cold_store.delete(inner_hash)
+
+
+
+DataIndex.resolver = Server.resolveRawData
@@ -0,0 +1,298 @@
+"""
+HealthDomino
+============
+
+HealthDomino is a GDPR or HIPAA compatible data driven service, that helps
+the user to store, manage, share or use their own personal medical records or
+health data securely with the advantages of being anonymous or with revealed
+identity at the same time.
+
+WHY PYTHON?
+-----------
+We use Python for planning, modeling and prototyping purposes. We think Python
+code is much easier to read at the first time.
+
+The use of Python doesn't mean that we'll develop our production ready solution
+in Python or in Python only. We transform our solutions to C++ or Java quite
+often.
+
+THIS FILE
+---------
+This file contains the mock hashBase vault of the App. Only the owner of the
+hashBase can delete an object, so the App keeps the innerHash, outerHash,
+hashBase, label, timestamp and seriesSignature of every transmitted object in
+an encrypted, append-only file with 145 bytes per object. Indexes by label,
+time and series turn "delete all my weight readings of 2025" into one batched
+deletion request. Aside of the expected behavior nothing is well implemented.
+
+PyCryptodome is imported on first use of encryption.
+"""
+from base64 import b64decode, b64encode
+from bisect import bisect_left, bisect_right
+from mock_metrics import Metrics, timed
+from mock_other import get_logger
+from mock_outbox import decrypt_content, encrypt_content
+from os import fsync, replace
+from os.path import exists
+from struct import calcsize, pack, unpack_from
+
+
+
+LOGGER = get_logger('Vault')
+
+
+
+class Vault(object):
+
+
+
+    # Frame: length of the encrypted content that follows.
+    FRAME = '>I'
+    # Record: innerHash, outerHash, raw hashBase, timestamp, label, series.
+    RECORD = '>32s32s64sqII'
+    # Name definition of a label or a series: length of the UTF-8 name.
+    NAME = '>H'
+
+
+
+    def __init__(self, path: str, key: bytes):
+
+        self.path = path
+        self.key = key
+        self.labels = []
+        self.label_ids = {}
+        self.series = []
+        self.series_ids = {}
+        # innerHash -> (outerHash, hashBase, timestamp, label id, series id)
+        self.records = {}
+        self.label_timestamps = {}
+        self.label_keys = {}
+        self.series_keys = {}
+        self.dead = 0
+        if exists(path):
+            with open(path, 'rb') as in_file:
+                content = in_file.read()
+            frame_size = calcsize(Vault.FRAME)
+            offset = 0
+            while offset + frame_size <= len(content):
+                length, = unpack_from(Vault.FRAME, content, offset)
+                end = offset + frame_size + length
+                if end > len(content):
+                    break
+                # A complete frame that doesn't decrypt means a wrong key or a
+                # damaged file, that raises ValueError instead of truncating.
+                self.load(decrypt_content(key, content[offset + frame_size:end]))
+                offset = end
+            if offset < len(content):
+                # A torn write at the end of the file. Drop it, so the next
+                # frames are appended right after the last valid one.
+                with open(path, 'r+b') as out_file:
+                    out_file.truncate(offset)
+
+
+
+    @timed('vault.compact')
+    def compact(self) -> int:
+
+        dead = self.dead
+        items = [(inner_hash, outer_hash, hash_base, timestamp, self.labels[label_id],
+                  self.series[series_id])
+                 for inner_hash, (outer_hash, hash_base, timestamp, label_id, series_id)
+                 in self.records.items()]
+        self.labels, self.label_ids, self.series, self.series_ids = [], {}, [], {}
+        self.records, self.label_timestamps, self.label_keys, self.series_keys = {}, {}, {}, {}
+        content = self.encode(items)
+        with open(self.path + '.tmp', 'wb') as out_file:
+            out_file.write(content)
+            out_file.flush()
+            fsync(out_file.fileno())
+        replace(self.path + '.tmp', self.path)
+        self.indexItems(items)
+        self.dead = 0
+        return dead
+
+
+
+    @timed('vault.delete')
+    def delete(self, label: str='', start=None, end=None, series=None, client=None,
+               all: bool=False) -> int:
+
+        # Without a filter every object would be deleted, that must be asked
+        # for explicitly.
+        if not all and label == '' and start is None and end is None and series is None:
+            raise ValueError('Vault.delete needs a label, a time range, a series or all=True.')
+        if client is None:
+            from mock_app import App as client
+        inner_hashes = self.query(label, start, end, series)
+        if len(inner_hashes) == 0:
+            return 0
+        requests = [(inner_hash, self.records[inner_hash][0], self.records[inner_hash][1])
+                    for inner_hash in inner_hashes]
+        results = client.requestDeleteBatch(requests)
+        deleted = [inner_hash for inner_hash, is_deleted in zip(inner_hashes, results) if is_deleted]
+        if len(deleted) > 0:
+            self.write(b''.join(b'D' + bytes.fromhex(inner_hash) for inner_hash in deleted))
+            for inner_hash in deleted:
+                self.remove(inner_hash)
+            self.dead += len(deleted)
+        LOGGER.info('Deleting %s objects from the vault... %s deleted.', len(inner_hashes), len(deleted))
+        if Metrics.hooks:
+            Metrics.count('vault.deleted', len(deleted))
+        if self.dead > len(self.records):
+            self.compact()
+        return len(deleted)
+
+
+
+    def encode(self, items: list) -> bytes:
+
+        content = bytearray()
+        for inner_hash, outer_hash, hash_base, timestamp, label, series in items:
+            for name, names, ids, kind in ((label, self.labels, self.label_ids, b'L'),
+                                           (series, self.series, self.series_ids, b'S')):
+                if name not in ids:
+                    encoded = name.encode('utf-8')
+                    content += kind + pack(Vault.NAME, len(encoded)) + encoded
+                    ids[name] = len(names)
+                    names.append(name)
+            content += b'R' + pack(Vault.RECORD, bytes.fromhex(inner_hash), bytes.fromhex(outer_hash),
+                                   b64decode(hash_base), timestamp, self.label_ids[label],
+                                   self.series_ids[series])
+        encrypted = encrypt_content(self.key, bytes(content))
+        return pack(Vault.FRAME, len(encrypted)) + encrypted
+
+
+
+    def get(self, inner_hash: str):
+
+        if inner_hash not in self.records:
+            return None
+        outer_hash, hash_base, timestamp, label_id, series_id = self.records[inner_hash]
+        return (outer_hash, hash_base, timestamp, self.labels[label_id], self.series[series_id])
+
+
+
+    def hashBase(self, inner_hash: str) -> str:
+
+        return self.records[inner_hash][1] if inner_hash in self.records else ''
+
+
+
+    def index(self, inner_hash: str, record: tuple):
+
+        if inner_hash in self.records:
+            self.remove(inner_hash)
+        self.records[inner_hash] = record
+        _, _, timestamp, label_id, series_id = record
+        timestamps = self.label_timestamps.setdefault(label_id, [])
+        keys = self.label_keys.setdefault(label_id, [])
+        position = bisect_right(timestamps, timestamp)
+        timestamps.insert(position, timestamp)
+        keys.insert(position, inner_hash)
+        self.series_keys.setdefault(series_id, set()).add(inner_hash)
+
+
+
+    def indexItems(self, items: list):
+
+        for inner_hash, outer_hash, hash_base, timestamp, label, series in items:
+            self.index(inner_hash, (outer_hash, hash_base, timestamp, self.label_ids[label],
+                                    self.series_ids[series]))
+
+
+
+    def load(self, content: bytes):
+
+        record_size = calcsize(Vault.RECORD)
+        name_size = calcsize(Vault.NAME)
+        offset = 0
+        while offset < len(content):
+            kind = content[offset:offset + 1]
+            offset += 1
+            if kind == b'R':
+                inner, outer, hash_base, timestamp, label_id, series_id = unpack_from(Vault.RECORD, content, offset)
+                offset += record_size
+                self.index(inner.hex(), (outer.hex(), b64encode(hash_base).decode('utf-8'),
+                                         timestamp, label_id, series_id))
+            elif kind == b'D':
+                self.remove(content[offset:offset + 32].hex())
+                self.dead += 1
+                offset += 32
+            else:
+                length, = unpack_from(Vault.NAME, content, offset)
+                offset += name_size
+                name = content[offset:offset + length].decode('utf-8')
+                offset += length
+                names, ids = (self.labels, self.label_ids) if kind == b'L' else (self.series, self.series_ids)
+                ids[name] = len(names)
+                names.append(name)
+
+
+
+    def put(self, hddos: list):
+
+        items = [(hddo.innerHash, hddo.outerHash, hddo.hashBase, hddo.data.timestamp,
+                  hddo.data.label, hddo.seriesSignature) for hddo in hddos if hddo.isTransmitted]
+        if len(items) == 0:
+            return
+        self.write(self.encode(items), encoded=True)
+        self.indexItems(items)
+
+
+
+    def query(self, label: str='', start=None, end=None, series=None) -> list:
+
+        # A label also matches its sub-labels: 'human_measure.weight' matches
+        # 'human_measure.weight.kg' too.
+        result = []
+        for label_id, name in enumerate(self.labels):
+            if label != '' and name != label and not name.startswith(label + '.'):
+                continue
+            if label_id not in self.label_keys:
+                continue
+            timestamps = self.label_timestamps[label_id]
+            low = 0 if start is None else bisect_left(timestamps, start)
+            high = len(timestamps) if end is None else bisect_right(timestamps, end)
+            result.extend(self.label_keys[label_id][low:high])
+        if series is not None:
+            series_keys = self.series_keys.get(self.series_ids.get(series), set())
+            result = [inner_hash for inner_hash in result if inner_hash in series_keys]
+        return result
+
+
+
+    def remove(self, inner_hash: str):
+
+        record = self.records.pop(inner_hash, None)
+        if record is None:
+            return
+        _, _, timestamp, label_id, series_id = record
+        timestamps = self.label_timestamps[label_id]
+        keys = self.label_keys[label_id]
+        position = bisect_left(timestamps, timestamp)
+        while keys[position] != inner_hash:
+            position += 1
+        del timestamps[position]
+        del keys[position]
+        if len(keys) == 0:
+            del self.label_timestamps[label_id]
+            del self.label_keys[label_id]
+        self.series_keys[series_id].discard(inner_hash)
+
+
+
+    def write(self, content: bytes, encoded: bool=False):
+
+        if not encoded:
+            encrypted = encrypt_content(self.key, content)
+            content = pack(Vault.FRAME, len(encrypted)) + encrypted
+        with open(self.path, 'ab') as out_file:
+            out_file.write(content)
+            out_file.flush()
+            fsync(out_file.fileno())
+
+
+
+    def __len__(self) -> int:
+
+        return len(self.records)
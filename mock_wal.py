@@ -0,0 +1,287 @@
+"""
+HealthDomino
+============
+
+HealthDomino is a GDPR or HIPAA compatible data driven service, that helps
+the user to store, manage, share or use their own personal medical records or
+health data securely with the advantages of being anonymous or with revealed
+identity at the same time.
+
+WHY PYTHON?
+-----------
+We use Python for planning, modeling and prototyping purposes. We think Python
+code is much easier to read at the first time.
+
+The use of Python doesn't mean that we'll develop our production ready solution
+in Python or in Python only. We transform our solutions to C++ or Java quite
+often.
+
+THIS FILE
+---------
+This file contains the mock write-ahead log of the server. Mutations are
+appended as checksummed JSON lines. Concurrent appends are collected during
+the group commit window and made durable with a single fsync. The window is
+off by default: the single threaded Server has nothing to group, it appends
+a batch without waiting and waits once at the end instead. Snapshots store
+the whole state, so recovery only replays the log written after the last
+snapshot. Aside of the expected behavior nothing is well implemented.
+"""
+from hddo import HealthDominoDataObject, RawData
+import json
+from os import fsync, listdir, makedirs, remove, replace
+from os.path import join
+from threading import Condition, Lock, Thread
+from time import sleep
+from zlib import crc32
+
+
+
+class WriteAheadLog(object):
+
+
+
+    SEGMENT_FORMAT = 'wal-{:020d}.log'
+    SNAPSHOT_FORMAT = 'snapshot-{:020d}.json'
+
+
+
+    def __init__(self, directory: str, group_commit_seconds: float=0.0,
+                 max_batch: int=1024, snapshot_every: int=0):
+
+        makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.group_commit_seconds = group_commit_seconds
+        self.max_batch = max_batch
+        self.snapshot_every = snapshot_every
+        self.snapshot_provider = None
+        self.condition = Condition()
+        self.io_lock = Lock()
+        self.pending = []
+        self.lsn = 0
+        self.durable_lsn = 0
+        self.snapshot_lsn = 0
+        self.segment = None
+        self.flusher = None
+        self.is_closed = False
+
+
+
+    def append(self, record: dict, wait: bool=True) -> int:
+
+        # The Server applies a mutation right after it is logged, so at this
+        # point every earlier record is already part of the provided state.
+        if self.snapshot_every > 0 and self.snapshot_provider is not None \
+           and self.lsn - self.snapshot_lsn >= self.snapshot_every:
+            self.snapshot(self.snapshot_provider)
+        with self.condition:
+            self.lsn += 1
+            lsn = self.lsn
+            record['lsn'] = lsn
+            self.pending.append(encode_record(record))
+            if self.group_commit_seconds > 0:
+                self.startFlusher()
+                self.condition.notify_all()
+                if wait:
+                    while self.durable_lsn < lsn:
+                        self.condition.wait()
+        if self.group_commit_seconds <= 0 and wait:
+            self.flush()
+        return lsn
+
+
+
+    def close(self):
+
+        with self.condition:
+            self.is_closed = True
+            self.condition.notify_all()
+        if self.flusher is not None:
+            self.flusher.join()
+            self.flusher = None
+        self.flush()
+        with self.io_lock:
+            if self.segment is not None:
+                self.segment.close()
+                self.segment = None
+
+
+
+    def files(self, prefix: str) -> list:
+
+        return sorted(name for name in listdir(self.directory) if name.startswith(prefix))
+
+
+
+    def flush(self):
+
+        with self.io_lock:
+            with self.condition:
+                batch = self.pending
+                self.pending = []
+                last_lsn = self.lsn
+            if len(batch) > 0:
+                self.openSegment()
+                self.segment.write(''.join(batch))
+                self.segment.flush()
+                fsync(self.segment.fileno())
+            with self.condition:
+                if last_lsn > self.durable_lsn:
+                    self.durable_lsn = last_lsn
+                self.condition.notify_all()
+
+
+
+    def flushLoop(self):
+
+        while True:
+            with self.condition:
+                while len(self.pending) == 0 and not self.is_closed:
+                    self.condition.wait()
+                if self.is_closed and len(self.pending) == 0:
+                    return
+            if len(self.pending) < self.max_batch:
+                sleep(self.group_commit_seconds)
+            self.flush()
+
+
+
+    def openSegment(self):
+
+        if self.segment is None:
+            path = join(self.directory, WriteAheadLog.SEGMENT_FORMAT.format(self.durable_lsn + 1))
+            self.segment = open(path, 'a', encoding='utf-8')
+
+
+
+    def recover(self) -> tuple:
+
+        state = None
+        snapshots = [name for name in self.files('snapshot-') if name.endswith('.json')]
+        if len(snapshots) > 0:
+            with open(join(self.directory, snapshots[-1]), 'r', encoding='utf-8') as in_file:
+                content = json.load(in_file)
+            state = content['state']
+            self.snapshot_lsn = content['lsn']
+        records = []
+        last_lsn = self.snapshot_lsn
+        for name in self.files('wal-'):
+            path = join(self.directory, name)
+            valid_bytes = 0
+            with open(path, 'rb') as in_file:
+                for line in in_file:
+                    record = decode_record(line)
+                    if record is None:
+                        break
+                    valid_bytes += len(line)
+                    if record['lsn'] > last_lsn:
+                        records.append(record)
+                        last_lsn = record['lsn']
+                else:
+                    continue
+            # A torn write at the end of the log. Drop it and anything after.
+            with open(path, 'r+b') as out_file:
+                out_file.truncate(valid_bytes)
+            break
+        with self.condition:
+            self.lsn = last_lsn
+            self.durable_lsn = last_lsn
+        return state, records
+
+
+
+    def snapshot(self, provider):
+
+        # The state and the log position are taken under the same lock, so
+        # no append can get between them.
+        with self.io_lock:
+            with self.condition:
+                state = provider()
+                lsn = self.lsn
+            path = join(self.directory, WriteAheadLog.SNAPSHOT_FORMAT.format(lsn))
+            with open(path + '.tmp', 'w', encoding='utf-8') as out_file:
+                json.dump({'lsn' : lsn, 'state' : state}, out_file)
+                out_file.flush()
+                fsync(out_file.fileno())
+            replace(path + '.tmp', path)
+            self.snapshot_lsn = lsn
+            for name in self.files('snapshot-'):
+                if name != WriteAheadLog.SNAPSHOT_FORMAT.format(lsn):
+                    remove(join(self.directory, name))
+        # Records up to the snapshot are not needed any more. Segments are
+        # only dropped if no later record got into them in the meantime.
+        self.flush()
+        with self.io_lock:
+            if self.segment is not None:
+                self.segment.close()
+                self.segment = None
+            if self.durable_lsn == lsn:
+                for name in self.files('wal-'):
+                    remove(join(self.directory, name))
+
+
+
+    def startFlusher(self):
+
+        if self.flusher is None and not self.is_closed:
+            self.flusher = Thread(target=self.flushLoop, daemon=True)
+            self.flusher.start()
+
+
+
+    def waitDurable(self, lsn: int):
+
+        if self.group_commit_seconds <= 0:
+            self.flush()
+            return
+        with self.condition:
+            self.startFlusher()
+            self.condition.notify_all()
+            while self.durable_lsn < lsn:
+                self.condition.wait()
+
+
+
+def decode_record(line: bytes):
+
+    try:
+        checksum, content = line.decode('utf-8').rstrip('\n').split(' ', 1)
+        if not line.endswith(b'\n') or int(checksum, 16) != crc32(content.encode('utf-8')):
+            return None
+        return json.loads(content)
+    except (UnicodeDecodeError, ValueError):
+        return None
+
+
+
+def encode_record(record: dict) -> str:
+
+    content = json.dumps(record, separators=(',', ':'))
+    return '{:08x} {}\n'.format(crc32(content.encode('utf-8')), content)
+
+
+
+def hddo_from_record(record: dict) -> HealthDominoDataObject:
+
+    result = HealthDominoDataObject(RawData.fromJSON(record['data'], lazy=True),
+                                    record['version'],
+                                    record['compatibility_limit'])
+    if len(record['script']) > 0:
+        result.addScript(record['script'])
+    result.addSeriesSignature(record['series_signature'])
+    for label, value in record['identity_info'].items():
+        result.addInfo(label, value)
+    result.addMessage(record['message'])
+    result.close()
+    result.reset_(record['pha'], record['inner_hash'], record['outer_hash'])
+    return result
+
+
+
+def hddo_to_record(hddo: HealthDominoDataObject) -> dict:
+
+    return {'data' : hddo.data.toJSON(), 'version' : hddo.version,
+            'compatibility_limit' : hddo.compatibilityLimit,
+            'script' : hddo.script, 'series_signature' : hddo.seriesSignature,
+            'pha' : hddo.pha, 'identity_info' : hddo.identityInfo,
+            'message' : hddo.message, 'inner_hash' : hddo.innerHash,
+            'outer_hash' : hddo.outerHash}
@@ -0,0 +1,50 @@
+"""
+Shared fixtures of the HealthDomino tests. The Server keeps its state at class
+level, so every test starts from a clean Server and leaves one behind.
+"""
+from os.path import dirname
+import sys
+
+sys.path.insert(0, dirname(dirname(__file__)))
+
+from mock_app import App
+from mock_server import Server
+import pytest
+
+
+
+def clean_server():
+
+    if Server.wal is not None:
+        Server.wal.close()
+        Server.wal = None
+    if Server.cold_store is not None:
+        Server.cold_store.close()
+        Server.cold_store = None
+    if Server.custody is not None:
+        Server.custody.close()
+        Server.custody = None
+    Server.filters = {}
+    Server.trees = {}
+    Server.limiters = {}
+    Server.script_cache = None
+    Server.reset()
+
+
+
+@pytest.fixture
+def server():
+
+    clean_server()
+    yield Server
+    clean_server()
+
+
+
+@pytest.fixture(scope='session')
+def client():
+
+    # Key generation is slow, one registered user serves every test.
+    result = App()
+    result.registerUser()
+    return result
@@ -0,0 +1,85 @@
+from hddo import HDDOInitException, HealthDominoDataObject, RawData
+import json
+import pytest
+
+
+
+class Reading(object):
+
+    def __init__(self, value, unit=None):
+
+        self.__value = value
+        if unit is not None:
+            self.unit = unit
+
+
+
+def test_encode_value_reads_every_instance():
+
+    first = json.loads(RawData.encodeValue(Reading(1.0)))
+    second = json.loads(RawData.encodeValue(Reading(2.0, 'kg')))
+    third = json.loads(RawData.encodeValue(Reading(3.0)))
+    assert first == {'object_type' : 'Reading', '__value' : 1.0}
+    assert second == {'object_type' : 'Reading', '__value' : 2.0, 'unit' : 'kg'}
+    assert third == {'object_type' : 'Reading', '__value' : 3.0}
+
+
+
+VALID = RawData('human_measure.weight.kg', [61.5, 62.0], 1613862953).toJSON()
+NESTED = RawData('human_measure.weight.kg', RawData('human_measure.weight.kg', 'note', 1613862953),
+                 1613862953).toJSON()
+PARSE_INPUTS = [
+    VALID,
+    NESTED,
+    VALID + ' \n',
+    VALID + ' garbage',
+    VALID + '}',
+    VALID[:-1] + ', "extra": 1}',
+    VALID[:-1] + '} "extra"',
+    VALID.replace('[61.5, 62.0]', '[61.5, 62.0'),
+    VALID.replace('[61.5, 62.0]', '[61.5, 62.0]]'),
+    VALID.replace('[61.5, 62.0]', '{"object_type": "Reading"}'),
+    VALID.replace('[61.5, 62.0]', '{"unit": "kg"}'),
+    NESTED.replace('"value": "note"', '"value": "note", "extra": 1'),
+    NESTED.replace('"label": "human_measure.weight.kg", "version": 0, "value": "note"',
+                   '"label": "no.such.label", "version": 0, "value": "note"'),
+]
+
+
+
+def parse(json_string: str, lazy: bool):
+
+    try:
+        raw_data = RawData.fromJSON(json_string, lazy=lazy)
+    except HDDOInitException:
+        return None
+    return raw_data.toJSON(), str(raw_data.value)
+
+
+
+@pytest.mark.parametrize('json_string', PARSE_INPUTS)
+def test_lazy_and_eager_parsing_agree(json_string):
+
+    assert parse(json_string, True) == parse(json_string, False)
+
+
+
+def test_lazy_parsing_rejects_trailing_data():
+
+    for json_string in (VALID + ' garbage', VALID[:-1] + ', "extra": 1}', VALID + '}'):
+        with pytest.raises(HDDOInitException):
+            RawData.fromJSON(json_string, lazy=True)
+
+
+
+def test_hash_of_known_versions_only():
+
+    assert HealthDominoDataObject.newHash(HealthDominoDataObject.VERSION_0).name == 'sha256'
+    assert HealthDominoDataObject.newHash(HealthDominoDataObject.VERSION_1).name == 'blake2b'
+    for version in (-1, 2):
+        with pytest.raises(HDDOInitException):
+            HealthDominoDataObject.newHash(version)
+        hddo = HealthDominoDataObject(RawData('human_measure.weight.kg', 50.0), version)
+        hddo.close()
+        with pytest.raises(HDDOInitException):
+            hddo.computeHash()
@@ -0,0 +1,37 @@
+from hddo import HealthDominoDataObject, RawData
+from mock_outbox import Outbox
+from os.path import join
+
+TIMESTAMP = 1613862953
+KEY = b'0' * 32
+
+
+
+def count_lines(directory: str) -> int:
+
+    with open(join(directory, Outbox.DELIVERED), 'rb') as in_file:
+        return len(in_file.readlines())
+
+
+
+def test_delivered_log_is_compacted(server, client, tmp_path):
+
+    directory = str(tmp_path / 'outbox')
+    outbox = Outbox(directory, KEY)
+    for i in range(4):
+        hddo = HealthDominoDataObject(RawData('human_measure.weight.kg', 50.0 + i, TIMESTAMP + i))
+        hddo.close()
+        outbox.put(hddo)
+    delivered = outbox.drain(client)
+    assert len(delivered) == 4
+    assert outbox.forget([delivered[0].innerHash]) == 1
+    # One tombstone, two dead lines of three live ones
+    assert count_lines(directory) == 5
+    assert outbox.forget([delivered[1].innerHash, delivered[1].innerHash, 'unknown']) == 1
+    # Four dead lines of two live ones, the log is rewritten.
+    assert count_lines(directory) == 2
+    reopened = Outbox(directory, KEY)
+    assert sorted(reopened.delivered.keys()) == sorted(hddo.innerHash for hddo in delivered[2:])
+    assert reopened.hashBase(delivered[2].innerHash) == delivered[2].hashBase
+    assert reopened.hashBase(delivered[0].innerHash) == ''
+    assert reopened.dead == 0
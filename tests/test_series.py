@@ -0,0 +1,21 @@
+from mock_series import SeriesStore
+
+
+
+def test_scan_merges_late_points(monkeypatch):
+
+    SeriesStore.clear()
+    monkeypatch.setattr(SeriesStore, 'BLOCK_SIZE', 4)
+    for timestamp in range(0, 80, 10):
+        SeriesStore.append('s', 'human_measure.weight.kg', 'h{}'.format(timestamp), timestamp, timestamp / 10)
+    # Both blocks are sealed, the late points are in the tail.
+    for timestamp in (35, 5):
+        SeriesStore.append('s', 'human_measure.weight.kg', 'h{}'.format(timestamp), timestamp, timestamp / 10)
+    points = list(SeriesStore.scan('s', 'human_measure.weight.kg'))
+    assert [point[1] for point in points] == [0, 5, 10, 20, 30, 35, 40, 50, 60, 70]
+    assert all(inner_hash == 'h{}'.format(timestamp) and value == timestamp / 10
+               for inner_hash, timestamp, value in points)
+    assert [point[1] for point in SeriesStore.scan('s', 'human_measure.weight.kg', 5, 40)] == [5, 10, 20, 30, 35, 40]
+    SeriesStore.remove('h35')
+    assert [point[1] for point in SeriesStore.scan('s', 'human_measure.weight.kg', 30)] == [30, 40, 50, 60, 70]
+    SeriesStore.clear()
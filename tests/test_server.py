@@ -0,0 +1,96 @@
+from hddo import HealthDominoDataObject, RawData
+from mock_custody import reveal_content
+from mock_segments import SegmentStore
+from mock_wal import WriteAheadLog
+from os.path import join
+
+TIMESTAMP = 1613862953
+
+
+
+def transmit(client, count: int, first: float=50.0, pha: bool=False) -> list:
+
+    result = []
+    for i in range(count):
+        hddo = HealthDominoDataObject(RawData('human_measure.weight.kg', first + i, TIMESTAMP + i))
+        if pha:
+            hddo.addPHA(client)
+        hddo.close()
+        hddo.transmit(client)
+        result.append(hddo)
+    return result
+
+
+
+def test_delete_sealed_object_after_recovery(server, client, tmp_path):
+
+    wal_path, cold_path = str(tmp_path / 'wal'), str(tmp_path / 'cold')
+    server.users[client.user_pha] = client.user_public_key
+    server.recover(WriteAheadLog(wal_path, snapshot_every=3))
+    server.cold_store = SegmentStore(cold_path)
+    sealed = transmit(client, 4)
+    assert server.sealCold() == 4
+    transmit(client, 4, 60.0)
+    # Restart
+    server.wal.close()
+    server.cold_store.close()
+    server.wal = None
+    server.cold_store = SegmentStore(cold_path)
+    server.recover(WriteAheadLog(wal_path, snapshot_every=3))
+    assert len(server.hddo_inner) == 4
+    assert server.cold_store.size() == 4
+    hddo = sealed[0]
+    assert client.requestDelete(HealthDominoDataObject.toSendable(hddo), hddo.hashBase)
+    assert not server.isStored(hddo.innerHash)
+    assert server.getStoredHDDO(hddo.innerHash) is None
+    values = [raw_data.value for raw_data in server.queryData('human_measure.weight.kg')]
+    assert hddo.data.value not in values
+    assert len(values) == 7
+
+
+
+def test_reservations_across_filter_capacity(server):
+
+    server.enableFilters(capacity=4)
+    inner_hashes = ['{:064x}'.format(i) for i in range(12)]
+    for inner_hash in inner_hashes:
+        assert server.reserveIfAvailable(inner_hash) != ''
+    assert server.filters['reserved'].capacity > 4
+    for inner_hash in inner_hashes:
+        assert server.isReserved(inner_hash)
+        assert server.reserveIfAvailable(inner_hash) == ''
+
+
+
+def test_custody_survives_restart_without_plaintext(server, client, tmp_path):
+
+    wal_path = str(tmp_path / 'wal')
+    server.recover(WriteAheadLog(wal_path, snapshot_every=5))
+    server.createAccountIfAvailable(client.user_pha, client.user_public_key)
+    server.enableCustody(batch_size=3, workers=1)
+    hddos = transmit(client, 7, pha=True)
+    protected = [hddo.innerHash for hddo in hddos[:6]]
+    assert sorted(server.hddo_reencrypted.keys()) == sorted(protected)
+    for inner_hash in protected:
+        assert server.getStoredHDDO(inner_hash).data.value is None
+    assert [raw_data.value for raw_data in server.queryData('human_measure.weight.kg')] == [56.0]
+    # Restart, the snapshot has some of the protected objects, the log the rest.
+    server.wal.close()
+    server.wal = None
+    server.recover(WriteAheadLog(wal_path, snapshot_every=5))
+    assert sorted(server.hddo_reencrypted.keys()) == sorted(protected)
+    for hddo in hddos[:6]:
+        inner_hash = hddo.innerHash
+        assert server.getStoredHDDO(inner_hash).data.value is None
+        assert reveal_content(client.user_private_key, server.hddo_reencrypted[inner_hash],
+                              server.hddo_encoding_keys[inner_hash],
+                              server.hddo_encryption_keys[inner_hash]) == hddo.data.toJSON()
+    assert [raw_data.value for raw_data in server.queryData('human_measure.weight.kg')] == [56.0]
+    # The object accepted last waits for protection again.
+    assert len(server.custody) == 1
+    assert server.flushCustody() == 1
+    assert server.getStoredHDDO(hddos[6].innerHash).data.value is None
+    # Without the data only the copy of the client proves the ownership.
+    assert server.deleteHDDOs([(hddos[0].innerHash, hddos[0].outerHash, hddos[0].hashBase)]) == [False]
+    assert client.requestDelete(HealthDominoDataObject.toSendable(hddos[0]), hddos[0].hashBase)
+    assert hddos[0].innerHash not in server.hddo_reencrypted
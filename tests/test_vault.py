@@ -0,0 +1,26 @@
+from hddo import HealthDominoDataObject, RawData
+from mock_vault import Vault
+from os import urandom
+import pytest
+
+TIMESTAMP = 1613862953
+
+
+
+def test_delete_needs_a_filter(server, client, tmp_path):
+
+    server.users[client.user_pha] = client.user_public_key
+    vault = Vault(str(tmp_path / 'vault.bin'), urandom(32))
+    hddos = []
+    for i in range(3):
+        hddo = HealthDominoDataObject(RawData('human_measure.weight.kg', 50.0 + i, TIMESTAMP + i))
+        hddo.close()
+        hddo.transmit(client)
+        hddos.append(hddo)
+    vault.put(hddos)
+    with pytest.raises(ValueError):
+        vault.delete(client=client)
+    assert len(vault) == 3
+    assert vault.delete(start=TIMESTAMP + 2, client=client) == 1
+    assert vault.delete(client=client, all=True) == 2
+    assert len(vault) == 0
@@ -0,0 +1,87 @@
+from hddo import HealthDominoDataObject, RawData
+from mock_wal import decode_record, WriteAheadLog
+from os.path import dirname, join
+from signal import SIGKILL
+from subprocess import PIPE, Popen
+import sys
+
+ROOT = dirname(dirname(__file__))
+TIMESTAMP = 1613862953
+# Transmits objects until it is killed. Every printed line is a transmission
+# the Server confirmed, so it must survive the crash.
+CHILD = '''
+import sys
+sys.path.insert(0, {root!r})
+from hddo import HealthDominoDataObject, RawData
+from mock_app import App
+from mock_server import Server
+from mock_wal import WriteAheadLog
+Server.recover(WriteAheadLog({directory!r}, group_commit_seconds=0.002, snapshot_every=64))
+client = App()
+i = 0
+while True:
+    hddo = HealthDominoDataObject(RawData('human_measure.weight.kg', 50.0 + i % 1000 / 100, {timestamp} + i))
+    hddo.close()
+    hddo.transmit(client)
+    print(hddo.innerHash, hddo.outerHash, flush=True)
+    i += 1
+'''
+
+
+
+def test_recovery_after_kill_during_group_commit(server, tmp_path):
+
+    directory = str(tmp_path / 'wal')
+    child = Popen([sys.executable, '-c', CHILD.format(root=ROOT, directory=directory,
+                                                      timestamp=TIMESTAMP)],
+                  stdout=PIPE, stderr=PIPE, text=True)
+    confirmed = []
+    for line in child.stdout:
+        confirmed.append(line.split())
+        if len(confirmed) >= 200:
+            break
+    child.send_signal(SIGKILL)
+    child.wait()
+    assert len(confirmed) == 200
+    # The process may also die in the middle of a write.
+    wal = WriteAheadLog(directory)
+    segment = join(directory, wal.files('wal-')[-1])
+    with open(segment, 'a', encoding='utf-8') as out_file:
+        out_file.write('0badc0de {"type":"accept","hd')
+    server.recover(wal)
+    with open(segment, 'rb') as in_file:
+        lines = in_file.readlines()
+    assert all(decode_record(line) is not None for line in lines)
+    for inner_hash, outer_hash in confirmed:
+        assert server.isStored(inner_hash)
+        assert server.hddo_outer[outer_hash] == inner_hash
+    # At most the transmission in flight got in without being confirmed.
+    assert len(server.hddo_outer) - len(confirmed) in (0, 1)
+    state = server.getState()
+    server.wal.close()
+    server.wal = None
+    server.recover(WriteAheadLog(directory))
+    assert server.getState() == state
+
+
+
+def test_recovery_keeps_replay_protection(server, client, tmp_path):
+
+    directory = str(tmp_path / 'wal')
+    server.recover(WriteAheadLog(directory, snapshot_every=2))
+    hddos = []
+    for i in range(4):
+        hddo = HealthDominoDataObject(RawData('human_measure.weight.kg', 50.0 + i, TIMESTAMP + i))
+        hddo.close()
+        sendable = HealthDominoDataObject.toSendable(hddo)
+        inner_hash = hddo.computeHash()
+        hddo.reset_('', inner_hash, '', hddo.hashBase)
+        sendable.reset_('', inner_hash, '')
+        transmission_id = server.reserveIfAvailable(inner_hash)
+        hddos.append((sendable, transmission_id, server.acceptHDDO(sendable, transmission_id)))
+    server.wal.close()
+    server.wal = None
+    server.recover(WriteAheadLog(directory, snapshot_every=2))
+    for sendable, transmission_id, outer_hash in hddos:
+        # A client that lost the reply repeats the transmission.
+        assert server.acceptHDDO(sendable, transmission_id) == outer_hash